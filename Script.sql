@@ -1,3 +1,5 @@
+-- базовая схема (версия 1); дальнейшие изменения - миграции в etl/schema.py (python etl/schema.py)
+
 -- размерности
 
 CREATE TABLE IF NOT EXISTS dim_category (
@@ -9,9 +11,13 @@ CREATE TABLE IF NOT EXISTS dim_product (
   product_id INTEGER PRIMARY KEY,
   title TEXT NOT NULL,
   image TEXT,
-  category_id INTEGER NOT NULL REFERENCES dim_category(category_id)
+  category_id INTEGER NOT NULL REFERENCES dim_category(category_id),
+  attr_hash TEXT
   );
 
+-- отпечаток атрибутов товара для загрузки только изменённых товаров (для уже созданных баз)
+ALTER TABLE dim_product ADD COLUMN IF NOT EXISTS attr_hash TEXT;
+
 CREATE TABLE dim_time (
   time_id SERIAL PRIMARY KEY,
   etl_time TIMESTAMP NOT NULL UNIQUE,  
@@ -0,0 +1 @@
+# бенчмарки пайплайна: mock api, генератор данных и замеры по стадиям
@@ -0,0 +1,123 @@
+# datagen.py
+
+import json
+import random
+import sqlite3
+from typing import Any, Dict, Iterator
+
+# категории как у fakestoreapi
+CATEGORIES = ["men's clothing", "jewelery", "electronics", "women's clothing"]
+
+# настоящие валюты ответа цб: USD и валюты пересчёта по умолчанию (transform.TARGET_CURRENCIES),
+# иначе transform не нашёл бы их курсов и бенчмарк мерил бы прогон без валютных цен
+CBR_CURRENCIES = {
+    "USD": {"CharCode": "USD", "Nominal": 1, "Name": "Доллар США", "Value": 80.0},
+    "EUR": {"CharCode": "EUR", "Nominal": 1, "Name": "Евро", "Value": 92.5},
+    "CNY": {"CharCode": "CNY", "Nominal": 1, "Name": "Китайский юань", "Value": 11.1},
+}
+
+
+def iter_products(n: int, seed: int = 0) -> Iterator[Dict[str, Any]]:
+    # генерирует n товаров в формате fakestoreapi, не держа их в памяти
+    rng = random.Random(seed)
+    for i in range(1, n + 1):
+        yield {
+            "id": i,
+            "title": f"Product {i}",
+            "price": round(rng.uniform(1, 1000), 2),
+            "description": "synthetic product for benchmarks",
+            "category": CATEGORIES[i % len(CATEGORIES)],
+            "image": f"https://fakestoreapi.com/img/{i}.jpg",
+            "rating": {"rate": round(rng.uniform(1, 5), 1), "count": rng.randint(0, 1000)},
+        }
+
+
+def write_products(path: str, n: int, seed: int = 0) -> int:
+    # пишет каталог из n товаров json-массивом потоково (подходит и для 10M строк)
+    # возвращает размер файла в байтах
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        written += 1
+        for i, p in enumerate(iter_products(n, seed)):
+            chunk = ("," if i else "") + json.dumps(p, ensure_ascii=False)
+            f.write(chunk)
+            written += len(chunk.encode("utf-8"))
+        f.write("]")
+        written += 1
+    return written
+
+
+def products_payload(n: int, seed: int = 0) -> bytes:
+    # каталог целиком в байтах (для mock-сервера)
+    return json.dumps(list(iter_products(n, seed)), ensure_ascii=False).encode("utf-8")
+
+
+def iter_sales_history(n: int, seed: int = 0) -> Iterator[tuple]:
+    # пары (id товара строкой, продажи) как в sales_history.json
+    rng = random.Random(seed + 1)
+    for i in range(1, n + 1):
+        yield str(i), rng.randint(0, 100000)
+
+
+def write_sales_history_json(path: str, n: int, seed: int = 0) -> None:
+    # sales_history.json на n товаров, пишется потоково
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i, (key, sales) in enumerate(iter_sales_history(n, seed)):
+            f.write(("," if i else "") + f'"{key}": {sales}')
+        f.write("}")
+
+
+def write_sales_history_sqlite(path: str, n: int, seed: int = 0) -> None:
+    # та же история сразу в формате state.SqliteSalesStore
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sales_state (
+                product_id TEXT PRIMARY KEY,
+                sales INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS state_meta (key TEXT PRIMARY KEY, value TEXT);")
+        conn.executemany("INSERT OR REPLACE INTO sales_state (product_id, sales) VALUES (?, ?);",
+                         iter_sales_history(n, seed))
+        # история уже в sqlite, переносить sales_history.json не нужно
+        conn.execute("INSERT OR REPLACE INTO state_meta (key, value) VALUES ('migrated_from_json', 'datagen');")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def cbr_payload(n_currencies: int = 40) -> Dict[str, Any]:
+    # ответ cbr-xml-daily из n_currencies валют: CBR_CURRENCIES всегда есть, остальные синтетические
+    valute = {code: dict(item) for code, item in CBR_CURRENCIES.items()}
+    for i in range(1, n_currencies - len(valute) + 1):
+        code = f"X{i:02d}"
+        valute[code] = {"CharCode": code, "Nominal": 10 if i % 3 == 0 else 1,
+                        "Name": f"Валюта {i}", "Value": 10.0 + i}
+    return {"Date": "2026-01-01T11:30:00+03:00", "Valute": valute}
+
+
+def weather_item(latitude: float, longitude: float, hours: int = 24) -> Dict[str, Any]:
+    # ответ open-meteo для одной точки
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "hourly": {
+            "time": [f"2026-01-01T{h:02d}:00" for h in range(hours)],
+            "temperature_2m": [round(-5 + h * 0.5, 1) for h in range(hours)],
+        },
+    }
+
+
+def crypto_item(asset_id: str, rank: int) -> Dict[str, Any]:
+    # элемент ответа coingecko coins/markets
+    return {
+        "id": asset_id,
+        "symbol": asset_id[:4],
+        "name": asset_id.title(),
+        "current_price": 1000.0 / rank,
+        "price_change_percentage_24h": (rank % 7) - 3.0,
+    }
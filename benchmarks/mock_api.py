@@ -0,0 +1,127 @@
+# mock_api.py
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks import datagen
+
+# пути как у настоящих api
+PATH_PRODUCTS = "/products"
+PATH_CBR = "/daily_json.js"
+PATH_WEATHER = "/v1/forecast"
+PATH_CRYPTO = "/api/v3/coins/markets"
+
+
+class MockApi:
+    # локальная замена fakestoreapi, cbr-xml-daily, open-meteo и coingecko
+    # n_products - размер каталога, latency - задержка ответа в секундах по пути (или общая)
+    # использование: with MockApi(n_products=1000, latency=0.05) as api: api.urls()
+
+    def __init__(self, n_products: int = 20, latency: float = 0.0,
+                 latencies: Optional[Dict[str, float]] = None,
+                 n_currencies: int = 40, host: str = "127.0.0.1", port: int = 0):
+        self.n_products = n_products
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.n_currencies = n_currencies
+        self.requests = 0
+        self._lock = threading.Lock()
+        # тело каталога строим один раз, это самый большой ответ
+        self._products = datagen.products_payload(n_products)
+        self._cbr = json.dumps(datagen.cbr_payload(n_currencies), ensure_ascii=False).encode("utf-8")
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def urls(self) -> Dict[str, str]:
+        # значения для констант URL_* в etl/extract.py
+        return {
+            "URL_PRODUCTS": self.base_url + PATH_PRODUCTS,
+            "URL_CBR_DAILY": self.base_url + PATH_CBR,
+            "URL_WEATHER": self.base_url + PATH_WEATHER,
+            "URL_CRYPTO": self.base_url + PATH_CRYPTO,
+        }
+
+    def _body(self, path: str, query: Dict[str, list]) -> Optional[bytes]:
+        if path == PATH_PRODUCTS:
+            return self._products
+        if path == PATH_CBR:
+            return self._cbr
+        if path == PATH_WEATHER:
+            lats = query.get("latitude", ["0"])[0].split(",")
+            lons = query.get("longitude", ["0"])[0].split(",")
+            items = [datagen.weather_item(float(lat), float(lon)) for lat, lon in zip(lats, lons)]
+            return json.dumps(items if len(items) > 1 else items[0]).encode("utf-8")
+        if path == PATH_CRYPTO:
+            ids = [i for i in query.get("ids", [""])[0].split(",") if i]
+            return json.dumps([datagen.crypto_item(a, r + 1) for r, a in enumerate(ids)]).encode("utf-8")
+        return None
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                with api._lock:
+                    api.requests += 1
+                delay = api.latencies.get(parts.path, api.latency)
+                if delay:
+                    time.sleep(delay)
+                body = api._body(parts.path, parse_qs(parts.query))
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockApi":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockApi":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="локальный mock api для бенчмарков")
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    api = MockApi(n_products=args.products, latency=args.latency, port=args.port)
+    print("mock api:", api.urls())
+    try:
+        api._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
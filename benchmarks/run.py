@@ -0,0 +1,383 @@
+# run.py
+# бенчмарки extract / transform / load на синтетических данных и локальном mock api
+# пример: python -m benchmarks.run --sizes 20,10000,100000 --stages extract,transform
+# результаты пишутся в json, два прогона можно сравнить: python -m benchmarks.run --compare old.json new.json
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from benchmarks import datagen
+from benchmarks.mock_api import MockApi
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ETL_DIR = os.path.join(PROJECT_DIR, "etl")
+RESULTS_DIR = os.path.join(PROJECT_DIR, "benchmarks", "results")
+
+# модули etl импортируют друг друга напрямую, как при запуске из папки etl
+sys.path.insert(0, ETL_DIR)
+
+STAGES = ("extract", "transform", "load")
+
+
+# ИЗМЕРЕНИЯ
+
+def measure(fn: Callable[[], Any], setup: Optional[Callable[[], Any]] = None,
+            repeat: int = 3, memory: bool = True) -> Dict[str, Any]:
+    # время - по repeat прогонам без tracemalloc, пик памяти - отдельным прогоном под tracemalloc
+    # setup вызывается перед каждым прогоном и в замер не входит
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+
+    result: Dict[str, Any] = {
+        "seconds_min": min(times),
+        "seconds_median": statistics.median(times),
+        "repeat": repeat,
+    }
+    if memory:
+        if setup:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+@contextlib.contextmanager
+def etl_sandbox(workdir: str) -> Iterator[Dict[str, Any]]:
+    # перенаправляет все пути данных модулей etl во временную папку workdir
+    # (в том числе здоровье источников и последние удачные данные: иначе фиктивный каталог mock api
+    # стал бы запасным для настоящего прогона)
+    import export
+    import extract
+    import ledger
+    import metrics
+    import resilience
+    import snapshots
+    import state
+    import transform
+
+    saved = {
+        (extract, "DATA_DIR"): extract.DATA_DIR,
+        (extract, "SOURCE_META"): extract.SOURCE_META,
+        (transform, "DATA_DIR"): transform.DATA_DIR,
+        (transform, "RAW_PRODUCTS"): transform.RAW_PRODUCTS,
+        (transform, "RAW_CBR"): transform.RAW_CBR,
+        (transform, "RAW_WEATHER"): transform.RAW_WEATHER,
+        (transform, "RAW_CRYPTO"): transform.RAW_CRYPTO,
+        (state, "DATA_DIR"): state.DATA_DIR,
+        (state, "SALES_HISTORY"): state.SALES_HISTORY,
+        (state, "SALES_STATE_DB"): state.SALES_STATE_DB,
+        (state, "PRODUCT_FINGERPRINTS"): state.PRODUCT_FINGERPRINTS,
+        (snapshots, "SNAPSHOT_DIR"): snapshots.SNAPSHOT_DIR,
+        (resilience, "SOURCE_HEALTH"): resilience.SOURCE_HEALTH,
+        (resilience, "LAST_GOOD_DIR"): resilience.LAST_GOOD_DIR,
+        (resilience, "_health"): resilience._health,
+        (resilience, "_last_good_values"): resilience._last_good_values,
+        (metrics, "METRICS_DIR"): metrics.METRICS_DIR,
+        (ledger, "LEDGER_DIR"): ledger.LEDGER_DIR,
+        (export, "EXPORT_DIR"): export.EXPORT_DIR,
+    }
+    extract.DATA_DIR = transform.DATA_DIR = state.DATA_DIR = workdir
+    extract.SOURCE_META = os.path.join(workdir, "source_meta.json")
+    extract._source_meta = None
+    transform.RAW_PRODUCTS = os.path.join(workdir, "raw_products.json")
+    transform.RAW_CBR = os.path.join(workdir, "raw_cbr.json")
+    transform.RAW_WEATHER = os.path.join(workdir, "raw_weather.json")
+    transform.RAW_CRYPTO = os.path.join(workdir, "raw_crypto.json")
+    state.SALES_HISTORY = os.path.join(workdir, "sales_history.json")
+    state.SALES_STATE_DB = os.path.join(workdir, "sales_state.sqlite3")
+    state.PRODUCT_FINGERPRINTS = os.path.join(workdir, "product_fingerprints.json")
+    snapshots.SNAPSHOT_DIR = os.path.join(workdir, "snapshots")
+    resilience.SOURCE_HEALTH = os.path.join(workdir, "source_health.json")
+    resilience.LAST_GOOD_DIR = os.path.join(workdir, "last_good")
+    resilience._health = None
+    resilience._last_good_values = {}
+    metrics.METRICS_DIR = os.path.join(workdir, "metrics")
+    ledger.LEDGER_DIR = os.path.join(workdir, "ledger")
+    export.EXPORT_DIR = os.path.join(workdir, "export")
+    try:
+        yield {"extract": extract, "transform": transform, "state": state}
+    finally:
+        for (module, name), value in saved.items():
+            setattr(module, name, value)
+        extract._source_meta = None
+
+
+def write_raw_inputs(workdir: str, n_products: int) -> None:
+    # сырые файлы для transform/load без обращения к api
+    datagen.write_products(os.path.join(workdir, "raw_products.json"), n_products)
+    with open(os.path.join(workdir, "raw_cbr.json"), "w", encoding="utf-8") as f:
+        json.dump(datagen.cbr_payload(), f, ensure_ascii=False)
+    with open(os.path.join(workdir, "raw_weather.json"), "w", encoding="utf-8") as f:
+        json.dump(datagen.weather_item(43.1155, 131.8855), f)
+    with open(os.path.join(workdir, "raw_crypto.json"), "w", encoding="utf-8") as f:
+        json.dump([datagen.crypto_item("bitcoin", 1)], f)
+
+
+def reset_state(workdir: str, n_products: int) -> None:
+    # история продаж на n_products товаров в sqlite-хранилище
+    for name in os.listdir(workdir):
+        if name.startswith("sales_state.sqlite3") or name == "product_fingerprints.json":
+            os.remove(os.path.join(workdir, name))
+    datagen.write_sales_history_sqlite(os.path.join(workdir, "sales_state.sqlite3"), n_products)
+
+
+# СТАДИИ
+
+def bench_extract(size: int, args) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory(prefix="etl_bench_") as workdir, \
+            etl_sandbox(workdir) as mods, \
+            MockApi(n_products=size, latency=args.latency) as api:
+        extract = mods["extract"]
+        saved_urls = {name: getattr(extract, name) for name in api.urls()}
+        for name, url in api.urls().items():
+            setattr(extract, name, url)
+        try:
+            def sequential():
+                for fetch in extract.SOURCES.values():
+                    fetch()
+
+            def concurrent():
+                extract.run_extract()
+
+            for case, fn in (("sequential", sequential), ("concurrent", concurrent)):
+                res = measure(fn, repeat=args.repeat, memory=not args.no_memory)
+                res.update(stage="extract", case=case, size=size, latency=args.latency)
+                results.append(res)
+        finally:
+            for name, url in saved_urls.items():
+                setattr(extract, name, url)
+            extract.close_sessions()
+    return results
+
+
+def bench_transform(size: int, args) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory(prefix="etl_bench_") as workdir, \
+            etl_sandbox(workdir) as mods:
+        transform = mods["transform"]
+        write_raw_inputs(workdir, size)
+
+        def setup():
+            reset_state(workdir, size)
+
+        for engine in args.engines:
+            transform.ENGINE = engine
+
+            def whole():
+                transform.transform()
+
+            def batched():
+                for _ in transform.transform_batches(args.batch_size):
+                    pass
+
+            for case, fn in (("transform", whole), ("transform_batches", batched)):
+                res = measure(fn, setup=setup, repeat=args.repeat, memory=not args.no_memory)
+                res.update(stage="transform", case=f"{case}[{engine}]", size=size)
+                results.append(res)
+        transform.ENGINE = os.getenv("ETL_ENGINE", "python")
+        check_engines(transform, args.engines, setup)
+    return results
+
+
+def check_engines(transform, engines: List[str], setup: Callable[[], Any]) -> None:
+    # движки обязаны давать одинаковые записи: сравниваем с первым на одном и том же состоянии
+    outputs = {}
+    try:
+        for engine in engines:
+            transform.ENGINE = engine
+            setup()
+            outputs[engine] = list(transform.transform())
+    finally:
+        transform.ENGINE = os.getenv("ETL_ENGINE", "python")
+    first = engines[0]
+    for engine in engines[1:]:
+        diff = [i for i, (a, b) in enumerate(zip(outputs[first], outputs[engine])) if a != b]
+        if diff or len(outputs[first]) != len(outputs[engine]):
+            i = diff[0] if diff else min(len(outputs[first]), len(outputs[engine]))
+            raise RuntimeError(f"движки {first} и {engine} дают разные записи: "
+                               f"расхождений {len(diff)}, первое - запись {i}")
+
+
+@contextlib.contextmanager
+def throwaway_database(load_module) -> Iterator[Dict[str, Any]]:
+    # создаёт временную базу на сервере из DB_PARAMS, накатывает миграции schema.py и удаляет после
+    import psycopg2
+    import schema
+
+    admin_params = dict(load_module.DB_PARAMS)
+    dbname = f"etl_bench_{os.getpid()}"
+    admin = psycopg2.connect(**admin_params)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {dbname};")
+        cur.execute(f"CREATE DATABASE {dbname};")
+    params = dict(admin_params, dbname=dbname)
+    try:
+        with psycopg2.connect(**params) as conn:
+            schema.migrate(conn)
+        yield params
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS {dbname} WITH (FORCE);")
+        admin.close()
+
+
+def bench_load(size: int, args) -> List[Dict[str, Any]]:
+    import psycopg2
+    import load
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="etl_bench_") as workdir, \
+            etl_sandbox(workdir), throwaway_database(load) as params:
+        write_raw_inputs(workdir, size)
+        saved_params = load.DB_PARAMS
+        load.DB_PARAMS = params
+        # пул соединений создаётся из DB_PARAMS, поэтому пересоздаём его для временной базы
+        load.close_pool()
+
+        def setup():
+            # каждый прогон - холодная загрузка в пустые таблицы
+            reset_state(workdir, size)
+            load.DIM_CACHE.clear()
+            with psycopg2.connect(**params) as conn, conn.cursor() as cur:
+                cur.execute("""
+                    TRUNCATE fact_sales, fact_weather, fact_currency, fact_crypto_price,
+                             dim_product, dim_category, dim_time, dim_location,
+                             dim_currency, dim_crypto_asset
+                    RESTART IDENTITY CASCADE;
+                """)
+
+        try:
+            for mode in args.load_modes:
+                # load() включает transform(), как и в обычном запуске
+                res = measure(lambda: load.load(mode=mode), setup=setup,
+                              repeat=args.repeat, memory=not args.no_memory)
+                res.update(stage="load", case=f"load[{mode}]", size=size)
+                results.append(res)
+        finally:
+            load.close_pool()
+            load.DB_PARAMS = saved_params
+    return results
+
+
+BENCHES = {"extract": bench_extract, "transform": bench_transform, "load": bench_load}
+
+
+# РЕЗУЛЬТАТЫ
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results: List[Dict[str, Any]], out_path: Optional[str]) -> str:
+    if out_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_path = os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    payload = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    return out_path
+
+
+def compare(base_path: str, new_path: str, threshold: float) -> int:
+    # сравнивает два файла результатов по медианному времени
+    # возвращает число регрессий (медленнее больше чем на threshold)
+    def index(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return {(r["stage"], r["case"], r["size"]): r for r in json.load(f)["results"]}
+
+    base, new = index(base_path), index(new_path)
+    regressions = 0
+    for key in sorted(set(base) & set(new), key=str):
+        old_t, new_t = base[key]["seconds_median"], new[key]["seconds_median"]
+        ratio = new_t / old_t if old_t else float("inf")
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  <-- регрессия"
+            regressions += 1
+        print(f"{key[0]:<10} {key[1]:<32} {key[2]:>10}  {old_t:9.4f} -> {new_t:9.4f} с  x{ratio:5.2f}{mark}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="бенчмарки etl")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="стадии через запятую: extract,transform,load")
+    parser.add_argument("--sizes", default="20,1000,10000",
+                        help="размеры каталога через запятую (от 20 до 10000000)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="задержка mock api в секундах на запрос")
+    parser.add_argument("--engines", default="python,columnar")
+    parser.add_argument("--load-modes", default="row,bulk,parallel")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--no-memory", action="store_true", help="не замерять пик памяти")
+    parser.add_argument("--out", help="куда записать json с результатами")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"),
+                        help="сравнить два файла результатов и выйти")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="допустимое замедление при сравнении (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    args.engines = [e for e in args.engines.split(",") if e]
+    args.load_modes = [m for m in args.load_modes.split(",") if m]
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = [s for s in stages if s not in BENCHES]
+    if unknown:
+        parser.error(f"неизвестные стадии: {', '.join(unknown)}")
+
+    results: List[Dict[str, Any]] = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        for stage in stages:
+            for res in BENCHES[stage](size, args):
+                print(f"{res['stage']:<10} {res['case']:<32} {res['size']:>10}  "
+                      f"{res['seconds_median']:9.4f} с  "
+                      f"{res.get('peak_mb', float('nan')):8.1f} МБ")
+                results.append(res)
+
+    out_path = write_results(results, args.out)
+    print("результаты:", out_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+# backfill.py
+
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Set
+
+from transform import transform, load_json
+from load import load, get_pool, close_pool, SOURCE_FACTS
+from schema import ensure_schema
+from snapshots import list_snapshots, load_run
+from state import SqliteSalesStore, open_sales_store
+from export import export_batches, EXPORT_FORMAT
+from metrics import span, inc, start_memory_probe, stop_memory_probe, export_run
+
+# КОНСТАНТЫ
+
+# сколько процессов разбирают снимки (ETL_BACKFILL_WORKERS), по умолчанию по числу ядер
+BACKFILL_WORKERS = int(os.getenv("ETL_BACKFILL_WORKERS", str(os.cpu_count() or 2)))
+# режим загрузки перепрогона, см. load.LOAD_MODE
+BACKFILL_LOAD_MODE = os.getenv("ETL_BACKFILL_LOAD_MODE", "bulk")
+
+# источники прогона; отсутствующий в снимке источник не должен подменяться файлом из data/
+RUN_SOURCES = tuple(SOURCE_FACTS)
+
+
+# ФУНКЦИИ
+
+def _prepare_run(etl_time: str, root: Optional[str] = None) -> Dict[str, Any]:
+    # выполняется в дочернем процессе: читает и распаковывает все снимки прогона etl_time
+    # возвращает raw только с источниками, которые есть в архиве, каталог товаров уже разобран в список
+    raw = load_run(etl_time, root)
+    if isinstance(raw.get("products"), str):
+        raw["products"] = load_json(raw["products"])
+    return raw
+
+
+def _loaded_times() -> Set[str]:
+    # etl_time прогонов, которые уже есть в dim_time
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        ensure_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_char(etl_time, 'YYYY-MM-DD HH24:MI:SS') FROM dim_time;")
+            loaded = {row[0] for row in cur.fetchall()}
+        conn.rollback()
+        return loaded
+    finally:
+        pool.putconn(conn)
+
+
+def _prefetch(executor: ProcessPoolExecutor, etl_times: List[str],
+              root: Optional[str], window: int) -> Iterator[Dict[str, Any]]:
+    # отдаёт raw прогонов строго по порядку etl_times,
+    # при этом впереди разбираются не больше window снимков (память не растёт с диапазоном)
+    pending: Deque[Future] = deque()
+    todo = iter(etl_times)
+    for etl_time in todo:
+        pending.append(executor.submit(_prepare_run, etl_time, root))
+        if len(pending) >= window:
+            break
+    while pending:
+        with span("backfill.wait_prepare"):
+            raw = pending.popleft().result()
+        next_time = next(todo, None)
+        if next_time is not None:
+            pending.append(executor.submit(_prepare_run, next_time, root))
+        yield raw
+
+
+@contextlib.contextmanager
+def _replay_store(state: Optional[str], live_state: bool) -> Iterator[Callable[[], Any]]:
+    # отдаёт фабрику хранилища истории продаж для перепрогона (transform закрывает его после прогона)
+    # live_state - настоящее хранилище пайплайна, state - свой sqlite-файл (можно продолжить
+    # следующим перепрогоном), иначе пустое временное хранилище, удаляемое после перепрогона
+    if live_state:
+        yield open_sales_store
+        return
+    if state:
+        yield lambda: SqliteSalesStore(state)
+        return
+    with tempfile.TemporaryDirectory(prefix="etl_backfill_") as tmp:
+        path = os.path.join(tmp, "sales_state.sqlite3")
+        yield lambda: SqliteSalesStore(path)
+
+
+def backfill(start: Optional[str] = None, end: Optional[str] = None, root: Optional[str] = None,
+             mode: Optional[str] = None, workers: int = BACKFILL_WORKERS,
+             reload: bool = False, state: Optional[str] = None, live_state: bool = False) -> int:
+    # перепрогон архивных снимков (snapshots.py) за диапазон etl_time [start, end]
+    # снимки разбираются пулом процессов, а transform и загрузка идут в основном процессе
+    # по возрастанию etl_time: история продаж - последовательная цепочка, её нельзя считать вразнобой
+    # у каждого прогона своё etl_time из архива, а не текущее время
+    # прогон демона (daemon.py) архивирует только обновлённые источники: такой снимок пишет только
+    # их факты, а записи продаж берут курс, погоду и крипту из последних более ранних снимков
+    # история продаж перепрогона ведётся отдельно от настоящей (state.py), чтобы снимки продолжали
+    # продажи своего времени, а не сегодняшние, и следующий обычный прогон не получил скачок:
+    # state - путь к своему sqlite-хранилищу, по умолчанию пустое временное;
+    # live_state - вести настоящее хранилище пайплайна (только явно)
+    # reload: грузить и прогоны, которые уже есть в dim_time; без него такие прогоны не грузятся,
+    # но история продаж проходит через них, чтобы цепочка не рвалась
+    # возвращает число загруженных прогонов
+    mode = mode or BACKFILL_LOAD_MODE
+    etl_times = sorted({etl_time for etl_time, _, _ in list_snapshots(start=start, end=end, root=root)})
+    loaded: Set[str] = set()
+    if not reload and etl_times:
+        loaded = _loaded_times().intersection(etl_times)
+        if loaded:
+            print(f"[backfill] уже загружено прогонов: {len(loaded)}, не грузим (--reload чтобы грузить)")
+        if live_state:
+            # настоящая история продаж эти прогоны уже прошла
+            etl_times = [t for t in etl_times if t not in loaded]
+        # прогоны после последнего незагруженного истории продаж не нужны
+        while etl_times and etl_times[-1] in loaded:
+            etl_times.pop()
+    if not etl_times:
+        print("[backfill] нет снимков для загрузки.")
+        return 0
+
+    todo = len(etl_times) - len(loaded.intersection(etl_times))
+    print(f"[backfill] прогонов: {todo}, с {etl_times[0]} по {etl_times[-1]}, "
+          f"процессов: {workers}")
+    done = 0
+    # последние известные данные по источникам
+    latest: Dict[str, Any] = {source: None for source in RUN_SOURCES}
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            _replay_store(state, live_state) as open_store:
+        for snapshot in _prefetch(executor, etl_times, root, window=workers * 2):
+            etl_time = snapshot["etl_time"]
+            present = [s for s in RUN_SOURCES if snapshot.get(s) is not None]
+            latest.update({s: snapshot[s] for s in present})
+            raw = dict(latest, etl_time=etl_time)
+            facts = [SOURCE_FACTS[s] for s in present]
+            if etl_time in loaded:
+                # уже в базе: только продвигаем историю продаж
+                if "sales" in facts:
+                    with span("backfill.transform"):
+                        transform(raw, store=open_store())
+                inc("backfill_runs_replayed")
+                continue
+            batches = None
+            if "sales" in facts:
+                with span("backfill.transform"):
+                    records = transform(raw, store=open_store())
+                if records:
+                    batches = [records]
+                    if EXPORT_FORMAT != "none":
+                        # выгрузка перепрогона ложится под etl_time из архива
+                        batches = export_batches(batches, etl_time)
+                else:
+                    facts.remove("sales")
+            if not facts:
+                print(f"[backfill] {etl_time}: снимок неполный, пропускаем")
+                inc("backfill_runs_skipped")
+                continue
+            # каталог между снимками мог меняться; лишнего не пишем благодаря отпечаткам товаров
+            with span("backfill.load"):
+                load(mode=mode, batches=batches, raw=raw, facts=facts)
+            inc("backfill_runs")
+            done += 1
+            print(f"[backfill] {etl_time}: загружено ({done}/{todo})")
+    return done
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="перепрогон архивных сырых снимков в хранилище")
+    parser.add_argument("--from", dest="start", help="начало диапазона: YYYY-MM-DD или 'YYYY-MM-DD HH:MM:SS'")
+    parser.add_argument("--to", dest="end", help="конец диапазона включительно, в том же виде")
+    parser.add_argument("--dir", dest="root", help="корень архива снимков, по умолчанию snapshots.SNAPSHOT_DIR")
+    parser.add_argument("--mode", default=None, help="режим загрузки: row, bulk или parallel")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--reload", action="store_true", help="грузить и уже загруженные прогоны")
+    parser.add_argument("--state", help="sqlite-хранилище истории продаж перепрогона, "
+                                        "по умолчанию пустое временное")
+    parser.add_argument("--live-state", action="store_true",
+                        help="вести настоящую историю продаж пайплайна вместо отдельной")
+    args = parser.parse_args()
+    if args.state and args.live_state:
+        parser.error("--state и --live-state вместе не используются")
+
+    start_memory_probe()
+    started = time.perf_counter()
+    try:
+        backfill(args.start, args.end, args.root, args.mode, args.workers, args.reload,
+                 args.state, args.live_state)
+    finally:
+        close_pool()
+        stop_memory_probe()
+        export_run("backfill")
+    print(f"[backfill] общее время: {time.perf_counter() - started:.3f} с")
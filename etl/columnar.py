@@ -0,0 +1,189 @@
+# columnar.py
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from records import RunContext, SalesRow
+from simulation import SalesSimulator, get_simulator
+
+
+# ИСТОРИЯ ПРОДАЖ В МАССИВАХ
+
+class SalesHistoryArray:
+    # история продаж в виде двух отсортированных массивов: id товара и продажи
+    # поиск сразу для всех товаров через searchsorted вместо словаря
+
+    def __init__(self, ids: np.ndarray, sales: np.ndarray):
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.sales = sales[order]
+
+    @classmethod
+    def from_dict(cls, history: Dict[str, int]) -> "SalesHistoryArray":
+        # ключи sales_history.json - строковые id товаров
+        ids = np.fromiter((int(k) for k in history), dtype=np.int64, count=len(history))
+        sales = np.fromiter(history.values(), dtype=np.int64, count=len(history))
+        return cls(ids, sales)
+
+    def lookup(self, ids: np.ndarray, default: np.ndarray) -> np.ndarray:
+        # продажи для ids, для отсутствующих в истории берётся default
+        if len(self.ids) == 0:
+            return default.copy()
+        pos = np.searchsorted(self.ids, ids)
+        pos_clipped = np.minimum(pos, len(self.ids) - 1)
+        found = self.ids[pos_clipped] == ids
+        return np.where(found, self.sales[pos_clipped], default)
+
+
+# ЛЕНИВЫЕ ЗАПИСИ
+
+class ColumnarRecords(Sequence):
+    # результат колоночного transform: числовые колонки в массивах numpy,
+    # записи SalesRow собираются только когда их запрашивают (индекс или итерация)
+    # context - общие поля прогона, как у records.SalesBatch
+
+    def __init__(self, context: RunContext, product_id: np.ndarray, title: List[Any], image: List[Any],
+                 category: List[Any], sales: np.ndarray, price_usd: np.ndarray,
+                 price_rub: Optional[np.ndarray]):
+        self.context = context
+        self.product_id = product_id
+        self.title = title
+        self.image = image
+        self.category = category
+        self.sales = sales
+        self.price_usd = price_usd
+        self.price_rub = price_rub
+
+    def __len__(self) -> int:
+        return len(self.product_id)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        price_rub = float(self.price_rub[i]) if self.price_rub is not None else None
+        return SalesRow(int(self.product_id[i]), self.title[i], self.image[i],
+                        self.category[i], int(self.sales[i]),
+                        float(self.price_usd[i]), price_rub)
+
+    def __iter__(self) -> Iterator[SalesRow]:
+        # колонки переводим в python-объекты разом, а не поэлементно
+        n = len(self)
+        price_rub = self.price_rub.tolist() if self.price_rub is not None else [None] * n
+        return map(SalesRow._make, zip(self.product_id.tolist(), self.title, self.image, self.category,
+                                       self.sales.tolist(), self.price_usd.tolist(), price_rub))
+
+
+# ТРАНСФОРМАЦИЯ
+
+def _to_price(value: Any, prod_id: Any) -> float:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        print(f"[build_columns] неверная цена у товара id={prod_id}, установлено 0.0")
+        return 0.0
+
+
+def _running_sales(ids: np.ndarray, prev: np.ndarray, increments: np.ndarray) -> np.ndarray:
+    # новые продажи = предыдущие + прирост
+    # если товар встречается в каталоге несколько раз, приросты накапливаются по порядку,
+    # как при последовательных вызовах build_row
+    n = len(ids)
+    if n == 0:
+        return prev.copy()
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    sorted_inc = increments[order]
+    csum = np.cumsum(sorted_inc)
+    starts = np.empty(n, dtype=bool)
+    starts[0] = True
+    starts[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    # индекс первого элемента группы для каждой позиции
+    group_first = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+    running = csum - (csum[group_first] - sorted_inc[group_first])
+    new_sales = np.empty_like(prev)
+    new_sales[order] = prev[order][group_first] + running
+    return new_sales
+
+
+def rub_prices(prices: np.ndarray, cbr_rate: float) -> np.ndarray:
+    # цены в рублях: умножение то же, что у build_row, а округляем python-овским round: np.round округляет
+    # иначе (умножает на 100), и часть цен расходилась бы с построчным движком на копейку
+    return np.array([round(v, 2) for v in (prices * cbr_rate).tolist()], dtype=np.float64)
+
+
+def product_columns(products: Sequence[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                                                    List[Any], List[Any], List[Any]]:
+    # раскладывает товары по колонкам за один проход:
+    # id, базовые продажи, цены в долларах (массивы) и названия, картинки, категории (списки)
+    # id и базовые продажи должны быть целыми: массив int64 молча обрезал бы 3.7 до 3,
+    # а построчный движок хранит их как есть - TypeError, и build_records считает построчно
+    n = len(products)
+    ids = np.empty(n, dtype=np.int64)
+    base_sales = np.empty(n, dtype=np.int64)
+    prices = np.empty(n, dtype=np.float64)
+    titles: List[Any] = [None] * n
+    images: List[Any] = [None] * n
+    categories: List[Any] = [None] * n
+
+    for i, p in enumerate(products):
+        prod_id = p.get("id")
+        count = p.get("rating", {}).get("count", 0)
+        if type(prod_id) is not int or type(count) is not int:
+            raise TypeError(f"нецелый id или продажи у товара id={prod_id!r}")
+        ids[i] = prod_id
+        titles[i] = p.get("title")
+        images[i] = p.get("image")
+        categories[i] = p.get("category")
+        prices[i] = _to_price(p.get("price", 0), prod_id)
+        base_sales[i] = count
+    return ids, base_sales, prices, titles, images, categories
+
+
+def build_columns(
+    products: Sequence[Dict[str, Any]],
+    context: RunContext,
+    sales_history: Dict[str, int],
+    simulator: Optional[SalesSimulator] = None
+) -> ColumnarRecords:
+    # колоночный аналог цикла по build_row: товары раскладываем по колонкам,
+    # цены и продажи считаем операциями над массивами
+    # обновляет sales_history в памяти (не сохраняет в файл)
+    ids, base_sales, prices, titles, images, categories = product_columns(products)
+
+    # предыдущие продажи из истории, приросты - сразу для всей пачки (simulation.py),
+    # те же, что у build_row при том же зерне
+    history = SalesHistoryArray.from_dict(sales_history)
+    prev_sales = history.lookup(ids, base_sales)
+    simulator = simulator or get_simulator()
+    increments = simulator.increment_array(ids, context.etl_time)
+    new_sales = _running_sales(ids, prev_sales, increments)
+
+    # сохраняем в историю (при повторе id остаётся последнее значение)
+    sales_history.update(zip(map(str, ids.tolist()), new_sales.tolist()))
+
+    # пересчитываем цену в рубли если курс есть
+    cbr_rate = context.cbr_rate
+    price_rub = rub_prices(prices, cbr_rate) if cbr_rate else None
+
+    return ColumnarRecords(context, ids, titles, images, categories, new_sales, prices, price_rub)
+
+
+# ПЕРЕСЧЁТ ЦЕН В ВАЛЮТЫ
+
+def price_matrix(records: Sequence[SalesRow]) -> Tuple[List[str], np.ndarray]:
+    # цены пачки (ColumnarRecords или SalesBatch) во всех валютах records.context.fx одной операцией:
+    # матрица (товары, валюты) = цены в долларах x множители, округление до копеек/центов
+    # возвращает коды валют (столбцы) и матрицу
+    fx = records.context.fx
+    codes = [code for code, _ in fx]
+    factors = np.fromiter((factor for _, factor in fx), dtype=np.float64, count=len(fx))
+    if isinstance(records, ColumnarRecords):
+        prices = records.price_usd
+    else:
+        prices = np.fromiter((row.price_usd for row in records), dtype=np.float64, count=len(records))
+    return codes, np.round(np.outer(prices, factors), 2)
@@ -0,0 +1,178 @@
+# daemon.py
+
+import json
+import os
+import signal
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import extract
+from extract import run_extract, get_stale_sources, close_sessions, RAW_SOURCES
+from transform import transform
+from load import load, close_pool, SOURCE_FACTS
+from pipeline import SAVE_RAW
+from snapshots import archive_raw, etl_time_now, ARCHIVE_ENABLED
+from export import export_batches, EXPORT_FORMAT
+from metrics import span, inc, export_run
+
+# КОНСТАНТЫ
+
+# как часто опрашивать каждый источник, секунды
+# курс цб меняется раз в день, крипта - каждую минуту; ETL_INTERVALS='{"crypto": 30}' переопределяет
+DEFAULT_INTERVALS: Dict[str, float] = {
+    "products": 3600,
+    "cbr":      3600,
+    "weather":  900,
+    "crypto":   60,
+}
+# источники, которым подходит срок в ближайшие SCHEDULE_SLACK секунд, идут в текущий цикл:
+# etl_time считается с точностью до секунды, отдельные циклы в одну секунду слились бы в один прогон
+SCHEDULE_SLACK = 1.0
+# через сколько секунд повторить источник, который не загрузился (если это раньше его интервала)
+RETRY_SECONDS = float(os.getenv("ETL_DAEMON_RETRY", "60"))
+
+
+def _env_intervals(name: str, default: Dict[str, float]) -> Dict[str, float]:
+    # интервалы из переменной окружения name (json-объект источник -> секунды) поверх default
+    raw = os.getenv(name)
+    if not raw:
+        return dict(default)
+    try:
+        value = json.loads(raw)
+    except json.JSONDecodeError:
+        print(f"[daemon] {name} не является json, используем значения по умолчанию")
+        return dict(default)
+    if not isinstance(value, dict):
+        return dict(default)
+    return {**default, **{k: float(v) for k, v in value.items() if k in default}}
+
+
+SOURCE_INTERVALS = _env_intervals("ETL_INTERVALS", DEFAULT_INTERVALS)
+
+
+class Scheduler:
+    # расписание опроса: у каждого источника свой интервал и своё время следующего запуска
+    # время - time.monotonic(), чтобы перевод системных часов не сбивал расписание
+
+    def __init__(self, intervals: Dict[str, float]):
+        unknown = [name for name in intervals if name not in SOURCE_FACTS]
+        if unknown:
+            raise ValueError(f"неизвестные источники: {', '.join(unknown)}")
+        if any(seconds <= 0 for seconds in intervals.values()):
+            raise ValueError("интервалы должны быть положительными")
+        self.intervals = dict(intervals)
+        # при старте все источники должны загрузиться сразу
+        self.next_due = {name: 0.0 for name in intervals}
+
+    def due(self, now: float) -> List[str]:
+        return [name for name, at in self.next_due.items() if at <= now + SCHEDULE_SLACK]
+
+    def done(self, name: str, now: float, ok: bool = True) -> None:
+        # планирует следующий запуск; неудачный источник повторяется не позже RETRY_SECONDS
+        interval = self.intervals[name]
+        self.next_due[name] = now + (interval if ok else min(interval, RETRY_SECONDS))
+
+    def wait_seconds(self, now: float) -> float:
+        return max(0.0, min(self.next_due.values()) - now)
+
+
+def run_tick(names: Iterable[str], latest: Dict[str, Any], mode: Optional[str] = None) -> List[str]:
+    # один цикл демона: качает источники names, обновляет latest (последние данные по источникам)
+    # и пишет только факты обновившихся источников под новым etl_time
+    # записи продаж считаются по свежему каталогу и последним известным курсу, погоде и крипте
+    # источник, отданный из последних удачных данных (см. run_extract), не считается обновившимся:
+    # демон и так держит его последние данные в latest, а повторять старые факты незачем
+    # возвращает список обновившихся источников
+    with span("daemon.extract"):
+        fetched, latencies = run_extract(names=names, sources=RAW_SOURCES)
+    stale = get_stale_sources()
+    refreshed = [name for name, data in fetched.items() if data is not None and name not in stale]
+    # latest["stale"]: источники, которые в latest из последних удачных данных, а не из ответа
+    # демона (так бывает, если источник не отвечает с самого запуска); возраст - на момент получения
+    latest_stale = latest.setdefault("stale", {})
+    for name in refreshed:
+        latest[name] = fetched[name]
+        latest_stale.pop(name, None)
+    for name, age in stale.items():
+        if latest.get(name) is None:
+            latest[name] = fetched[name]
+            latest_stale[name] = age
+    for name, seconds in latencies.items():
+        state = "ок" if name in refreshed else "устарело" if name in stale else "ошибка"
+        print(f"[daemon] {name}: {seconds:.3f} с, {state}")
+    if not refreshed:
+        return refreshed
+
+    raw = dict(latest)
+    raw["etl_time"] = etl_time_now()
+    if ARCHIVE_ENABLED:
+        # в архив - только то, что получено в этом цикле
+        with span("daemon.archive"):
+            archive_raw({name: latest[name] for name in refreshed}, raw["etl_time"])
+
+    facts = [SOURCE_FACTS[name] for name in refreshed]
+    batches = None
+    if "sales" in facts:
+        with span("daemon.transform"):
+            records = transform(raw)
+        if records:
+            batches = [records]
+            if EXPORT_FORMAT != "none":
+                batches = export_batches(batches, raw["etl_time"])
+        else:
+            facts.remove("sales")
+    if facts:
+        with span("daemon.load"):
+            load(mode=mode, batches=batches, raw=raw, facts=facts)
+    inc("daemon_ticks")
+    return refreshed
+
+
+def run_daemon(intervals: Optional[Dict[str, float]] = None, mode: Optional[str] = None,
+               stop: Optional[threading.Event] = None, max_ticks: Optional[int] = None) -> int:
+    # долгоживущий процесс: http-сессии, пул соединений с базой и кэш измерений
+    # живут между циклами, поэтому частый опрос крипты стоит один запрос и одну короткую транзакцию
+    # stop: событие остановки (по умолчанию - sigint/sigterm), max_ticks: выйти после стольких циклов
+    # возвращает число выполненных циклов
+    scheduler = Scheduler(intervals or SOURCE_INTERVALS)
+    stop = stop or threading.Event()
+    extract.SAVE_RAW = SAVE_RAW
+    latest: Dict[str, Any] = {}
+    ticks = 0
+    print("[daemon] интервалы: " + ", ".join(f"{name}={seconds:g} с"
+                                             for name, seconds in scheduler.intervals.items()))
+    while not stop.is_set():
+        due = scheduler.due(time.monotonic())
+        if due:
+            refreshed: List[str] = []
+            try:
+                refreshed = run_tick(due, latest, mode)
+            except Exception as e:
+                # демон не должен падать из-за одного цикла: ошибка уже откатила транзакцию
+                inc("daemon_tick_errors")
+                print(f"[daemon] цикл завершился ошибкой: {e}")
+            now = time.monotonic()
+            for name in due:
+                scheduler.done(name, now, ok=name in refreshed)
+            export_run("daemon", history=False)
+            ticks += 1
+            if max_ticks is not None and ticks >= max_ticks:
+                break
+        stop.wait(scheduler.wait_seconds(time.monotonic()))
+    return ticks
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop_event.set())
+    try:
+        run_daemon(stop=stop_event)
+    finally:
+        close_sessions()
+        close_pool()
+        export_run("daemon")
+    print("[daemon] остановлен")
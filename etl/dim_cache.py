@@ -0,0 +1,117 @@
+# dim_cache.py
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+
+# измерения звезды, у каждого свой кэш: natural key -> surrogate key
+DIMENSIONS = ("category", "product", "time", "location", "currency", "crypto_asset")
+
+# по одному bulk select на измерение для прогрева кэша, один раз за процесс
+# dim_time не прогревается: прогону нужен один свой etl_time, а таблица растёт с каждым прогоном
+WARM_SQL = {
+    "category":     "SELECT category_name, category_id FROM dim_category;",
+    "product":      "SELECT product_id, product_id FROM dim_product;",
+    "location":     "SELECT location_name, location_id FROM dim_location;",
+    "currency":     "SELECT currency_code, currency_code FROM dim_currency;",
+    "crypto_asset": "SELECT asset_id, asset_id FROM dim_crypto_asset;",
+}
+
+# сколько строк за раз тянуть серверным курсором при прогреве
+WARM_ITERSIZE = 10000
+
+
+class DimensionCache:
+    # кэш одного измерения: natural key -> surrogate key
+    # maxsize=None - без ограничения, иначе вытесняется давно не использованный ключ (lru)
+
+    def __init__(self, name: str, maxsize: Optional[int] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        # возвращает surrogate key или None, считает попадания и промахи
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        # запоминает ключ, при переполнении выкидывает самый старый
+        if key is None or value is None:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, pairs: Iterable) -> None:
+        for key, value in pairs:
+            self.put(key, value)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class DimensionCaches:
+    # набор кэшей по всем измерениям звезды
+
+    def __init__(self, maxsize: Optional[Dict[str, Optional[int]]] = None):
+        maxsize = maxsize or {}
+        self._caches = {name: DimensionCache(name, maxsize.get(name))
+                        for name in DIMENSIONS}
+        # уже прогретые измерения: повторный прогрев - полный обход таблицы, его не делаем
+        self._warmed: Set[str] = set()
+
+    def __getitem__(self, name: str) -> DimensionCache:
+        return self._caches[name]
+
+    def __iter__(self):
+        return iter(self._caches.values())
+
+    def warm(self, conn, names: Optional[Iterable[str]] = None) -> None:
+        # заполняет кэши из базы: один select на измерение, только для ещё не прогретых
+        # (после clear прогрев повторяется); измерения без WARM_SQL заполняются по ходу загрузки
+        # серверный курсор, чтобы большой dim_product не тянулся в память целиком
+        for name in (names if names is not None else WARM_SQL):
+            if name not in WARM_SQL or name in self._warmed:
+                continue
+            cache = self._caches[name]
+            cache.clear()
+            with conn.cursor(name=f"warm_{name}") as cur:
+                cur.itersize = WARM_ITERSIZE
+                cur.execute(WARM_SQL[name])
+                cache.update(cur)
+            self._warmed.add(name)
+
+    def clear(self) -> None:
+        # сбрасывает ключи (например после отката транзакции - в базе их уже нет)
+        for cache in self._caches.values():
+            cache.clear()
+        self._warmed.clear()
+
+    def reset_stats(self) -> None:
+        for cache in self._caches.values():
+            cache.reset_stats()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: cache.stats() for name, cache in self._caches.items()}
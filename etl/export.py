@@ -0,0 +1,224 @@
+# export.py
+
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# необязательная зависимость: без pyarrow выгрузка отключается с предупреждением
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from records import SalesRow
+from transform import TARGET_CURRENCIES
+from snapshots import list_snapshots, ETL_TIME_FORMAT
+from metrics import timed, inc
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
+
+# КОНСТАНТЫ
+
+# выгрузка записей transform для аналитиков: data/export/date=YYYY-MM-DD/hour=HH/records_<время>.<формат>
+# раскладка та же, что у архива снимков (snapshots.py), один файл на прогон
+EXPORT_DIR = os.getenv("ETL_EXPORT_DIR", os.path.join(DATA_DIR, "export"))
+# формат выгрузки: "parquet", "arrow" (arrow ipc) или "none" - не выгружать (ETL_EXPORT_FORMAT)
+EXPORT_FORMAT = os.getenv("ETL_EXPORT_FORMAT", "none")
+# сжатие колонок parquet
+EXPORT_COMPRESSION = os.getenv("ETL_EXPORT_COMPRESSION", "zstd")
+
+EXPORT_EXT = {"parquet": ".parquet", "arrow": ".arrow"}
+# имя "источника" в имени файла выгрузки
+EXPORT_NAME = "records"
+
+# валюты, цены в которых выгружаются колонками price_<код> (рубли уже есть в price_rub)
+FX_CURRENCIES = [code for code in TARGET_CURRENCIES if code != "RUB"]
+
+# колонки выгрузки: поля SalesRow, затем поля прогона (records.as_dict), затем цены в FX_CURRENCIES,
+# и их типы
+RECORD_SCHEMA = pa.schema([
+    ("product_id",     pa.int64()),
+    ("title",          pa.string()),
+    ("image",          pa.string()),
+    ("category",       pa.string()),
+    ("sales",          pa.int64()),
+    ("price_usd",      pa.float64()),
+    ("price_rub",      pa.float64()),
+    ("cbr_usd_rub",    pa.float64()),
+    ("temp_snapshot",  pa.float64()),
+    ("btc_price_usd",  pa.float64()),
+    ("btc_change_24h", pa.float64()),
+    ("etl_time",       pa.timestamp("ms")),
+] + [(f"price_{code.lower()}", pa.float64()) for code in FX_CURRENCIES]) if pa is not None else None
+
+
+# ФУНКЦИИ
+
+def export_path(etl_time: str, fmt: Optional[str] = None, root: Optional[str] = None) -> str:
+    # путь файла выгрузки прогона etl_time
+    fmt = fmt or EXPORT_FORMAT
+    dt = datetime.strptime(etl_time, ETL_TIME_FORMAT)
+    return os.path.join(root or EXPORT_DIR, f"date={dt:%Y-%m-%d}", f"hour={dt:%H}",
+                        f"{EXPORT_NAME}_{dt:%Y%m%dT%H%M%S}{EXPORT_EXT[fmt]}")
+
+
+def to_record_batch(records: Sequence[SalesRow]) -> "pa.RecordBatch":
+    # пачка записей transform (SalesBatch или ColumnarRecords) -> arrow record batch с типами RECORD_SCHEMA
+    # поля прогона из records.context становятся колонками-константами
+    # у ColumnarRecords числовые колонки уже в массивах numpy, записи SalesRow не собираются
+    # columnar тянет numpy, а он нужен только вместе с pyarrow
+    from columnar import ColumnarRecords, price_matrix
+
+    n = len(records)
+    if isinstance(records, ColumnarRecords):
+        columns: Dict[str, Any] = {
+            "product_id": records.product_id,
+            "title":      records.title,
+            "image":      records.image,
+            "category":   records.category,
+            "sales":      records.sales,
+            "price_usd":  records.price_usd,
+            "price_rub":  records.price_rub if records.price_rub is not None else [None] * n,
+        }
+    else:
+        # транспонируем записи в колонки одним проходом
+        columns = dict(zip(SalesRow._fields, zip(*records)))
+    context = records.context
+    etl_time = datetime.strptime(context.etl_time, ETL_TIME_FORMAT)
+    columns.update({
+        "cbr_usd_rub":    [context.cbr_rate] * n,
+        "temp_snapshot":  [context.temp_snapshot] * n,
+        "btc_price_usd":  [context.btc_price_usd] * n,
+        "btc_change_24h": [context.btc_change_24h] * n,
+        "etl_time":       [etl_time] * n,
+    })
+    # цены во всех целевых валютах разом; валюта без курса в этом прогоне - пустая колонка
+    codes, prices = price_matrix(records)
+    for code in FX_CURRENCIES:
+        columns[f"price_{code.lower()}"] = prices[:, codes.index(code)] if code in codes else [None] * n
+    return pa.record_batch([pa.array(columns[field.name], type=field.type) for field in RECORD_SCHEMA],
+                           schema=RECORD_SCHEMA)
+
+
+class RecordExporter:
+    # пишет записи одного прогона в файл выгрузки пачка за пачкой, по мере их появления:
+    # весь прогон в памяти не собирается, в parquet каждая пачка - отдельная группа строк
+    # файл пишется во временный и подменяется в close(), читатель не увидит его недописанным
+
+    def __init__(self, etl_time: str, fmt: Optional[str] = None, root: Optional[str] = None):
+        fmt = fmt or EXPORT_FORMAT
+        if fmt not in EXPORT_EXT:
+            raise ValueError(f"неизвестный формат выгрузки: {fmt}")
+        if pa is None:
+            raise RuntimeError("для выгрузки parquet/arrow нужен пакет pyarrow")
+        self.fmt = fmt
+        self.path = export_path(etl_time, fmt, root)
+        self.tmp_path = self.path + ".tmp"
+        self.rows = 0
+        self._writer = None
+
+    def write(self, records: Sequence[SalesRow]) -> None:
+        if not records:
+            return
+        batch = to_record_batch(records)
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if self.fmt == "parquet":
+                self._writer = pq.ParquetWriter(self.tmp_path, RECORD_SCHEMA, compression=EXPORT_COMPRESSION)
+            else:
+                self._writer = pa.ipc.new_file(self.tmp_path, RECORD_SCHEMA)
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self) -> Optional[str]:
+        # дописывает файл и ставит его на место, возвращает путь (None если записей не было)
+        if self._writer is None:
+            return None
+        self._writer.close()
+        self._writer = None
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self) -> None:
+        # бросает недописанный файл
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def export_batches(batches: Iterable[Sequence[SalesRow]], etl_time: str,
+                   fmt: Optional[str] = None, root: Optional[str] = None
+                   ) -> Iterator[Sequence[SalesRow]]:
+    # отдаёт пачки записей дальше (в load) и попутно дописывает их в выгрузку прогона etl_time:
+    # transform не вызывается второй раз, история продаж не сдвигается
+    # файл появляется, когда отдана последняя пачка; если пачки не дочитали - выгрузка отменяется
+    # без pyarrow пачки просто проходят насквозь
+    try:
+        exporter = RecordExporter(etl_time, fmt, root)
+    except RuntimeError as e:
+        print(f"[export] выгрузка отключена: {e}")
+        yield from batches
+        return
+    try:
+        for batch in batches:
+            exporter.write(batch)
+            yield batch
+    except BaseException:
+        exporter.abort()
+        raise
+    path = exporter.close()
+    if path is not None:
+        inc("export_rows", exporter.rows)
+        print(f"[export] записей: {exporter.rows}, файл: {path}")
+
+
+@timed("export.export_records")
+def export_records(records: Sequence[SalesRow], etl_time: str,
+                   fmt: Optional[str] = None, root: Optional[str] = None) -> Optional[str]:
+    # выгрузка уже готового списка записей одним файлом, возвращает путь
+    exporter = RecordExporter(etl_time, fmt, root)
+    try:
+        exporter.write(records)
+    except BaseException:
+        exporter.abort()
+        raise
+    return exporter.close()
+
+
+def list_exports(start: Optional[str] = None, end: Optional[str] = None,
+                 root: Optional[str] = None) -> List[Tuple[str, str]]:
+    # выгрузки как (etl_time, путь) по возрастанию etl_time, start/end - как в list_snapshots
+    return [(etl_time, path) for etl_time, _, path
+            in list_snapshots(EXPORT_NAME, start=start, end=end, root=root or EXPORT_DIR)]
+
+
+def read_export(path: str) -> "pa.Table":
+    # колоночное чтение одной выгрузки (формат - по расширению)
+    if pa is None:
+        raise RuntimeError("для чтения выгрузки нужен пакет pyarrow")
+    if path.endswith(EXPORT_EXT["arrow"]):
+        with pa.OSFile(path, "rb") as source:
+            return pa.ipc.open_file(source).read_all()
+    return pq.read_table(path)
+
+
+def read_exports(start: Optional[str] = None, end: Optional[str] = None,
+                 root: Optional[str] = None) -> Optional["pa.Table"]:
+    # все выгрузки за диапазон etl_time одной таблицей, None если выгрузок нет
+    paths = [path for _, path in list_exports(start, end, root)]
+    if not paths:
+        return None
+    # набор валютных колонок мог меняться (ETL_TARGET_CURRENCIES): недостающие заполняются null
+    tables = [read_export(path) for path in paths]
+    try:
+        return pa.concat_tables(tables, promote_options="default")
+    except TypeError:
+        # pyarrow старше 14
+        return pa.concat_tables(tables, promote=True)
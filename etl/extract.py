@@ -1,9 +1,20 @@
 import requests
+import hashlib
 import json
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from datetime import datetime
+from urllib.parse import urlsplit
 from zoneinfo import ZoneInfo
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Iterable, Tuple
+from requests.adapters import HTTPAdapter
+from snapshots import read_snapshot, write_snapshot, archive_raw, etl_time_now, ARCHIVE_ENABLED
+from metrics import timed, inc, observe, start_memory_probe, stop_memory_probe, export_run
+from resilience import breaker_allows, breaker_record, remember_good, last_good
+from transform import parse_cbr_rates
 
 # определяем путь до папки data относительно этого файла
 BASE_DIR = os.path.dirname(os.path.abspath(
@@ -27,54 +38,421 @@ WEATHER_LATITUDE = 43.1155
 WEATHER_LONGITUDE = 131.8855
 WEATHER_TIMEZONE = "Asia/Vladivostok"
 
+
+def _env_list(name: str, default: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # список из переменной окружения name в виде json-массива, иначе default
+    raw = os.getenv(name)
+    if not raw:
+        return default
+    try:
+        value = json.loads(raw)
+    except json.JSONDecodeError:
+        print(f"[extract] {name} не является json, используем значение по умолчанию")
+        return default
+    return value if isinstance(value, list) else default
+
+
+# точки погоды: первая - основная (temp_snapshot в записях), ETL_WEATHER_LOCATIONS переопределяет
+WEATHER_LOCATIONS: List[Dict[str, Any]] = _env_list("ETL_WEATHER_LOCATIONS", [
+    {"name": "Vladivostok", "latitude": WEATHER_LATITUDE,
+     "longitude": WEATHER_LONGITUDE, "timezone": WEATHER_TIMEZONE},
+])
+# криптоактивы coingecko, ETL_CRYPTO_ASSETS переопределяет
+CRYPTO_ASSETS: List[Dict[str, Any]] = _env_list("ETL_CRYPTO_ASSETS", [
+    {"id": "bitcoin", "symbol": "btc", "name": "Bitcoin"},
+])
+
+# сколько точек погоды в одном запросе к open-meteo
+WEATHER_PAGE_SIZE = 50
+# сколько монет на одной странице coingecko (максимум api - 250)
+CRYPTO_PAGE_SIZE = 250
+
 # время ожидания запроса в секундах
 REQUEST_TIMEOUT = 5
 
+# бюджет времени на извлечение всех источников одного прогона, секунды (ETL_EXTRACT_DEADLINE)
+# источник, не уложившийся в него, заменяется последними удачными данными (см. resilience.py)
+EXTRACT_DEADLINE = float(os.getenv("ETL_EXTRACT_DEADLINE", "15"))
+# если ответа нет столько секунд, параллельно шлём второй такой же запрос и берём первый ответ
+HEDGE_AFTER = float(os.getenv("ETL_HEDGE_AFTER", "1.5"))
+# сколько раз пробовать запрос (ошибка соединения, 429, 5xx), пока позволяет бюджет
+RETRY_ATTEMPTS = 3
+# пауза перед повтором: RETRY_BACKOFF * 2^номер попытки со случайным разбросом, секунды
+RETRY_BACKOFF = 0.5
+
+# сколько keep-alive соединений держим на один хост
+POOL_MAXSIZE = 10
+# сколько источников качаем одновременно
+MAX_WORKERS = 8
+
+# потоковый режим для каталога товаров: тело ответа пишется на диск кусками,
+# без разбора json в памяти (ETL_STREAM=1)
+STREAM_MODE = os.getenv("ETL_STREAM", "0") == "1"
+# размер куска при потоковой записи ответа, байт
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# сохранять ли сырые ответы в data/raw_*.json (ETL_SAVE_RAW=0 отключает)
+# в pipeline.py данные передаются в памяти, файлы - только побочный вывод
+# потоковый режим каталога пишет файл всегда: через него идёт передача в transform
+SAVE_RAW = os.getenv("ETL_SAVE_RAW", "1") != "0"
+
+# метаданные источников для условных запросов: etag, last-modified, хэш тела, флаг изменения
+SOURCE_META = os.path.join(DATA_DIR, "source_meta.json")
+_source_meta: Optional[Dict[str, Dict[str, Any]]] = None
+_source_meta_lock = threading.Lock()
+
+# общие http-сессии: одна на хост, живут весь процесс
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+# потоки для запросов с хеджированием: основной и запасной запрос идут отдельно от потока источника
+_request_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2, thread_name_prefix="request")
+# срок (time.monotonic()) бюджета источника, который качается в текущем потоке
+_budget = threading.local()
+# источники последнего run_extract, отданные из последних удачных данных: имя -> возраст, секунды
+_stale_sources: Dict[str, float] = {}
+
+
+# СЕССИИ
+
+def get_session(url: str) -> requests.Session:
+    # возвращает keep-alive сессию для хоста из url, создаёт при первом обращении
+    # повторные запросы к тому же хосту переиспользуют tcp/tls соединение из пула
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+    return session
+
+
+def close_sessions() -> None:
+    # закрывает все открытые сессии (например перед выходом из процесса)
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _observe_response(resp: requests.Response, nbytes: Optional[int] = None) -> None:
+    # метрики http: число запросов, время до заголовков ответа, байты тела
+    inc("http_requests")
+    observe("http_request_seconds", resp.elapsed.total_seconds())
+    if nbytes is not None:
+        inc("http_bytes", nbytes)
+
+
+# ЗАПРОСЫ В ПРЕДЕЛАХ БЮДЖЕТА
+
+def _deadline() -> float:
+    # срок бюджета текущего источника; вне run_extract - EXTRACT_DEADLINE от текущего момента
+    deadline = getattr(_budget, "deadline", None)
+    return deadline if deadline is not None else time.monotonic() + EXTRACT_DEADLINE
+
+
+def _close_response(fut: Future) -> None:
+    # закрывает ответ проигравшего запроса, чтобы соединение вернулось в пул
+    if not fut.cancelled() and fut.exception() is None:
+        fut.result().close()
+
+
+def _hedged_get(url: str, params: Optional[Dict[str, Any]], headers: Optional[Dict[str, str]],
+                stream: bool, deadline: float) -> requests.Response:
+    # один запрос; если за HEDGE_AFTER секунд ответа нет - запасной такой же, побеждает первый ответ
+    # хвост медленных ответов одного соединения так не растягивает весь прогон
+    def attempt() -> requests.Response:
+        timeout = max(0.1, min(REQUEST_TIMEOUT, deadline - time.monotonic()))
+        return get_session(url).get(url, params=params, headers=headers, timeout=timeout, stream=stream)
+
+    pending = {_request_pool.submit(attempt)}
+    done, pending = wait(pending, timeout=max(0.0, min(HEDGE_AFTER, deadline - time.monotonic())))
+    if not done and deadline - time.monotonic() > 0:
+        inc("http_hedged")
+        pending.add(_request_pool.submit(attempt))
+
+    error: Optional[BaseException] = None
+    resp: Optional[requests.Response] = None
+    while resp is None:
+        for fut in done:
+            if fut.exception() is not None:
+                error = fut.exception()
+            elif resp is None:
+                resp = fut.result()
+            else:
+                fut.result().close()
+        if resp is not None or not pending:
+            break
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            break
+    for fut in pending:
+        fut.add_done_callback(_close_response)
+    if resp is None:
+        raise error or requests.Timeout(f"{url}: нет ответа в пределах бюджета")
+    return resp
+
+
+def resilient_get(url: str, params: Optional[Dict[str, Any]] = None,
+                  headers: Optional[Dict[str, str]] = None, stream: bool = False) -> requests.Response:
+    # get с хеджированием и повторами (ошибка соединения, 429, 5xx) с экспоненциальной паузой,
+    # всё в пределах бюджета источника: запрос не ждёт дольше, чем осталось до срока
+    # возвращает ответ (в том числе 4xx - их разбирает вызывающий), иначе пробрасывает последнюю ошибку
+    deadline = _deadline()
+    error: Optional[BaseException] = None
+    for attempt in range(RETRY_ATTEMPTS):
+        if attempt:
+            pause = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            if time.monotonic() + pause >= deadline:
+                break
+            time.sleep(pause)
+            inc("http_retries")
+        try:
+            resp = _hedged_get(url, params, headers, stream, deadline)
+        except requests.RequestException as e:
+            error = e
+            continue
+        if resp.status_code != 429 and resp.status_code < 500:
+            return resp
+        error = requests.HTTPError(f"{resp.status_code} для {url}", response=resp)
+        resp.close()
+    raise error or requests.Timeout(f"{url}: бюджет времени исчерпан")
+
+
+# УСЛОВНЫЕ ЗАПРОСЫ
+
+def _load_source_meta() -> Dict[str, Dict[str, Any]]:
+    # читает source_meta.json один раз за процесс (вызывать под _source_meta_lock)
+    global _source_meta
+    if _source_meta is None:
+        try:
+            with open(SOURCE_META, "r", encoding="utf-8") as f:
+                _source_meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            _source_meta = {}
+    return _source_meta
+
+
+def get_source_meta(name: str) -> Dict[str, Any]:
+    # копия метаданных источника name (пустой словарь если ещё не качали)
+    with _source_meta_lock:
+        return dict(_load_source_meta().get(name, {}))
+
+
+def get_source_flags() -> Dict[str, bool]:
+    # флаги последнего извлечения: True если данные источника изменились
+    # источник без метаданных считается изменённым
+    with _source_meta_lock:
+        meta = _load_source_meta()
+        return {name: meta.get(name, {}).get("changed", True) for name in SOURCES}
+
+
+def _update_source_meta(name: str, resp: Optional[requests.Response], digest: Optional[str]) -> bool:
+    # запоминает валидаторы и хэш тела ответа, сохраняет source_meta.json
+    # digest=None означает ответ 304, resp=None при digest - данные собраны из нескольких страниц
+    # возвращает True если данные изменились
+    with _source_meta_lock:
+        meta = _load_source_meta()
+        entry = meta.setdefault(name, {})
+        if digest is None:
+            changed = False
+        else:
+            changed = digest != entry.get("sha256")
+            entry["sha256"] = digest
+            entry["etag"] = resp.headers.get("ETag") if resp is not None else None
+            entry["last_modified"] = resp.headers.get("Last-Modified") if resp is not None else None
+        entry["changed"] = changed
+        entry["checked_at"] = datetime.now().isoformat(timespec="seconds")
+        _write_source_meta(meta)
+    return changed
+
+
+def _write_source_meta(meta: Dict[str, Dict[str, Any]]) -> None:
+    # сохраняет source_meta.json через временный файл (вызывать под _source_meta_lock)
+    tmp_path = SOURCE_META + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, SOURCE_META)
+
+
+def _raw_is_current(name: str, out_path: str) -> bool:
+    # True если сырой файл на месте и записан из последнего известного тела ответа
+    # (при SAVE_RAW=False хэш в метаданных обновляется, а файл - нет)
+    if not os.path.exists(out_path):
+        return False
+    meta = get_source_meta(name)
+    return meta.get("saved_sha256") is not None and meta.get("saved_sha256") == meta.get("sha256")
+
+
+def _save_raw(name: str, out_path: str, data: Any) -> None:
+    # пишет сырой файл компактным json и отмечает, из какого тела ответа он записан
+    write_snapshot(out_path, data)
+    _mark_raw_saved(name)
+
+
+def _mark_raw_saved(name: str) -> None:
+    with _source_meta_lock:
+        meta = _load_source_meta()
+        entry = meta.setdefault(name, {})
+        entry["saved_sha256"] = entry.get("sha256")
+        _write_source_meta(meta)
+
+
+def conditional_get(name: str, url: str, out_path: str,
+                    params: Optional[Dict[str, Any]] = None,
+                    stream: bool = False) -> Optional[requests.Response]:
+    # get с If-None-Match / If-Modified-Since из прошлого ответа
+    # валидаторы шлём только если сырой файл на месте, иначе нечего переиспользовать
+    # (при SAVE_RAW=False файл не обновляется, поэтому и на него не полагаемся, кроме stream)
+    # возвращает None если сервер ответил 304 Not Modified
+    headers = {}
+    if (SAVE_RAW or stream) and _raw_is_current(name, out_path):
+        meta = get_source_meta(name)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    resp = resilient_get(url, params=params, headers=headers, stream=stream)
+    _observe_response(resp)
+    if resp.status_code == 304:
+        resp.close()
+        return None
+    resp.raise_for_status()
+    return resp
+
+
+def _read_raw(path: str) -> Any:
+    return read_snapshot(path)
+
+
+def fetch_json(name: str, url: str, out_name: str,
+               params: Optional[Dict[str, Any]] = None) -> Tuple[Any, bool]:
+    # условно загружает json источника name и сохраняет его в data/out_name
+    # файл переписывается только если тело ответа изменилось (или файла нет)
+    # возвращает (данные, изменились ли они); ошибки запроса пробрасываются
+    out_path = os.path.join(DATA_DIR, out_name)
+    resp = conditional_get(name, url, out_path, params=params)
+    if resp is None:
+        _update_source_meta(name, None, None)
+        return _read_raw(out_path), False
+
+    inc("http_bytes", len(resp.content))
+    digest = hashlib.sha256(resp.content).hexdigest()
+    data = resp.json()
+    changed = _update_source_meta(name, resp, digest)
+    if SAVE_RAW and (changed or not _raw_is_current(name, out_path)):
+        _save_raw(name, out_path, data)
+    return data, changed
+
+
+def save_paged_json(name: str, out_name: str, data: Any) -> bool:
+    # сохраняет данные, собранные из нескольких страниц api, в data/out_name
+    # у таких источников нет общего etag, поэтому изменение определяем только по хэшу
+    out_path = os.path.join(DATA_DIR, out_name)
+    body = json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    changed = _update_source_meta(name, None, hashlib.sha256(body).hexdigest())
+    if SAVE_RAW and (changed or not _raw_is_current(name, out_path)):
+        _save_raw(name, out_path, data)
+    return changed
+
+
+def _pages(items: List[Any], size: int) -> Iterable[List[Any]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 # ФУНКЦИИ
 
-def fetch_products() -> List[Dict[str, Any]]:
+@timed("extract.fetch_products")
+def fetch_products() -> Optional[List[Dict[str, Any]]]:
     # загружает список товаров с fakestoreapi и сохраняет json в папку data
-    # возвращает список товаров или пустой список если ошибка
+    # возвращает список товаров или None если ошибка
     try:
-        resp = requests.get(URL_PRODUCTS, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
+        data, _ = fetch_json("products", URL_PRODUCTS, "raw_products.json")
     except requests.RequestException as e:
         print(f"[fetch_products] Ошибка при запросе {URL_PRODUCTS}: {e}")
-        return []
+        return None
+    return data
 
-    data = resp.json()
+
+@timed("extract.fetch_products_stream")
+def fetch_products_stream() -> Optional[str]:
+    # потоковая версия fetch_products: тело ответа пишется в raw_products.json кусками
+    # как есть, не разбирая json, поэтому память не зависит от размера каталога
+    # возвращает путь к файлу или None если ошибка
     out_path = os.path.join(DATA_DIR, "raw_products.json")
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    return data
+    tmp_path = out_path + ".tmp"
+    try:
+        resp = conditional_get("products", URL_PRODUCTS, out_path, stream=True)
+        if resp is None:
+            _update_source_meta("products", None, None)
+            return out_path
+        digest = hashlib.sha256()
+        with resp, open(tmp_path, "wb") as f:
+            for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                inc("http_bytes", len(chunk))
+    except requests.RequestException as e:
+        print(f"[fetch_products_stream] Ошибка при запросе {URL_PRODUCTS}: {e}")
+        return None
+
+    # подменяем файл только когда он скачан целиком и действительно изменился
+    if (_update_source_meta("products", resp, digest.hexdigest())
+            or not _raw_is_current("products", out_path)):
+        os.replace(tmp_path, out_path)
+        _mark_raw_saved("products")
+    else:
+        os.remove(tmp_path)
+    return out_path
 
 
-def fetch_cbr_rate() -> Optional[float]:
+@timed("extract.fetch_cbr")
+def fetch_cbr() -> Optional[Dict[str, Any]]:
     # загружает json курсов валют и сохраняет в папку data
-    # возвращает курс доллара или none если что-то не так
+    # возвращает ответ целиком или None при ошибке
     try:
-        resp = requests.get(URL_CBR_DAILY, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
+        data, _ = fetch_json("cbr", URL_CBR_DAILY, "raw_cbr.json")
     except requests.RequestException as e:
-        print(f"[fetch_cbr_rate] Ошибка при запросе {URL_CBR_DAILY}: {e}")
+        print(f"[fetch_cbr] Ошибка при запросе {URL_CBR_DAILY}: {e}")
         return None
+    return data
 
-    data = resp.json()
-    out_path = os.path.join(DATA_DIR, "raw_cbr.json")
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
 
-    try:
-        return data["Valute"]["USD"]["Value"]
-    except KeyError:
-        print("[fetch_cbr_rate] Не найдено поле Valute→USD→Value в ответе")
+@timed("extract.fetch_cbr_rates")
+def fetch_cbr_rates() -> Optional[Dict[str, float]]:
+    # загружает курсы валют (см. fetch_cbr)
+    # возвращает таблицу курсов всех валют ответа (рублей за единицу) или none если что-то не так
+    data = fetch_cbr()
+    if data is None:
         return None
+    return cbr_rates_from_raw(data)
 
 
-def fetch_weather() -> Optional[float]:
-    # запрашивает погоду (температуру по часам) для Владивостока на сегодня и сохраняет в папку data
-    # возвращает температуру за последний час или None.
+def cbr_rates_from_raw(data: Any) -> Optional[Dict[str, float]]:
+    # таблица курсов из ответа цб (fetch_cbr) или None, если в нём нет доллара
+    rates = parse_cbr_rates(data)
+    if "USD" not in rates:
+        print("[fetch_cbr_rates] Не найдено поле Valute→USD→Value в ответе")
+        return None
+    return rates
+
+
+@timed("extract.fetch_weather_raw")
+def fetch_weather_raw(locations: Optional[List[Dict[str, Any]]] = None) -> Optional[Any]:
+    # запрашивает погоду (температуру по часам) на сегодня для всех точек locations
+    # (по умолчанию WEATHER_LOCATIONS) и сохраняет в папку data
+    # координаты уходят в open-meteo через запятую: один запрос на страницу из WEATHER_PAGE_SIZE точек
+    # каждая точка дополнена полем location_name; при одной точке это объект, как раньше
+    # возвращает то, что записано в raw_weather.json, или None при ошибке
+    locations = locations if locations is not None else WEATHER_LOCATIONS
+    if not locations:
+        return None
     try:
         now_vl = datetime.now(ZoneInfo(WEATHER_TIMEZONE))
     except Exception:
@@ -84,29 +462,50 @@ def fetch_weather() -> Optional[float]:
         now_vl = now_utc + offset
 
     date_str = now_vl.date().isoformat()
-    params = {
-        "latitude": WEATHER_LATITUDE,
-        "longitude": WEATHER_LONGITUDE,
-        "hourly": "temperature_2m",
-        "start_date": date_str,
-        "end_date": date_str,
-        "timezone": WEATHER_TIMEZONE
-    }
-
+    data: List[Dict[str, Any]] = []
     try:
-        resp = requests.get(URL_WEATHER, params=params,
-                            timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
+        for page in _pages(locations, WEATHER_PAGE_SIZE):
+            params = {
+                "latitude": ",".join(str(loc["latitude"]) for loc in page),
+                "longitude": ",".join(str(loc["longitude"]) for loc in page),
+                "hourly": "temperature_2m",
+                "start_date": date_str,
+                "end_date": date_str,
+                "timezone": ",".join(loc.get("timezone", "auto") for loc in page)
+            }
+            resp = resilient_get(URL_WEATHER, params=params)
+            _observe_response(resp, len(resp.content))
+            resp.raise_for_status()
+            # на одну точку open-meteo отвечает объектом, на несколько - списком
+            body = resp.json()
+            items = body if isinstance(body, list) else [body]
+            for loc, item in zip(page, items):
+                item["location_name"] = loc["name"]
+                data.append(item)
     except requests.RequestException as e:
-        print(f"[fetch_weather] Ошибка при запросе {URL_WEATHER}: {e}")
+        print(f"[fetch_weather_raw] Ошибка при запросе {URL_WEATHER}: {e}")
         return None
 
-    data = resp.json()
-    out_path = os.path.join(DATA_DIR, "raw_weather.json")
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    raw = data[0] if len(data) == 1 else data
+    save_paged_json("weather", "raw_weather.json", raw)
+    return raw
 
-    hourly = data.get("hourly", {})
+
+@timed("extract.fetch_weather")
+def fetch_weather(locations: Optional[List[Dict[str, Any]]] = None) -> Optional[float]:
+    # загружает погоду для всех точек (см. fetch_weather_raw)
+    # возвращает температуру за последний час для первой точки или None.
+    raw = fetch_weather_raw(locations)
+    if raw is None:
+        return None
+    return weather_from_raw(raw)
+
+
+def weather_from_raw(raw: Any) -> Optional[float]:
+    # температура за последний час первой точки из ответа fetch_weather_raw или None
+    data = raw if isinstance(raw, list) else [raw]
+
+    hourly = data[0].get("hourly", {}) if data else {}
     temps = hourly.get("temperature_2m", [])
     if not temps:
         print("[fetch_weather] Нет данных о температуре в ответе.")
@@ -115,50 +514,237 @@ def fetch_weather() -> Optional[float]:
     return temps[-1]
 
 
-def fetch_btc() -> Optional[Dict[str, float]]:
-    # загружает данные о биткоине (цена и изменение за 24h) и сохраняет в папку data
-    # возвращает словарь или none при ошибке
-    params = {
-        "vs_currency": "usd",
-        "ids": "bitcoin",
-        "sparkline": False,
-        "price_change_percentage": "24h"
-    }
-
+@timed("extract.fetch_crypto")
+def fetch_crypto(assets: Optional[List[Dict[str, Any]]] = None) -> Optional[List[Dict[str, Any]]]:
+    # загружает котировки всех монет assets (по умолчанию CRYPTO_ASSETS) и сохраняет в папку data
+    # id монет уходят в coingecko через запятую: один запрос на страницу из CRYPTO_PAGE_SIZE монет
+    # возвращает список котировок или None при ошибке
+    assets = assets if assets is not None else CRYPTO_ASSETS
+    data: List[Dict[str, Any]] = []
     try:
-        resp = requests.get(URL_CRYPTO, params=params, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
+        for page in _pages([a["id"] for a in assets], CRYPTO_PAGE_SIZE):
+            params = {
+                "vs_currency": "usd",
+                "ids": ",".join(page),
+                "per_page": len(page),
+                "page": 1,
+                "sparkline": False,
+                "price_change_percentage": "24h"
+            }
+            resp = resilient_get(URL_CRYPTO, params=params)
+            _observe_response(resp, len(resp.content))
+            resp.raise_for_status()
+            data.extend(resp.json())
     except requests.RequestException as e:
-        print(f"[fetch_btc] Ошибка при запросе {URL_CRYPTO}: {e}")
+        print(f"[fetch_crypto] Ошибка при запросе {URL_CRYPTO}: {e}")
         return None
 
-    data = resp.json()
-    out_path = os.path.join(DATA_DIR, "raw_crypto.json")
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    save_paged_json("btc", "raw_crypto.json", data)
+    return data
+
+
+@timed("extract.fetch_btc")
+def fetch_btc() -> Optional[Dict[str, float]]:
+    # загружает котировки криптоактивов (см. fetch_crypto) и сохраняет в папку data
+    # возвращает цену и изменение за 24h для биткоина или none при ошибке
+    data = fetch_crypto()
+    if data is None:
+        return None
+    return btc_from_raw(data)
 
+
+def btc_from_raw(data: Any) -> Optional[Dict[str, float]]:
+    # цена и изменение за 24h биткоина (или первой монеты) из ответа fetch_crypto или None
     if not data:
         print("[fetch_btc] Ответ пустой.")
         return None
 
-    coin = data[0]
+    coin = next((c for c in data if c.get("id") == "bitcoin"), data[0])
     return {
         "price": coin.get("current_price", 0.0),
         "change_24h": coin.get("price_change_percentage_24h", 0.0)
     }
 
 
-# ГЛАВНЫЙ БЛОК
+# ПАРАЛЛЕЛЬНЫЙ ЗАПУСК
+
+# все источники: имя -> функция загрузки
+SOURCES: Dict[str, Callable[[], Any]] = {
+    "products": fetch_products_stream if STREAM_MODE else fetch_products,
+    "cbr":      fetch_cbr_rates,
+    "weather":  fetch_weather,
+    "btc":      fetch_btc,
+}
+
+
+# те же источники, но результат - сырой ответ целиком (то, что пишется в raw_*.json)
+# это вход transform(raw=...) в pipeline.py
+RAW_SOURCES: Dict[str, Callable[[], Any]] = {
+    "products": fetch_products_stream if STREAM_MODE else fetch_products,
+    "cbr":      fetch_cbr,
+    "weather":  fetch_weather_raw,
+    "crypto":   fetch_crypto,
+}
+
+# у источника один ключ для предохранителя и последних удачных данных - его имя в RAW_SOURCES,
+# какой бы из словарей ни опрашивался: неудачи одного api считаются вместе
+SOURCE_KEYS: Dict[str, str] = {"btc": "crypto"}
+
+# функции SOURCES, которые сводят сырой ответ: (функция RAW_SOURCES, сводка из сырого ответа)
+# последними удачными данными всегда запоминается сырой ответ, сводка строится из него
+SUMMARIES: Dict[Callable[[], Any], Tuple[Callable[[], Any], Callable[[Any], Any]]] = {
+    fetch_cbr_rates: (fetch_cbr, cbr_rates_from_raw),
+    fetch_weather:   (fetch_weather_raw, weather_from_raw),
+    fetch_btc:       (fetch_crypto, btc_from_raw),
+}
+
+
+def source_key(name: str) -> str:
+    return SOURCE_KEYS.get(name, name)
 
-if __name__ == "__main__":
-    prods = fetch_products()
-    print("Продуктов:", len(prods) if prods is not None else "Ошибка")
 
-    rate = fetch_cbr_rate()
-    print("Курс USD:", rate if rate is not None else "Ошибка")
+def _timed_fetch(name: str, fetch: Callable[[], Any]) -> Tuple[Any, float]:
+    # вызывает fetch и замеряет время, ошибки не пробрасываем чтобы не ронять остальные источники
+    started = time.perf_counter()
+    try:
+        result = fetch()
+    except Exception as e:
+        print(f"[run_extract] источник {name} упал: {e}")
+        result = None
+    return result, time.perf_counter() - started
+
+
+def _failed(result: Any) -> bool:
+    # функции загрузки сообщают об ошибке через None; пустой каталог товаров - тоже неудача
+    return result is None or (isinstance(result, list) and not result)
+
+
+def _guarded_fetch(name: str, fetch: Callable[[], Any], deadline: float) -> Tuple[Any, float]:
+    # _timed_fetch за предохранителем источника и в пределах бюджета deadline
+    # удачный сырой ответ запоминается как последний удачный (ключ - source_key),
+    # а для предохранителя опоздавший ответ - такая же неудача, как ошибка
+    key = source_key(name)
+    if not breaker_allows(key):
+        print(f"[run_extract] источник {name}: предохранитель разомкнут, не опрашиваем")
+        inc("extract_breaker_skips")
+        return None, 0.0
+    raw_fetch, from_raw = SUMMARIES.get(fetch, (fetch, None))
+    _budget.deadline = deadline
+    try:
+        raw, seconds = _timed_fetch(name, raw_fetch)
+    finally:
+        _budget.deadline = None
+    result = raw if from_raw is None or _failed(raw) else from_raw(raw)
+    ok = not _failed(result)
+    breaker_record(key, ok and time.monotonic() <= deadline)
+    if ok:
+        remember_good(key, raw)
+    return result, seconds
+
+
+def get_stale_sources() -> Dict[str, float]:
+    # источники последнего run_extract, вместо которых отданы последние удачные данные,
+    # и возраст этих данных в секундах
+    return dict(_stale_sources)
+
+
+def run_extract(names: Optional[Iterable[str]] = None,
+                max_workers: int = MAX_WORKERS,
+                sources: Optional[Dict[str, Callable[[], Any]]] = None,
+                deadline: Optional[float] = None
+                ) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    # запускает все (или только names) источники sources (по умолчанию SOURCES)
+    # одновременно в пуле потоков
+    # общее время ~ время самого медленного источника, но не больше deadline секунд
+    # (по умолчанию EXTRACT_DEADLINE): кто не уложился, упал или отключён предохранителем,
+    # получает последние удачные данные, если они есть (список таких - get_stale_sources())
+    # возвращает (результаты по имени источника, задержки в секундах по имени источника)
+    sources = sources if sources is not None else SOURCES
+    selected = list(names) if names is not None else list(sources)
+    unknown = [n for n in selected if n not in sources]
+    if unknown:
+        raise ValueError(f"неизвестные источники: {', '.join(unknown)}")
+
+    results: Dict[str, Any] = {}
+    latencies: Dict[str, float] = {}
+    _stale_sources.clear()
+    if not selected:
+        return results, latencies
+
+    budget = EXTRACT_DEADLINE if deadline is None else deadline
+    started = time.monotonic()
+    until = started + budget
+    workers = max(1, min(max_workers, len(selected)))
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract")
+    try:
+        futures = {name: pool.submit(_guarded_fetch, name, sources[name], until)
+                   for name in selected}
+        wait(futures.values(), timeout=budget)
+        for name, fut in futures.items():
+            if fut.done():
+                results[name], latencies[name] = fut.result()
+            else:
+                # поток дорабатывает в фоне, его результат запомнится для следующих прогонов
+                print(f"[run_extract] источник {name} не уложился в {budget:g} с")
+                inc("extract_deadline_misses")
+                results[name], latencies[name] = None, time.monotonic() - started
+    finally:
+        pool.shutdown(wait=False)
+
+    for name in selected:
+        if not _failed(results[name]):
+            continue
+        fallback = last_good(source_key(name))
+        from_raw = SUMMARIES.get(sources[name], (None, None))[1]
+        if fallback is not None and from_raw is not None:
+            fallback = (from_raw(fallback[0]), fallback[1])
+        if fallback is None or _failed(fallback[0]):
+            # неудача всегда None: пустой каталог не должен уйти дальше как настоящий
+            results[name] = None
+            continue
+        results[name], age = fallback
+        _stale_sources[name] = age
+        inc("extract_stale_sources")
+        print(f"[run_extract] источник {name}: последние удачные данные, возраст {age:.0f} с")
+    return results, latencies
+
 
-    temp = fetch_weather()
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    start_memory_probe()
+    started = time.perf_counter()
+    results, latencies = run_extract()
+    wall = time.perf_counter() - started
+
+    prods = results["products"]
+    if STREAM_MODE:
+        print("Каталог товаров:", prods if prods is not None else "Ошибка")
+    else:
+        print("Продуктов:", len(prods) if prods is not None else "Ошибка")
+
+    rates = results["cbr"]
+    print("Курс USD:", rates["USD"] if rates is not None else "Ошибка",
+          f"(валют в ответе: {len(rates) - 1})" if rates is not None else "")
+
+    temp = results["weather"]
     print("Температура (посл. час):", temp if temp is not None else "Нет данных")
 
-    btc = fetch_btc()
+    btc = results["btc"]
     print("Bitcoin:", btc if btc is not None else "Ошибка")
+
+    flags = get_source_flags()
+    for name, seconds in latencies.items():
+        state = "изменился" if flags.get(name, True) else "без изменений"
+        print(f"  {name}: {seconds:.3f} с, {state}")
+    print(f"Общее время извлечения: {wall:.3f} с")
+    close_sessions()
+
+    # копия сырых файлов прогона в архив снимков (см. snapshots.py)
+    if ARCHIVE_ENABLED and SAVE_RAW:
+        raw_files = {name: os.path.join(DATA_DIR, f"raw_{name}.json")
+                     for name in ("products", "cbr", "weather", "crypto")}
+        archive_raw({name: path for name, path in raw_files.items() if os.path.exists(path)},
+                    etl_time_now())
+    stop_memory_probe()
+    export_run("extract")
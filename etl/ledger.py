@@ -0,0 +1,356 @@
+# ledger.py
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set
+
+from records import RunContext, SalesRow, SalesBatch
+from simulation import SalesSimulator, get_simulator
+from snapshots import read_snapshot, write_encoded, dumps_json, ETL_TIME_FORMAT
+from state import open_sales_store
+from metrics import span, timed, inc
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
+
+# КОНСТАНТЫ
+
+# журнал прогонов pipeline.py: data/ledger/runs/<run_id>.json - какие этапы прогона завершены,
+# data/ledger/objects/ab/<sha256>.<ext> - их результаты по хешу содержимого (одинаковое хранится один раз)
+LEDGER_DIR = os.getenv("ETL_LEDGER_DIR", os.path.join(DATA_DIR, "ledger"))
+# вести ли журнал (ETL_LEDGER=0 отключает, тогда упавший прогон повторяется целиком)
+LEDGER_ENABLED = os.getenv("ETL_LEDGER", "1") != "0"
+# сколько последних прогонов хранить в журнале (ETL_LEDGER_KEEP), незавершённые не удаляются
+LEDGER_KEEP = int(os.getenv("ETL_LEDGER_KEEP", "24"))
+
+# этапы прогона по порядку: extract - сырые данные источников, transform - пачки записей и
+# изменения истории продаж, history - изменения применены к хранилищу состояния, load - загрузка в базу
+STAGES = ("extract", "transform", "history", "load")
+
+# расширение объектов журнала (сжатый json, см. snapshots.py)
+OBJECT_EXT = ".json.gz"
+
+
+# ИСТОРИЯ ПРОДАЖ
+
+class HistoryDelta:
+    # хранилище истории продаж для transform(store=...): читает из настоящего,
+    # а новые значения копит в delta, не записывая; commit и close ничего не делают
+    # delta - итоговые продажи товаров, а не приросты: применить её дважды - то же, что один раз
+
+    def __init__(self, store):
+        self.store = store
+        self.delta: Dict[str, int] = {}
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, int]:
+        keys = list(keys)
+        values = self.store.get_many([k for k in keys if k not in self.delta])
+        values.update({k: self.delta[k] for k in keys if k in self.delta})
+        return values
+
+    def put_many(self, values: Dict[str, int]) -> None:
+        self.delta.update(values)
+
+    def commit(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+# ЖУРНАЛ
+
+def run_id_of(etl_time: str) -> str:
+    return datetime.strptime(etl_time, ETL_TIME_FORMAT).strftime("%Y%m%dT%H%M%S")
+
+
+class RunLedger:
+    # журнал одного прогона: завершённые этапы и хеши их результатов
+    # запись о прогоне появляется, когда завершён extract: раньше продолжать нечего
+
+    def __init__(self, record: Dict[str, Any], root: Optional[str] = None):
+        self.root = root or LEDGER_DIR
+        self.record = record
+
+    @property
+    def run_id(self) -> str:
+        return self.record["run_id"]
+
+    @property
+    def etl_time(self) -> str:
+        return self.record["etl_time"]
+
+    @classmethod
+    def create(cls, etl_time: str, root: Optional[str] = None) -> "RunLedger":
+        record = {"run_id": run_id_of(etl_time), "etl_time": etl_time, "status": "running",
+                  "started_at": time.time(), "stages": {}}
+        return cls(record, root)
+
+    @classmethod
+    def open(cls, run_id: str, root: Optional[str] = None) -> Optional["RunLedger"]:
+        path = _run_path(run_id, root)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), root)
+
+    # этапы
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.record["stages"]
+
+    def next_stage(self) -> Optional[str]:
+        # первый незавершённый этап или None, если прогон завершён
+        return next((stage for stage in STAGES if not self.is_done(stage)), None)
+
+    def complete(self, stage: str, **info: Any) -> None:
+        # отмечает этап завершённым; info - хеши результатов и сведения, нужные следующим этапам
+        self.record["stages"][stage] = dict(info, done_at=time.time())
+        self.record["status"] = "done" if self.next_stage() is None else "running"
+        self.record.pop("error", None)
+        self._save()
+
+    def fail(self, stage: str, error: str) -> None:
+        self.record["status"] = "failed"
+        self.record["error"] = f"{stage}: {error}"
+        self._save()
+
+    def abandon(self, reason: str) -> None:
+        # прогон больше не продолжить: его можно удалить из журнала (prune)
+        self.record["status"] = "abandoned"
+        self.record["error"] = reason
+        self._save()
+
+    def _save(self) -> None:
+        # запись о прогоне переписывается через временный файл: на диске всегда целая версия
+        path = _run_path(self.run_id, self.root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.record, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    # объекты
+
+    def object_path(self, digest: str, ext: str = OBJECT_EXT) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest + ext)
+
+    def put_object(self, data: Any) -> str:
+        # сохраняет data по хешу содержимого, возвращает хеш; уже сохранённое не переписывается
+        body = dumps_json(data)
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_encoded(path, body)
+            inc("ledger_objects_written")
+        return digest
+
+    def put_file(self, src: str) -> str:
+        # то же для файла (потоковый каталог товаров): жёсткая ссылка под хешем, расширение сохраняется
+        # extract подменяет файл через os.replace, поэтому содержимое по ссылке потом не меняется;
+        # копия - только если ссылку сделать нельзя (другая файловая система)
+        sha = hashlib.sha256()
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        path = self.object_path(digest, _file_ext(src))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(src, path)
+            except OSError:
+                shutil.copyfile(src, path + ".tmp")
+                os.replace(path + ".tmp", path)
+            inc("ledger_objects_written")
+        return digest + _file_ext(src)
+
+    def get_object(self, digest: str) -> Any:
+        return read_snapshot(self.object_path(digest))
+
+    # результаты этапов
+
+    @timed("ledger.save_extract")
+    def save_extract(self, raw: Dict[str, Any], seed: Any = None) -> None:
+        # сырые данные источников (None - источник не загрузился)
+        # путь к файлу (потоковый каталог) сохраняется копией файла, в журнале - с расширением
+        # seed - зерно генератора продаж прогона: с ним продолжение посчитает те же продажи
+        sources = {}
+        for name, data in raw.items():
+            if name in ("etl_time", "stale"):
+                continue
+            if data is None:
+                sources[name] = None
+            elif isinstance(data, str):
+                sources[name] = {"file": self.put_file(data)}
+            else:
+                sources[name] = self.put_object(data)
+        self.complete("extract", sources=sources, stale=raw.get("stale") or {}, seed=seed)
+
+    def load_extract(self) -> Dict[str, Any]:
+        # raw прогона из журнала: как его отдал extract, с etl_time и stale
+        info = self.record["stages"]["extract"]
+        raw: Dict[str, Any] = {}
+        for name, ref in info["sources"].items():
+            if ref is None:
+                raw[name] = None
+            elif isinstance(ref, dict):
+                digest, _, ext = ref["file"].partition(".")
+                raw[name] = self.object_path(digest, "." + ext)
+            else:
+                raw[name] = self.get_object(ref)
+        raw["etl_time"] = self.etl_time
+        raw["stale"] = info["stale"]
+        return raw
+
+    def simulator(self) -> SalesSimulator:
+        # генератор продаж с зерном из этапа extract; у журналов без зерна - генератор процесса
+        seed = self.record["stages"]["extract"].get("seed")
+        return SalesSimulator(seed) if seed is not None else get_simulator()
+
+    def save_transform(self, batches: Iterable[Sequence[SalesRow]],
+                       delta: HistoryDelta) -> Iterator[Sequence[SalesRow]]:
+        # пачки записей пишутся по мере их появления, каждая - отдельным объектом, и сразу
+        # отдаются дальше (в load) из памяти; изменения истории - после последней
+        # этап завершается, только когда пачки пройдены до конца
+        hashes: List[str] = []
+        rows = 0
+        for batch in batches:
+            if not batch:
+                continue
+            with span("ledger.save_batch"):
+                hashes.append(self.put_object({"context": list(batch.context),
+                                               "rows": [list(row) for row in batch]}))
+            rows += len(batch)
+            yield batch
+        self.complete("transform", batches=hashes, history=self.put_object(delta.delta), rows=rows)
+
+    def iter_batches(self) -> Iterator[SalesBatch]:
+        # пачки записей из журнала по одной, в том порядке, в каком их отдал transform
+        for digest in self.record["stages"]["transform"]["batches"]:
+            data = self.get_object(digest)
+            yield SalesBatch(_context_from_json(data["context"]), map(SalesRow._make, data["rows"]))
+
+    @timed("ledger.apply_history")
+    def apply_history(self) -> int:
+        # пишет изменения истории продаж в хранилище состояния одной транзакцией
+        # повтор после сбоя безопасен: в delta итоговые значения, а не приросты
+        delta = self.get_object(self.record["stages"]["transform"]["history"])
+        store = open_sales_store()
+        try:
+            store.put_many(delta)
+            store.commit()
+        finally:
+            store.close()
+        self.complete("history", products=len(delta))
+        return len(delta)
+
+
+def _run_path(run_id: str, root: Optional[str] = None) -> str:
+    return os.path.join(root or LEDGER_DIR, "runs", f"{run_id}.json")
+
+
+def _file_ext(path: str) -> str:
+    # расширение вместе со сжатием: .json, .json.gz ...
+    name = os.path.basename(path)
+    return name[name.index("."):] if "." in name else ".json"
+
+
+def _context_from_json(values: List[Any]) -> RunContext:
+    # в json кортежи стали списками, fx возвращаем к виду ((код, множитель), ...)
+    context = RunContext(*values)
+    return context._replace(fx=tuple(tuple(pair) for pair in context.fx))
+
+
+# СПИСОК ПРОГОНОВ
+
+def list_runs(root: Optional[str] = None) -> List[RunLedger]:
+    # все прогоны журнала по возрастанию run_id
+    runs_dir = os.path.join(root or LEDGER_DIR, "runs")
+    if not os.path.isdir(runs_dir):
+        return []
+    runs = []
+    for name in sorted(os.listdir(runs_dir)):
+        if name.endswith(".json"):
+            ledger = RunLedger.open(name[:-len(".json")], root)
+            if ledger is not None:
+                runs.append(ledger)
+    return runs
+
+
+def find_resumable(run_id: Optional[str] = None, root: Optional[str] = None) -> Optional[RunLedger]:
+    # прогон для продолжения: заданный run_id или последний, если он не завершён
+    # прогон, чья история продаж ещё не применена, продолжать нельзя, если после него
+    # историю уже сдвинул более поздний прогон: его итоговые значения затёрли бы новые
+    runs = list_runs(root)
+    if run_id in (None, "last"):
+        ledger = runs[-1] if runs else None
+        if ledger is None or ledger.next_stage() is None:
+            print("[ledger] незавершённых прогонов нет")
+            return None
+    else:
+        ledger = next((r for r in runs if r.run_id == run_id), None)
+        if ledger is None:
+            print(f"[ledger] прогона {run_id} нет в журнале")
+            return None
+        if ledger.next_stage() is None:
+            print(f"[ledger] прогон {run_id} уже завершён")
+            return None
+    if not ledger.is_done("history"):
+        later = [r.run_id for r in runs if r.run_id > ledger.run_id and r.is_done("history")]
+        if later:
+            reason = f"история продаж уже сдвинута прогоном {later[-1]}"
+            print(f"[ledger] {reason}, прогон {ledger.run_id} продолжать нельзя")
+            ledger.abandon(reason)
+            return None
+    return ledger
+
+
+def prune(keep: int = LEDGER_KEEP, root: Optional[str] = None) -> int:
+    # оставляет keep последних прогонов (незавершённые, кроме брошенных, - всегда) и удаляет объекты,
+    # на которые больше никто не ссылается; возвращает число удалённых объектов
+    root = root or LEDGER_DIR
+    runs = list_runs(root)
+    for ledger in runs[:max(len(runs) - keep, 0)]:
+        if ledger.next_stage() is None or ledger.record["status"] == "abandoned":
+            os.remove(_run_path(ledger.run_id, root))
+    referenced: Set[str] = set()
+    for ledger in list_runs(root):
+        stages = ledger.record["stages"]
+        for ref in stages.get("extract", {}).get("sources", {}).values():
+            if ref is not None:
+                referenced.add(ref["file"] if isinstance(ref, dict) else ref + OBJECT_EXT)
+        transform = stages.get("transform", {})
+        referenced.update(digest + OBJECT_EXT for digest in transform.get("batches", []))
+        if "history" in transform:
+            referenced.add(transform["history"] + OBJECT_EXT)
+    removed = 0
+    objects_dir = os.path.join(root, "objects")
+    for dirpath, _, files in os.walk(objects_dir):
+        for name in files:
+            if name not in referenced:
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+    return removed
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    # python ledger.py - прогоны журнала и их этапы; python ledger.py prune - чистка
+    if sys.argv[1:] == ["prune"]:
+        print(f"[ledger] удалено объектов: {prune()}")
+        sys.exit(0)
+    for ledger in list_runs():
+        stage = ledger.next_stage()
+        print(f"{ledger.run_id}  {ledger.etl_time}  {ledger.record['status']:8}  "
+              f"следующий этап: {stage or '-'}"
+              + (f"  ({ledger.record['error']})" if ledger.record.get("error") else ""))
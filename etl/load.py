@@ -1,11 +1,32 @@
 # load.py
 
+import csv
+import hashlib
+import io
+import itertools
 import os
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future
 from dotenv import load_dotenv
 import psycopg2
-from transform import transform
+from psycopg2.extensions import cursor as _pg_cursor
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from transform import (transform, transform_batches, load_json, parse_weather_snapshots,
+                       parse_crypto_quotes, parse_cbr_currencies, STREAM_MODE, BATCH_SIZE,
+                       RAW_WEATHER, RAW_CRYPTO, RAW_CBR)
+from records import RunContext, SalesRow
+from dim_cache import DimensionCache, DimensionCaches
+from extract import WEATHER_LOCATIONS, CRYPTO_ASSETS
+from state import open_sales_store
+from schema import ensure_schema, ensure_partitions
+from rollups import RollupDelta, apply_rollups
+from queries import notify_loaded, invalidate as invalidate_queries
+from metrics import timed, inc, observe, start_memory_probe, stop_memory_probe, export_run
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Iterable, Iterator, Dict, Any, List, Sequence, Set
 
 # вычисляем корень проекта, чтобы .env точно находился
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -40,65 +61,201 @@ def get_db_params() -> dict:
 
 DB_PARAMS = get_db_params()
 
-LOCATION_NAME = "Vladivostok"
-LATITUDE = 43.1155
-LONGITUDE = 131.8855
+# точки погоды и криптоактивы берутся из настроек extract (WEATHER_LOCATIONS, CRYPTO_ASSETS)
 
-CURRENCY_CODE = "USD"
-CURRENCY_DESC = "US Dollar"
+# кэш ключей измерений: ETL_DIM_CACHE=0 выключает,
+# ETL_DIM_CACHE_PRODUCT_MAX ограничивает число товаров в кэше (lru)
+# кэш живёт весь процесс, поэтому etl_time последних прогонов держим в ограниченном lru (DIM_CACHE_TIME_MAX)
+DIM_CACHE_ENABLED = os.getenv("ETL_DIM_CACHE", "1") != "0"
+DIM_CACHE_PRODUCT_MAX = int(os.getenv("ETL_DIM_CACHE_PRODUCT_MAX", "0")) or None
+DIM_CACHE_TIME_MAX = 1024
+DIM_CACHE = DimensionCaches(maxsize={"product": DIM_CACHE_PRODUCT_MAX, "time": DIM_CACHE_TIME_MAX})
 
-ASSET_ID = "bitcoin"
-ASSET_SYMBOL = "btc"
-ASSET_NAME = "Bitcoin"
+# режим загрузки фактов продаж: "row" - построчно, "bulk" - staging-таблица + copy,
+# "parallel" - факты делятся на партиции по product_id, каждую грузит своё соединение
+LOAD_MODE = os.getenv("ETL_LOAD_MODE", "row")
+LOAD_MODES = ("row", "bulk", "parallel")
+
+# сколько партиций (и соединений) в режиме parallel
+LOAD_WORKERS = int(os.getenv("ETL_LOAD_WORKERS", "4"))
+# фиксация партиций: "coordinated" - все или ничего (двухфазная фиксация, если сервер
+# разрешает prepared transactions), "independent" - каждая партиция фиксируется сама
+COMMIT_STRATEGY = os.getenv("ETL_COMMIT_STRATEGY", "coordinated")
+
+# пул соединений процесса, создаётся при первой загрузке (см. get_pool)
+_pool: Optional[ThreadedConnectionPool] = None
+
+# колонки staging-таблицы в том порядке, в котором их пишет copy
+STAGE_SALES_COLUMNS = ("product_id", "title", "image", "category_name",
+                       "sales", "price_usd", "price_rub")
+# чем copy помечает NULL в csv: пустое поле остаётся пустой строкой
+NULL_MARKER = "\\N"
+
+# группы фактов, которые load() умеет писать по отдельности, и измерения, на которые они ссылаются
+FACT_DIMENSIONS = {
+    "sales":    ("category", "product"),
+    "weather":  ("location",),
+    "currency": ("currency",),
+    "crypto":   ("crypto_asset",),
+}
+FACT_GROUPS = tuple(FACT_DIMENSIONS)
+# какие факты пишутся по свежим данным источника (daemon.py, backfill.py)
+SOURCE_FACTS = {
+    "products": "sales",
+    "cbr":      "currency",
+    "weather":  "weather",
+    "crypto":   "crypto",
+}
+
+# из данных каких источников считаются факты группы: если хоть один отдан из последних удачных
+# данных (raw["stale"], см. extract.run_extract), факты группы пишутся с is_stale
+FACT_SOURCES = {
+    "sales":    ("products", "cbr"),
+    "weather":  ("weather",),
+    "currency": ("cbr",),
+    "crypto":   ("crypto",),
+}
+
+# прирост роллапа продаж по категориям от только что вставленных фактов
+# ставится после CTE "ins" (insert into fact_sales ... returning product_id, sales, price_usd)
+SALES_ROLLUP_SELECT = """
+    SELECT p.category_id, COUNT(*), COALESCE(SUM(ins.sales), 0),
+           COALESCE(SUM(ins.sales * ins.price_usd), 0)
+    FROM ins
+    JOIN dim_product p ON p.product_id = ins.product_id
+    GROUP BY p.category_id
+"""
 
 
 # ФУНКЦИИ
 
-def upsert_dimension(conn, select_sql: str, insert_sql: str, sel_params: tuple, ins_params: tuple) -> Optional[int]:
-    # универсальная функция: если select_sql возвращает row - берёт row[0]
+class InstrumentedCursor(_pg_cursor):
+    # курсор, который считает запросы к базе и время каждого обращения (db_queries, db_query_seconds)
+    # execute_values вызывает execute на каждую страницу, поэтому тоже учитывается
+
+    def _observe(self, started: float) -> None:
+        inc("db_queries")
+        observe("db_query_seconds", time.perf_counter() - started)
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._observe(started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._observe(started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._observe(started)
+
+
+def get_pool() -> ThreadedConnectionPool:
+    # общий пул соединений: основное, соединение для измерений и по одному на партицию
+    global _pool
+    if _pool is None or _pool.closed:
+        _pool = ThreadedConnectionPool(1, LOAD_WORKERS + 2, cursor_factory=InstrumentedCursor,
+                                       **DB_PARAMS)
+    return _pool
+
+
+def close_pool() -> None:
+    # закрывает все соединения пула (например перед выходом из процесса)
+    global _pool
+    if _pool is not None and not _pool.closed:
+        _pool.closeall()
+    _pool = None
+
+
+def _dim_cache(name: str) -> Optional[DimensionCache]:
+    # кэш измерения name или None если кэширование выключено
+    return DIM_CACHE[name] if DIM_CACHE_ENABLED else None
+
+
+def upsert_dimension(conn, select_sql: str, insert_sql: str, sel_params: tuple, ins_params: tuple,
+                     cache: Optional[DimensionCache] = None, key: Any = None) -> Optional[Any]:
+    # универсальная функция: сначала смотрим в cache по natural key,
+    # затем если select_sql возвращает row - берёт row[0]
     # иначе выполняет insert_sql и возвращает сгенерированный id (row[0])
+    # если insert_sql без RETURNING, surrogate key совпадает с natural key и возвращается key
+    # insert_sql с ON CONFLICT DO NOTHING RETURNING может ничего не вернуть, если строку
+    # успела вставить параллельная загрузка - тогда перечитываем её select_sql
+    if cache is not None and key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
     with conn.cursor() as cur:
         cur.execute(select_sql, sel_params)
         row = cur.fetchone()
         if row:
-            return row[0]
-        cur.execute(insert_sql, ins_params)
-        return cur.fetchone()[0]
+            result = row[0]
+        else:
+            cur.execute(insert_sql, ins_params)
+            row = cur.fetchone() if cur.description else None
+            if row is None and cur.description:
+                cur.execute(select_sql, sel_params)
+                row = cur.fetchone()
+            result = row[0] if row else key
 
+    if cache is not None:
+        cache.put(key, result)
+    return result
 
-def insert_fact_if_not_exists(conn, select_sql: str, insert_sql: str, sel_params: tuple, ins_params: tuple) -> None:
-    # если select_sql не находит строку - выполняем insert_sql с ins_params
+
+@timed("load.insert_fact")
+def insert_fact(conn, insert_sql: str, params: tuple) -> List[Tuple[Any, ...]]:
+    # один факт; повторы отсекает уникальный natural key (insert_sql с ON CONFLICT DO NOTHING)
+    # возвращает строки RETURNING, если они есть в insert_sql
     with conn.cursor() as cur:
-        cur.execute(select_sql, sel_params)
-        if cur.fetchone() is None:
-            cur.execute(insert_sql, ins_params)
+        cur.execute(insert_sql, params)
+        return cur.fetchall() if cur.description else []
 
 
+@timed("load.get_or_create_category")
 def get_or_create_category(conn, category_name: str) -> Optional[int]:
     # получает category_id из dim_category по имени или создаёт новую запись
     select_sql = "SELECT category_id FROM dim_category WHERE category_name = %s;"
-    insert_sql = "INSERT INTO dim_category (category_name) VALUES (%s) RETURNING category_id;"
+    insert_sql = """
+        INSERT INTO dim_category (category_name) VALUES (%s)
+        ON CONFLICT (category_name) DO NOTHING
+        RETURNING category_id;
+    """
     try:
-        return upsert_dimension(conn, select_sql, insert_sql, (category_name,), (category_name,))
+        return upsert_dimension(conn, select_sql, insert_sql, (category_name,), (category_name,),
+                                cache=_dim_cache("category"), key=category_name)
     except Exception as e:
         print(f"[get_or_create_category] ошибка: {e}")
         return None
 
 
+@timed("load.get_or_create_product")
 def get_or_create_product(conn, product_id: int, title: str, image: str, category_id: int) -> Optional[int]:
     # получает или создаёт запись в dim_product / возвращает product_id или None при ошибке.
     select_sql = "SELECT product_id FROM dim_product WHERE product_id = %s;"
     insert_sql = """
         INSERT INTO dim_product (product_id, title, image, category_id)
-        VALUES (%s, %s, %s, %s);
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (product_id) DO NOTHING;
     """
     try:
-        return upsert_dimension(conn, select_sql, insert_sql, (product_id,), (product_id, title, image, category_id))
+        return upsert_dimension(conn, select_sql, insert_sql, (product_id,), (product_id, title, image, category_id),
+                                cache=_dim_cache("product"), key=product_id)
     except Exception as e:
         print(f"[get_or_create_product] ошибка: {e}")
         return None
 
 
+@timed("load.get_or_create_time")
 def get_or_create_time(conn, etl_time_str: str) -> Optional[int]:
     # получает или создаёт запись в dim_time
     # ожидается формат 'YYYY-MM-DD HH:MM:SS'
@@ -112,6 +269,7 @@ def get_or_create_time(conn, etl_time_str: str) -> Optional[int]:
     insert_sql = """
         INSERT INTO dim_time (etl_time, date, hour, weekday)
         VALUES (%s, %s, %s, %s)
+        ON CONFLICT (etl_time) DO NOTHING
         RETURNING time_id;
     """
     date_ = dt.date()
@@ -119,199 +277,916 @@ def get_or_create_time(conn, etl_time_str: str) -> Optional[int]:
     weekday_ = dt.isoweekday()
 
     try:
-        return upsert_dimension(conn, select_sql, insert_sql, (dt,), (dt, date_, hour_, weekday_))
+        return upsert_dimension(conn, select_sql, insert_sql, (dt,), (dt, date_, hour_, weekday_),
+                                cache=_dim_cache("time"), key=dt)
     except Exception as e:
         print(f"[get_or_create_time] ошибка: {e}")
         return None
 
 
+@timed("load.get_or_create_location")
 def get_or_create_location(conn, location_name: str, latitude: float, longitude: float) -> Optional[int]:
     # получает или создаёт запись в dim_location
     select_sql = "SELECT location_id FROM dim_location WHERE location_name = %s;"
     insert_sql = """
         INSERT INTO dim_location (location_name, latitude, longitude)
         VALUES (%s, %s, %s)
+        ON CONFLICT (location_name) DO NOTHING
         RETURNING location_id;
     """
     try:
         return upsert_dimension(conn, select_sql, insert_sql,
-                                (location_name,), (location_name, latitude, longitude))
+                                (location_name,), (location_name, latitude, longitude),
+                                cache=_dim_cache("location"), key=location_name)
     except Exception as e:
         print(f"[get_or_create_location] ошибка: {e}")
         return None
 
 
-def get_or_create_currency(conn, currency_code: str, description: Optional[str] = None) -> Optional[str]:
-    # получает или создаёт валюту в dim_currency
-    select_sql = "SELECT currency_code FROM dim_currency WHERE currency_code = %s;"
-    insert_sql = "INSERT INTO dim_currency (currency_code, description) VALUES (%s, %s);"
-    try:
-        existing = upsert_dimension(
-            conn, select_sql, insert_sql, (currency_code,), (currency_code, description))
-        return existing if existing else currency_code
-    except Exception as e:
-        print(f"[get_or_create_currency] ошибка: {e}")
-        return None
+@timed("load.resolve_currencies")
+def resolve_currencies(conn, currencies: List[Dict[str, Any]]) -> List[str]:
+    # гарантирует наличие всех валют курса цб в dim_currency одним insert для недостающих
+    # currencies - как их отдаёт transform.parse_cbr_currencies
+    cache = _dim_cache("currency")
+    codes = list(dict.fromkeys(c["currency_code"] for c in currencies))
+    missing = [code for code in codes if cache is None or cache.get(code) is None]
+    if missing:
+        names = {c["currency_code"]: c["description"] for c in currencies}
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO dim_currency (currency_code, description)
+                VALUES %s
+                ON CONFLICT (currency_code) DO NOTHING;
+            """, [(code, names[code]) for code in missing])
+        if cache is not None:
+            for code in missing:
+                cache.put(code, code)
+    return codes
 
 
+@timed("load.get_or_create_crypto_asset")
 def get_or_create_crypto_asset(conn, asset_id: str, symbol: str, name: str) -> Optional[str]:
     # получает или создаёт запись в dim_crypto_asset
     select_sql = "SELECT asset_id FROM dim_crypto_asset WHERE asset_id = %s;"
     insert_sql = """
         INSERT INTO dim_crypto_asset (asset_id, symbol, name)
-        VALUES (%s, %s, %s);
+        VALUES (%s, %s, %s)
+        ON CONFLICT (asset_id) DO NOTHING;
     """
     try:
         existing = upsert_dimension(
-            conn, select_sql, insert_sql, (asset_id,), (asset_id, symbol, name))
+            conn, select_sql, insert_sql, (asset_id,), (asset_id, symbol, name),
+            cache=_dim_cache("crypto_asset"), key=asset_id)
         return existing if existing else asset_id
     except Exception as e:
         print(f"[get_or_create_crypto_asset] ошибка: {e}")
         return None
 
 
-def load():
+@timed("load.resolve_locations")
+def resolve_locations(conn, locations: List[Dict[str, Any]]) -> Dict[str, int]:
+    # location_id для всех точек: известные берём из кэша,
+    # остальные ищем одним select и недостающие вставляем одним insert
+    cache = _dim_cache("location")
+    ids: Dict[str, int] = {}
+    missing: Dict[str, Dict[str, Any]] = {}
+    for loc in locations:
+        location_id = cache.get(loc["name"]) if cache is not None else None
+        if location_id is None:
+            missing.setdefault(loc["name"], loc)
+        else:
+            ids[loc["name"]] = location_id
+    if not missing:
+        return ids
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT location_name, location_id FROM dim_location
+            WHERE location_name = ANY(%s);
+        """, (list(missing),))
+        found = dict(cur.fetchall())
+        to_insert = [(name, loc["latitude"], loc["longitude"])
+                     for name, loc in missing.items() if name not in found]
+        if to_insert:
+            found.update(execute_values(cur, """
+                INSERT INTO dim_location (location_name, latitude, longitude)
+                VALUES %s
+                ON CONFLICT (location_name) DO UPDATE SET location_name = EXCLUDED.location_name
+                RETURNING location_name, location_id;
+            """, to_insert, fetch=True))
+
+    for name, location_id in found.items():
+        ids[name] = location_id
+        if cache is not None:
+            cache.put(name, location_id)
+    return ids
+
+
+@timed("load.resolve_crypto_assets")
+def resolve_crypto_assets(conn, quotes: List[Dict[str, Any]]) -> List[str]:
+    # гарантирует наличие всех монет в dim_crypto_asset одним insert для недостающих
+    # symbol и name берутся из котировки, иначе из CRYPTO_ASSETS, иначе из id
+    cache = _dim_cache("crypto_asset")
+    configured = {a["id"]: a for a in CRYPTO_ASSETS}
+    asset_ids = list(dict.fromkeys(q["asset_id"] for q in quotes))
+    missing = [a for a in asset_ids if cache is None or cache.get(a) is None]
+    if missing:
+        rows = []
+        for asset_id in missing:
+            quote = next(q for q in quotes if q["asset_id"] == asset_id)
+            conf = configured.get(asset_id, {})
+            rows.append((asset_id,
+                         quote.get("symbol") or conf.get("symbol") or asset_id,
+                         quote.get("name") or conf.get("name") or asset_id))
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO dim_crypto_asset (asset_id, symbol, name)
+                VALUES %s
+                ON CONFLICT (asset_id) DO NOTHING;
+            """, rows)
+        if cache is not None:
+            for asset_id in missing:
+                cache.put(asset_id, asset_id)
+    return asset_ids
+
+
+@timed("load.insert_weather_facts")
+def insert_weather_facts(conn, time_id: int, rows: List[Tuple[int, Optional[float]]],
+                         rollup: Optional[RollupDelta] = None, stale: bool = False) -> None:
+    # факты погоды по всем точкам одним многострочным insert, без повторов для (time_id, location_id)
+    # etl_date (ключ секционирования) берётся из dim_time
+    # rollup: сюда добавляются вставленные температуры; stale: погода из последних удачных данных
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        inserted = execute_values(cur, """
+            INSERT INTO fact_weather (time_id, location_id, temperature, is_stale, etl_date)
+            SELECT v.time_id, v.location_id, v.temperature, v.is_stale, t.date
+            FROM (VALUES %s) AS v(time_id, location_id, temperature, is_stale)
+            JOIN dim_time t ON t.time_id = v.time_id
+            ON CONFLICT (time_id, location_id, etl_date) DO NOTHING
+            RETURNING location_id, temperature;
+        """, [(time_id, location_id, temp, stale) for location_id, temp in rows],
+            template="(%s::integer, %s::integer, %s::double precision, %s::boolean)", fetch=True)
+    if rollup is not None:
+        for location_id, temperature in inserted:
+            rollup.add_weather(location_id, temperature)
+
+
+@timed("load.insert_currency_facts")
+def insert_currency_facts(conn, time_id: int, rows: List[Tuple[str, Optional[float]]],
+                          stale: bool = False) -> None:
+    # курсы всех валют одним многострочным insert, без повторов для (time_id, currency_code)
+    # stale: курсы из последних удачных данных цб
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO fact_currency (time_id, currency_code, rate_cbr, is_stale, etl_date)
+            SELECT v.time_id, v.currency_code, v.rate_cbr, v.is_stale, t.date
+            FROM (VALUES %s) AS v(time_id, currency_code, rate_cbr, is_stale)
+            JOIN dim_time t ON t.time_id = v.time_id
+            ON CONFLICT (time_id, currency_code, etl_date) DO NOTHING;
+        """, [(time_id, code, rate, stale) for code, rate in rows],
+            template="(%s::integer, %s::text, %s::double precision, %s::boolean)")
+
+
+@timed("load.insert_crypto_facts")
+def insert_crypto_facts(conn, time_id: int,
+                        rows: List[Tuple[str, Optional[float], Optional[float]]],
+                        rollup: Optional[RollupDelta] = None, stale: bool = False) -> None:
+    # факты цен по всем монетам одним многострочным insert, без повторов для (time_id, asset_id)
+    # rollup: сюда добавляются вставленные цены; stale: котировки из последних удачных данных
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        inserted = execute_values(cur, """
+            INSERT INTO fact_crypto_price (time_id, asset_id, price_usd, change_pct_24h, is_stale, etl_date)
+            SELECT v.time_id, v.asset_id, v.price_usd, v.change_pct_24h, v.is_stale, t.date
+            FROM (VALUES %s) AS v(time_id, asset_id, price_usd, change_pct_24h, is_stale)
+            JOIN dim_time t ON t.time_id = v.time_id
+            ON CONFLICT (time_id, asset_id, etl_date) DO NOTHING
+            RETURNING asset_id, price_usd;
+        """, [(time_id,) + tuple(row) + (stale,) for row in rows],
+            template="(%s::integer, %s::text, %s::double precision, %s::double precision, %s::boolean)",
+            fetch=True)
+    if rollup is not None:
+        for asset_id, price_usd in inserted:
+            rollup.add_crypto(asset_id, price_usd)
+
+
+def product_fingerprint(title: Optional[str], image: Optional[str], category: Optional[str]) -> str:
+    # отпечаток атрибутов товара: меняется только если поменялось название, картинка или категория
+    payload = "\x1f".join("" if v is None else str(v) for v in (title, image, category))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+@timed("load.sync_products")
+def sync_products(conn, records: Iterable[SalesRow], store) -> Dict[str, str]:
+    # cdc для dim_product: сравниваем отпечатки входящих товаров с сохранёнными в store
+    # и одним пакетом отправляем в базу только новые и изменённые товары
+    # изменённые товары обновляются на месте (scd1)
+    # store только читается; возвращает отпечатки отправленных товаров, их нужно
+    # записать в store после commit в базе (store.put_fingerprints + store.commit)
+    incoming: Dict[Any, Tuple[str, Optional[str], str, str]] = {}
+    for rec in records:
+        prod_id = rec.product_id
+        title = rec.title
+        category = rec.category
+        # неполные записи пропускаются, как и в построчном режиме
+        if prod_id is None or title is None or category is None:
+            continue
+        image = rec.image
+        incoming[prod_id] = (title, image, category,
+                             product_fingerprint(title, image, category))
+    if not incoming:
+        return {}
+
+    known = store.get_fingerprints(str(pid) for pid in incoming)
+    changed = {pid: v for pid, v in incoming.items() if known.get(str(pid)) != v[3]}
+    # отпечаток совпал, но товара может не быть в базе (например, её пересоздали):
+    # кэш ключей - подсказка "есть", остальные (в том числе вытесненные из lru) проверяем
+    # одним select по ключам пачки, а не отправляем заново
+    product_cache = _dim_cache("product")
+    unsure = [pid for pid in incoming
+              if pid not in changed and (product_cache is None or pid not in product_cache)]
+    if unsure:
+        with conn.cursor() as cur:
+            cur.execute("SELECT product_id FROM dim_product WHERE product_id = ANY(%s);", (unsure,))
+            present = {row[0] for row in cur.fetchall()}
+        for pid in unsure:
+            if pid in present:
+                if product_cache is not None:
+                    product_cache.put(pid, pid)
+            else:
+                changed[pid] = incoming[pid]
+    if not changed:
+        return {}
+
+    category_ids: Dict[str, int] = {}
+    for name in {v[2] for v in changed.values()}:
+        category_id = get_or_create_category(conn, name)
+        if category_id is not None:
+            category_ids[name] = category_id
+
+    rows = [(pid, title, image, category_ids[category], fp)
+            for pid, (title, image, category, fp) in changed.items()
+            if category in category_ids]
+    with conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO dim_product (product_id, title, image, category_id, attr_hash)
+            VALUES %s
+            ON CONFLICT (product_id) DO UPDATE SET
+                title = EXCLUDED.title,
+                image = EXCLUDED.image,
+                category_id = EXCLUDED.category_id,
+                attr_hash = EXCLUDED.attr_hash
+            WHERE dim_product.attr_hash IS DISTINCT FROM EXCLUDED.attr_hash;
+        """, rows, page_size=1000)
+
+    if product_cache is not None:
+        for pid, *_ in rows:
+            product_cache.put(pid, pid)
+    return {str(pid): fp for pid, _, _, _, fp in rows}
+
+
+@timed("load.load_sales_rowwise")
+def load_sales_rowwise(conn, records: Iterable[SalesRow], time_id: int,
+                       dims_unchanged: bool = False, rollup: Optional[RollupDelta] = None,
+                       stale: bool = False) -> None:
+    # построчная загрузка: для каждого товара select-then-insert по категориям, товарам и фактам
+    # dims_unchanged: товары пачки уже сверены с базой (sync_products) - известные кэшу
+    # не трогаем вовсе (ни категорию, ни товар)
+    # rollup: сюда добавляется прирост роллапа продаж
+    # stale: записи посчитаны по последним удачным данным источника (is_stale у фактов)
+    product_cache = _dim_cache("product") if dims_unchanged else None
+    for rec in records:
+        prod_id = rec.product_id
+        category = rec.category
+        price_usd = rec.price_usd
+        price_rub = rec.price_rub
+        sales = rec.sales
+        title = rec.title
+        image = rec.image
+
+        if product_cache is not None and prod_id in product_cache:
+            _insert_sales_fact(conn, prod_id, time_id, sales, price_usd, price_rub, rollup, stale)
+            continue
+
+        # dim_category
+        category_id = get_or_create_category(conn, category)
+        if category_id is None:
+            print(
+                f"[load] не удалось получить category_id для '{category}', пропускаем запись.")
+            continue
+
+        # dim_product
+        prod = get_or_create_product(
+            conn, prod_id, title, image, category_id)
+        if prod is None:
+            print(
+                f"[load] не удалось получить product_id={prod_id}, пропускаем запись.")
+            continue
+
+        # вставляем факт продаж
+        _insert_sales_fact(conn, prod_id, time_id, sales, price_usd, price_rub, rollup, stale)
+
+
+@timed("load.insert_sales_fact")
+def _insert_sales_fact(conn, prod_id: int, time_id: int, sales: Optional[int],
+                       price_usd: Optional[float], price_rub: Optional[float],
+                       rollup: Optional[RollupDelta] = None, stale: bool = False) -> None:
+    insert_sales = """
+        WITH ins AS (
+            INSERT INTO fact_sales (product_id, time_id, sales, price_usd, price_rub, is_stale, etl_date)
+            SELECT %s, t.time_id, %s, %s, %s, %s, t.date FROM dim_time t WHERE t.time_id = %s
+            ON CONFLICT (product_id, time_id, etl_date) DO NOTHING
+            RETURNING product_id, sales, price_usd
+        )
+    """ + SALES_ROLLUP_SELECT
+    for row in insert_fact(conn, insert_sales, (prod_id, sales, price_usd, price_rub, stale, time_id)):
+        if rollup is not None:
+            rollup.add_sales(*row)
+
+
+class RecordStream(io.RawIOBase):
+    # файлоподобный поток csv-строк поверх итератора записей
+    # copy читает его кусками, поэтому весь csv никогда не лежит в памяти целиком
+
+    def __init__(self, rows: Iterable[Iterable[Any]]):
+        self._rows = iter(rows)
+        self._buf = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_chunk(self) -> bytes:
+        out = io.StringIO()
+        # None пишется меткой NULL_MARKER: пустое поле copy в формате csv тоже читает как NULL,
+        # и товар с пустым названием или категорией потерялся бы, хотя построчно вставляется
+        writer = csv.writer(out, lineterminator="\n")
+        for _ in range(1000):
+            try:
+                writer.writerow([NULL_MARKER if v is None else v for v in next(self._rows)])
+            except StopIteration:
+                break
+        return out.getvalue().encode("utf-8")
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buf) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._buf += chunk
+        if size < 0:
+            data, self._buf = self._buf, b""
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+@timed("load.bulk_load_sales")
+def bulk_load_sales(conn, records: Iterable[SalesRow], time_id: int,
+                    dims_unchanged: bool = False, rollup: Optional[RollupDelta] = None,
+                    stale: bool = False) -> int:
+    # set-based загрузка: все записи одним copy во временную таблицу,
+    # затем категории, товары и факты продаж несколькими insert ... select
+    # количество запросов не зависит от числа товаров
+    # dims_unchanged: товары пачки уже сверены с базой (sync_products) - измерения обновляем,
+    # только если в базе нет каких-то товаров
+    # rollup: сюда добавляется прирост роллапа продаж; stale: см. load_sales_rowwise
+    # возвращает число вставленных фактов продаж
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS stage_sales (
+                product_id INTEGER,
+                title TEXT,
+                image TEXT,
+                category_name TEXT,
+                sales INTEGER,
+                price_usd DOUBLE PRECISION,
+                price_rub DOUBLE PRECISION
+            ) ON COMMIT DROP;
+        """)
+        cur.execute("TRUNCATE stage_sales;")
+        # поля SalesRow идут в порядке STAGE_SALES_COLUMNS, поэтому записи уходят в csv как есть
+        cur.copy_expert(
+            f"COPY stage_sales ({', '.join(STAGE_SALES_COLUMNS)}) FROM STDIN "
+            f"WITH (FORMAT csv, NULL '{NULL_MARKER}')",
+            RecordStream(records))
+
+        # записи без id, названия или категории в построчном режиме тоже пропускаются
+        cur.execute("""
+            DELETE FROM stage_sales
+            WHERE product_id IS NULL OR title IS NULL OR category_name IS NULL;
+        """)
+        if cur.rowcount:
+            print(f"[bulk_load_sales] пропущено неполных записей: {cur.rowcount}")
+
+        update_dims = True
+        if dims_unchanged:
+            cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM stage_sales s
+                    WHERE NOT EXISTS (SELECT 1 FROM dim_product p WHERE p.product_id = s.product_id)
+                );
+            """)
+            update_dims = cur.fetchone()[0]
+
+        if update_dims:
+            _bulk_upsert_dims(cur)
+
+        # fact_sales
+        cur.execute("""
+            WITH ins AS (
+                INSERT INTO fact_sales (product_id, time_id, sales, price_usd, price_rub, is_stale, etl_date)
+                SELECT DISTINCT ON (s.product_id)
+                       s.product_id, t.time_id, s.sales, s.price_usd, s.price_rub, %(stale)s, t.date
+                FROM stage_sales s
+                CROSS JOIN dim_time t
+                WHERE t.time_id = %(time_id)s
+                ORDER BY s.product_id
+                ON CONFLICT (product_id, time_id, etl_date) DO NOTHING
+                RETURNING product_id, sales, price_usd
+            )
+        """ + SALES_ROLLUP_SELECT, {"time_id": time_id, "stale": stale})
+        by_category = cur.fetchall()
+    if rollup is not None:
+        for row in by_category:
+            rollup.add_sales(*row)
+    return sum(row[1] for row in by_category)
+
+
+def _bulk_upsert_dims(cur) -> None:
+    # dim_category и dim_product из staging-таблицы
+    cur.execute("""
+        INSERT INTO dim_category (category_name)
+        SELECT DISTINCT s.category_name
+        FROM stage_sales s
+        ON CONFLICT (category_name) DO NOTHING;
+    """)
+
+    # существующие товары не меняем, как и в построчном режиме
+    cur.execute("""
+        INSERT INTO dim_product (product_id, title, image, category_id)
+        SELECT DISTINCT ON (s.product_id)
+               s.product_id, s.title, s.image, c.category_id
+        FROM stage_sales s
+        JOIN dim_category c ON c.category_name = s.category_name
+        ORDER BY s.product_id
+        ON CONFLICT (product_id) DO NOTHING;
+    """)
+
+
+@timed("load.insert_sales_facts")
+def insert_sales_facts(conn, time_id: int, records: Iterable[SalesRow],
+                       rollup: Optional[RollupDelta] = None, stale: bool = False) -> int:
+    # факты продаж многострочным insert без staging-таблицы, без повторов для (product_id, time_id)
+    # товары уже должны быть в dim_product; неполные записи пропускаются, как и в других режимах
+    # rollup: сюда добавляется прирост роллапа продаж; stale: см. load_sales_rowwise
+    # возвращает число вставленных фактов
+    rows: Dict[Any, Tuple[Any, ...]] = {}
+    for rec in records:
+        prod_id = rec.product_id
+        if prod_id is None or rec.title is None or rec.category is None:
+            continue
+        rows.setdefault(prod_id, (prod_id, time_id, rec.sales,
+                                  rec.price_usd, rec.price_rub, stale))
+    if not rows:
+        return 0
+    with conn.cursor() as cur:
+        by_category = execute_values(cur, """
+            WITH ins AS (
+                INSERT INTO fact_sales (product_id, time_id, sales, price_usd, price_rub, is_stale, etl_date)
+                SELECT v.product_id, v.time_id, v.sales, v.price_usd, v.price_rub, v.is_stale, t.date
+                FROM (VALUES %s) AS v(product_id, time_id, sales, price_usd, price_rub, is_stale)
+                JOIN dim_time t ON t.time_id = v.time_id
+                ON CONFLICT (product_id, time_id, etl_date) DO NOTHING
+                RETURNING product_id, sales, price_usd
+            )
+        """ + SALES_ROLLUP_SELECT, list(rows.values()),
+            template="(%s::integer, %s::integer, %s::integer, %s::double precision, %s::double precision, "
+                     "%s::boolean)",
+            page_size=1000, fetch=True)
+    if rollup is not None:
+        for row in by_category:
+            rollup.add_sales(*row)
+    return sum(row[1] for row in by_category)
+
+
+def partition_of(product_id: Any, partitions: int) -> int:
+    # номер партиции товара: остаток от деления для целых id, crc32 для остальных
+    if isinstance(product_id, int):
+        return product_id % partitions
+    return zlib.crc32(str(product_id).encode("utf-8")) % partitions
+
+
+class PartitionedLoader:
+    # параллельная загрузка фактов продаж: записи делятся на партиции по product_id,
+    # у каждой партиции своё соединение из пула и свой поток, пачки партиции идут по порядку
+    # strategy: "coordinated" - фиксация всех партиций вместе с основным соединением в commit(),
+    # "independent" - каждая пачка партиции фиксируется сразу, ошибка одной не трогает остальные
+    # временные таблицы нельзя подготовить для двухфазной фиксации, поэтому без staging и copy
+
+    def __init__(self, pool: ThreadedConnectionPool, time_id: int,
+                 workers: int = LOAD_WORKERS, strategy: str = COMMIT_STRATEGY, stale: bool = False):
+        if workers < 1:
+            raise ValueError("число партиций должно быть положительным")
+        strategy = strategy.lower()
+        if strategy not in ("coordinated", "independent"):
+            raise ValueError(f"неизвестная стратегия фиксации: {strategy}")
+        self.pool = pool
+        self.time_id = time_id
+        self.strategy = strategy
+        self.stale = stale
+        self.conns = [pool.getconn() for _ in range(workers)]
+        self.executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"load-p{i}")
+                          for i in range(workers)]
+        self.futures: List[Future] = []
+        self.failed: List[int] = []
+        # прирост роллапа продаж от зафиксированных (или фиксируемых вместе) пачек партиций
+        self.rollup = RollupDelta()
+        self.tpc = False
+        # партиции, чья транзакция ещё не зафиксирована и не откачена: rollback трогает только их
+        self.open: Set[int] = set(range(workers))
+        for conn in self.conns:
+            conn.autocommit = False
+        if strategy == "coordinated":
+            self.tpc = self._tpc_supported()
+            if self.tpc:
+                gtrid = f"etl-{time_id}-{uuid.uuid4().hex[:12]}"
+                for i, conn in enumerate(self.conns):
+                    conn.tpc_begin(conn.xid(0, gtrid, f"p{i}"))
+            else:
+                print("[PartitionedLoader] max_prepared_transactions = 0, партиции будут "
+                      "зафиксированы по очереди после успеха всех (без двухфазной фиксации)")
+
+    def _tpc_supported(self) -> bool:
+        with self.conns[0].cursor() as cur:
+            cur.execute("SHOW max_prepared_transactions;")
+            enabled = int(cur.fetchone()[0]) > 0
+        self.conns[0].rollback()
+        return enabled
+
+    def submit(self, records: Iterable[SalesRow]) -> None:
+        # раскладывает пачку записей по партициям и ставит их в очереди потоков
+        parts: List[List[SalesRow]] = [[] for _ in self.conns]
+        for rec in records:
+            parts[partition_of(rec.product_id, len(parts))].append(rec)
+        for i, part in enumerate(parts):
+            if part:
+                self.futures.append(self.executors[i].submit(self._load_part, i, part))
+
+    def _load_part(self, i: int, part: List[SalesRow]) -> int:
+        conn = self.conns[i]
+        part_rollup = RollupDelta()
+        try:
+            inserted = insert_sales_facts(conn, self.time_id, part, part_rollup, self.stale)
+            if self.strategy == "independent":
+                conn.commit()
+        except Exception as e:
+            if self.strategy == "coordinated":
+                raise
+            conn.rollback()
+            print(f"[PartitionedLoader] партиция {i}: пачка не загружена: {e}")
+            self.failed.append(i)
+            return 0
+        inc("partition_batches")
+        self.rollup.merge(part_rollup)
+        return inserted
+
+    def wait(self) -> int:
+        # ждёт все поставленные пачки, возвращает число вставленных фактов
+        # в coordinated первая ошибка пробрасывается (после того как остальные потоки закончили)
+        inserted = 0
+        error: Optional[BaseException] = None
+        for fut in self.futures:
+            try:
+                inserted += fut.result()
+            except Exception as e:
+                error = error or e
+        self.futures = []
+        if error is not None:
+            raise error
+        return inserted
+
+    def commit(self, main_conn) -> None:
+        # фиксирует партиции вместе с main_conn
+        # tpc: партиции готовятся (prepare), затем фиксируется main_conn, затем партиции;
+        # если main_conn не зафиксировался, подготовленные партиции откатываются
+        if self.strategy == "independent":
+            main_conn.commit()
+            self.open.clear()
+            return
+        if not self.tpc:
+            main_conn.commit()
+            for i, conn in enumerate(self.conns):
+                conn.commit()
+                self.open.discard(i)
+            return
+        for conn in self.conns:
+            conn.tpc_prepare()
+        try:
+            main_conn.commit()
+        except Exception:
+            self.rollback()
+            raise
+        for i, conn in enumerate(self.conns):
+            conn.tpc_commit()
+            self.open.discard(i)
+
+    def rollback(self) -> None:
+        # откатывает незавершённые партиции; вызывается на пути ошибки, поэтому сам не бросает:
+        # ошибка отката только печатается, а наружу уходит исходная ошибка
+        for i in sorted(self.open):
+            conn = self.conns[i]
+            try:
+                if conn.closed:
+                    continue
+                if self.tpc:
+                    conn.tpc_rollback()
+                else:
+                    conn.rollback()
+            except Exception as e:
+                print(f"[PartitionedLoader] партиция {i}: не удалось откатить: {e}")
+        self.open.clear()
+
+    def close(self) -> None:
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        for conn in self.conns:
+            self.pool.putconn(conn)
+
+
+def load_sales_parallel(conn, batches: Iterable[Sequence[SalesRow]], time_id: int, store,
+                        workers: int = LOAD_WORKERS, strategy: str = COMMIT_STRATEGY,
+                        rollup: Optional[RollupDelta] = None,
+                        stale: bool = False) -> Tuple[int, Dict[str, str]]:
+    # режим parallel: измерения товаров пачки синхронизируются отдельным соединением и сразу
+    # фиксируются (соединения партиций должны их видеть), затем факты пачки уходят в партиции
+    # conn (факты погоды, курса и крипто) фиксируется вместе с партициями
+    # rollup: прирост роллапов прогона; дополняется приростом партиций и пишется в conn перед фиксацией
+    # stale: см. load_sales_rowwise
+    # возвращает (число вставленных фактов продаж, отпечатки для store)
+    pool = get_pool()
+    dims_conn = pool.getconn()
+    dims_conn.autocommit = False
+    loader = PartitionedLoader(pool, time_id, workers, strategy, stale)
+    fingerprints: Dict[str, str] = {}
+    try:
+        for batch in batches:
+            inc("records_loaded", len(batch))
+            # cdc дешёв для неизменившихся товаров, а без него в партициях может не хватить товаров
+            fingerprints.update(sync_products(dims_conn, batch, store))
+            dims_conn.commit()
+            loader.submit(batch)
+        inserted = loader.wait()
+        if rollup is not None:
+            rollup.merge(loader.rollup)
+            apply_rollups(conn, time_id, rollup)
+        loader.commit(conn)
+    except Exception:
+        # дожидаемся потоков партиций, прежде чем откатывать их соединения
+        for fut in loader.futures:
+            fut.exception()
+        loader.rollback()
+        try:
+            dims_conn.rollback()
+        except Exception as e:
+            print(f"[load_sales_parallel] не удалось откатить соединение измерений: {e}")
+        raise
+    finally:
+        loader.close()
+        pool.putconn(dims_conn)
+    if loader.failed:
+        print(f"[load] parallel: партиции с ошибками: {sorted(set(loader.failed))}")
+    return inserted, fingerprints
+
+
+def load(mode: Optional[str] = None, stream: Optional[bool] = None, batch_size: int = BATCH_SIZE,
+         batches: Optional[Iterable[Sequence[SalesRow]]] = None,
+         raw: Optional[Dict[str, Any]] = None,
+         facts: Optional[Iterable[str]] = None, context: Optional[RunContext] = None) -> bool:
     # основной процесс загрузки: берём преобразованные записи из transform()
     # затем апсетим размерности и вставляем факты в соответствующие таблицы
-    records = transform()
-    if not records:
-        print("[load] нет записей для загрузки, выходим.")
-        return
+    # mode: "row" (построчно), "bulk" (staging + copy) или "parallel" (партиции по соединениям),
+    # по умолчанию LOAD_MODE
+    # stream: брать записи пачками из transform_batches(), по умолчанию STREAM_MODE
+    # batches: уже готовые пачки записей (pipeline.py), тогда transform здесь не вызывается
+    # context: общие поля прогона (etl_time, курс), по умолчанию - контекст пачки из transform
+    # raw: сырые данные по источникам в памяти, иначе погода и крипто читаются из data/
+    # facts: какие группы фактов писать (FACT_GROUPS), по умолчанию все; без "sales" записи
+    # не нужны вовсе, etl_time и курс берутся из raw (daemon.py)
+    # raw["stale"]: источники, отданные из последних удачных данных, их факты помечаются is_stale
+    # возвращает True если загрузка зафиксирована в базе
+    facts = set(FACT_GROUPS if facts is None else facts)
+    unknown = facts - set(FACT_GROUPS)
+    if unknown:
+        raise ValueError(f"неизвестные группы фактов: {', '.join(sorted(unknown))}")
+    mode = (mode or LOAD_MODE).lower()
+    if mode not in LOAD_MODES:
+        raise ValueError(f"неизвестный режим загрузки: {mode} (есть: {', '.join(LOAD_MODES)})")
+    raw = raw or {}
+    stale_sources = raw.get("stale") or {}
+    stale = {group: any(source in stale_sources for source in sources)
+             for group, sources in FACT_SOURCES.items()}
+    if stale_sources:
+        print(f"[load] устаревшие данные источников: {', '.join(sorted(stale_sources))}, "
+              f"факты {', '.join(g for g in sorted(facts) if stale[g]) or '-'} помечаются is_stale")
+
+    first_batch: Optional[Sequence[SalesRow]] = None
+    if "sales" in facts:
+        stream = STREAM_MODE if stream is None else stream
+        if batches is not None:
+            batches = iter(batches)
+        elif stream:
+            batches = transform_batches(batch_size)
+        else:
+            records = transform()
+            batches = iter([records] if records else [])
+
+        first_batch = next(batches, None)
+        if not first_batch:
+            print("[load] нет записей для загрузки, выходим.")
+            return False
 
-    # берём первичный элемент чтобы получить общие параметры для всех записей
-    first = records[0]
-    etl_time_str = first.get("etl_time")
-    cbr_rate = first.get("cbr_usd_rub")
-    temp_snapshot = first.get("temp_snapshot")
-    btc_price = first.get("btc_price_usd")
-    btc_change = first.get("btc_change_24h")
+        context = context if context is not None else first_batch.context
+        etl_time_str = context.etl_time
+    else:
+        etl_time_str = context.etl_time if context is not None else raw.get("etl_time")
+
+    # погода по всем точкам и котировки всех монет (в записях только основные)
+    # точка без location_name - старый формат raw_weather.json, это основная точка
+    snapshots: List[Dict[str, Any]] = []
+    if "weather" in facts:
+        snapshots = parse_weather_snapshots(raw["weather"] if "weather" in raw else load_json(RAW_WEATHER))
+        default_location = WEATHER_LOCATIONS[0]["name"] if WEATHER_LOCATIONS else None
+        for snap in snapshots:
+            snap["location_name"] = snap["location_name"] or default_location
+    # курсы всех валют из ответа цб (рублей за единицу, с учётом Nominal)
+    currencies: List[Dict[str, Any]] = []
+    if "currency" in facts:
+        currencies = parse_cbr_currencies(raw["cbr"] if "cbr" in raw else load_json(RAW_CBR))
+    quotes: List[Dict[str, Any]] = []
+    if "crypto" in facts:
+        quotes = parse_crypto_quotes(raw["crypto"] if "crypto" in raw else load_json(RAW_CRYPTO))
 
     if not etl_time_str:
         print("[load] etl_time отсутствует в записи, выходим.")
-        return
+        return False
 
-    # открываем соединение с базой
+    # хранилище состояния: отпечатки товаров для cdc по dim_product
+    store = open_sales_store()
+
+    # берём соединение с базой из пула
+    conn = None
     try:
-        with psycopg2.connect(**DB_PARAMS) as conn:
+        conn = get_pool().getconn()
+        with conn:
             conn.autocommit = False  # начинаем транзакцию
 
             # проверяем соединение
             with conn.cursor() as test_cur:
                 test_cur.execute("SELECT 1;")
 
+            # загрузка опирается на уникальные ключи и секции из миграций schema.py
+            ensure_schema(conn)
+
+            # прогреваем кэш ключей измерений одним select на измерение, один раз за процесс
+            # (только те измерения, на которые ссылаются загружаемые факты)
+            if DIM_CACHE_ENABLED:
+                DIM_CACHE.reset_stats()
+                DIM_CACHE.warm(conn, [name for group in sorted(facts)
+                                      for name in FACT_DIMENSIONS[group]])
+
             # dim_time
             time_id = get_or_create_time(conn, etl_time_str)
             if time_id is None:
                 print("[load] не удалось получить time_id, откатываемся.")
                 conn.rollback()
-                return
+                return False
+
+            # месячные секции фактов для даты прогона
+            ensure_partitions(conn, datetime.fromisoformat(etl_time_str).date())
 
             # dim_location
-            location_id = get_or_create_location(
-                conn, LOCATION_NAME, LATITUDE, LONGITUDE)
-            if location_id is None:
-                print("[load] не удалось получить location_id, откатываемся.")
-                conn.rollback()
-                return
+            location_ids: Dict[str, int] = {}
+            if "weather" in facts:
+                # точки из настроек берём как есть, остальные - по координатам из ответа api;
+                # точку без названия или координат записать некуда, её пропускаем с сообщением
+                configured = {loc["name"]: loc for loc in WEATHER_LOCATIONS}
+                locations = []
+                skipped = []
+                for snap in snapshots:
+                    name = snap["location_name"]
+                    if name in configured:
+                        locations.append(configured[name])
+                    elif name and snap["latitude"] is not None and snap["longitude"] is not None:
+                        locations.append({"name": name, "latitude": snap["latitude"],
+                                          "longitude": snap["longitude"]})
+                    else:
+                        skipped.append(str(name))
+                if skipped:
+                    print(f"[load] погода без точки в dim_location, пропускаем: {', '.join(skipped)}")
+                location_ids = resolve_locations(conn, locations)
 
             # dim_currency
-            curr = get_or_create_currency(conn, CURRENCY_CODE, CURRENCY_DESC)
-            if curr is None:
-                print("[load] не удалось получить currency_code, откатываемся.")
-                conn.rollback()
-                return
+            if "currency" in facts:
+                resolve_currencies(conn, currencies)
 
             # dim_crypto_asset
-            asset = get_or_create_crypto_asset(
-                conn, ASSET_ID, ASSET_SYMBOL, ASSET_NAME)
-            if asset is None:
-                print("[load] не удалось получить asset_id, откатываемся.")
-                conn.rollback()
-                return
+            if "crypto" in facts:
+                resolve_crypto_assets(conn, quotes)
+
+            # соединения партиций ссылаются на time_id, поэтому измерения фиксируем сразу
+            parallel_sales = mode == "parallel" and "sales" in facts
+            if parallel_sales:
+                conn.commit()
+
+            # прирост роллапов от фактов этого прогона, пишется одной транзакцией с фактами
+            rollup = RollupDelta()
 
             # факты погоды
-            select_weather = "SELECT fact_id FROM fact_weather WHERE time_id = %s AND location_id = %s;"
-            insert_weather = """
-                INSERT INTO fact_weather (time_id, location_id, temperature)
-                VALUES (%s, %s, %s);
-            """
-            insert_fact_if_not_exists(conn,
-                                      select_weather, insert_weather,
-                                      (time_id, location_id), (time_id,
-                                                               location_id, temp_snapshot)
-                                      )
-
-            # факты курса валют
-            select_currency = "SELECT fact_id FROM fact_currency WHERE time_id = %s AND currency_code = %s;"
-            insert_currency = """
-                INSERT INTO fact_currency (time_id, currency_code, rate_cbr)
-                VALUES (%s, %s, %s);
-            """
-            insert_fact_if_not_exists(conn,
-                                      select_currency, insert_currency,
-                                      (time_id, CURRENCY_CODE), (time_id,
-                                                                 CURRENCY_CODE, cbr_rate)
-                                      )
+            if "weather" in facts:
+                insert_weather_facts(conn, time_id, [
+                    (location_ids[snap["location_name"]], snap["temperature"])
+                    for snap in snapshots if snap["location_name"] in location_ids],
+                    rollup, stale["weather"])
+
+            # факты курсов всех валют
+            if "currency" in facts:
+                insert_currency_facts(conn, time_id, [(c["currency_code"], c["rate"]) for c in currencies],
+                                      stale["currency"])
 
             # факты цены крипто
-            select_crypto = "SELECT fact_id FROM fact_crypto_price WHERE time_id = %s AND asset_id = %s;"
-            insert_crypto = """
-                INSERT INTO fact_crypto_price (time_id, asset_id, price_usd, change_pct_24h)
-                VALUES (%s, %s, %s, %s);
-            """
-            insert_fact_if_not_exists(conn,
-                                      select_crypto, insert_crypto,
-                                      (time_id, ASSET_ID), (time_id,
-                                                            ASSET_ID, btc_price, btc_change)
-                                      )
-
-            # факты продаж (прогон по всем товарам)
-            for rec in records:
-                prod_id = rec.get("product_id")
-                category = rec.get("category")
-                price_usd = rec.get("price_usd")
-                price_rub = rec.get("price_rub")
-                sales = rec.get("sales")
-                title = rec.get("title")
-                image = rec.get("image")
-
-                # dim_category
-                category_id = get_or_create_category(conn, category)
-                if category_id is None:
-                    print(
-                        f"[load] не удалось получить category_id для '{category}', пропускаем запись.")
-                    continue
+            if "crypto" in facts:
+                insert_crypto_facts(conn, time_id, [
+                    (q["asset_id"], q["price_usd"], q["change_pct_24h"]) for q in quotes],
+                    rollup, stale["crypto"])
 
-                # dim_product
-                prod = get_or_create_product(
-                    conn, prod_id, title, image, category_id)
-                if prod is None:
-                    print(
-                        f"[load] не удалось получить product_id={prod_id}, пропускаем запись.")
-                    continue
+            # факты продаж, пачка за пачкой
+            # измерения товаров сначала синхронизируются через cdc, поэтому дальше
+            # факты грузятся как для неизменившегося каталога
+            inserted = 0
+            fingerprints: Dict[str, str] = {}
+            if parallel_sales:
+                # партиции фиксируются вместе с conn согласно COMMIT_STRATEGY
+                inserted, fingerprints = load_sales_parallel(
+                    conn, itertools.chain([first_batch], batches), time_id, store,
+                    rollup=rollup, stale=stale["sales"])
+            else:
+                if "sales" in facts:
+                    for batch in itertools.chain([first_batch], batches):
+                        inc("records_loaded", len(batch))
+                        # сверка отпечатков дешёвая, поэтому идёт всегда: флаг "каталог не менялся"
+                        # сравнивает с прошлым извлечением, а не с последней удачной загрузкой
+                        fingerprints.update(sync_products(conn, batch, store))
+                        if mode == "bulk":
+                            inserted += bulk_load_sales(conn, batch, time_id, True, rollup, stale["sales"])
+                        else:
+                            load_sales_rowwise(conn, batch, time_id, True, rollup, stale["sales"])
+                apply_rollups(conn, time_id, rollup)
+            if "sales" in facts and mode in ("bulk", "parallel"):
+                inc("sales_facts_inserted", inserted)
+                print(f"[load] {mode}: вставлено фактов продаж: {inserted}")
+            if "sales" in facts:
+                print(f"[load] cdc: новых или изменённых товаров: {len(fingerprints)}")
 
-                # вставляем факт продаж
-                select_sales = "SELECT fact_id FROM fact_sales WHERE product_id = %s AND time_id = %s;"
-                insert_sales = """
-                    INSERT INTO fact_sales (product_id, time_id, sales, price_usd, price_rub)
-                    VALUES (%s, %s, %s, %s, %s);
-                """
-                insert_fact_if_not_exists(conn,
-                                          select_sales, insert_sales,
-                                          (prod_id, time_id), (prod_id,
-                                                               time_id, sales, price_usd, price_rub)
-                                          )
-
-            # фиксируем транзакцию
+            # фиксируем транзакцию, затем отпечатки товаров
+            # уведомление читателям (queries.py) уходит вместе с commit, свой кэш сбрасываем сразу после
+            notify_loaded(conn, time_id, facts)
             conn.commit()
-            print("[load] загрузка в БД прошла успешно.")
+            invalidate_queries(facts)
+            if fingerprints:
+                store.put_fingerprints(fingerprints)
+                store.commit()
+            print(f"[load] загрузка в БД прошла успешно ({', '.join(sorted(facts))}).")
+            if DIM_CACHE_ENABLED:
+                for name, st in DIM_CACHE.stats().items():
+                    print(f"[load] кэш {name}: размер={st['size']}, "
+                          f"попаданий={st['hits']}, промахов={st['misses']}")
+            return True
     except psycopg2.OperationalError as e:
+        DIM_CACHE.clear()
         print(f"[load] ошибка соединения с БД: {e}")
+        return False
     except Exception as e:
-        # при любой другой ошибке транзакция откатится
+        # при любой другой ошибке транзакция откатится, а вместе с ней и новые ключи в кэше
+        DIM_CACHE.clear()
         print(f"[load] непредвиденная ошибка: {e}")
         raise
+    finally:
+        if conn is not None and _pool is not None:
+            # оборванное соединение пул закрывает, а не выдаёт следующей загрузке
+            _pool.putconn(conn, close=bool(conn.closed))
+        store.close()
 
 
 if __name__ == "__main__":
-    load()
+    start_memory_probe()
+    try:
+        load()
+    finally:
+        close_pool()
+        stop_memory_probe()
+        export_run("load")
@@ -0,0 +1,227 @@
+# metrics.py
+
+import functools
+import json
+import os
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
+
+# КОНСТАНТЫ
+
+# куда складывать метрики прогонов (json по прогону и textfile для prometheus)
+METRICS_DIR = os.getenv("ETL_METRICS_DIR", os.path.join(DATA_DIR, "metrics"))
+# ETL_TRACEMALLOC=1 включает замер пика памяти (заметно замедляет python-код)
+TRACEMALLOC_ENABLED = os.getenv("ETL_TRACEMALLOC", "0") == "1"
+
+# границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # кумулятивная гистограмма в стиле prometheus
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(b): c for b, c in zip(self.buckets, self.counts)},
+        }
+
+
+class Metrics:
+    # метрики одного прогона: интервалы (span), счётчики, гистограммы и пик памяти
+    # потокобезопасно, extract пишет сюда из нескольких потоков
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self.spans: Dict[str, Dict[str, float]] = {}
+            self.counters: Dict[str, float] = {}
+            self.histograms: Dict[str, Histogram] = {}
+            self.gauges: Dict[str, float] = {}
+
+    def add_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            entry = self.spans.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["total_seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(value)
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+                "duration_seconds": time.time() - self.started_at,
+                "spans": {k: dict(v) for k, v in self.spans.items()},
+                "counters": dict(self.counters),
+                "histograms": {k: h.to_dict() for k, h in self.histograms.items()},
+                "gauges": dict(self.gauges),
+            }
+
+
+# общий реестр метрик процесса
+METRICS = Metrics()
+
+
+# ИНСТРУМЕНТЫ
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    # замеряет время блока и копит его в METRICS.spans[name] (даже если блок упал)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.add_span(name, time.perf_counter() - started)
+
+
+def timed(name: str) -> Callable:
+    # декоратор: каждый вызов функции - span с именем name
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inc(name: str, value: float = 1) -> None:
+    METRICS.inc(name, value)
+
+
+def observe(name: str, value: float) -> None:
+    METRICS.observe(name, value)
+
+
+def start_memory_probe() -> bool:
+    # включает tracemalloc, если это разрешено ETL_TRACEMALLOC; возвращает True если включили
+    if not TRACEMALLOC_ENABLED or tracemalloc.is_tracing():
+        return False
+    tracemalloc.start()
+    return True
+
+
+def stop_memory_probe() -> None:
+    # записывает пик памяти в gauge memory_peak_bytes и выключает tracemalloc
+    if not tracemalloc.is_tracing():
+        return
+    METRICS.set_gauge("memory_peak_bytes", tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+
+# ЭКСПОРТ
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _labels(**labels: str) -> str:
+    body = ",".join(f'{k}="{v}"' for k, v in labels.items())
+    return "{" + body + "}"
+
+
+def to_prometheus(snapshot: Dict[str, Any], job: str) -> str:
+    # текст в формате prometheus textfile collector
+    lines: List[str] = []
+
+    lines.append("# TYPE etl_span_seconds_total counter")
+    for name, s in sorted(snapshot["spans"].items()):
+        lines.append(f"etl_span_seconds_total{_labels(job=job, span=name)} {s['total_seconds']:.6f}")
+    lines.append("# TYPE etl_span_calls_total counter")
+    for name, s in sorted(snapshot["spans"].items()):
+        lines.append(f"etl_span_calls_total{_labels(job=job, span=name)} {s['count']}")
+
+    for name, value in sorted(snapshot["counters"].items()):
+        metric = f"etl_{_metric_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{_labels(job=job)} {value}")
+
+    for name, hist in sorted(snapshot["histograms"].items()):
+        metric = f"etl_{_metric_name(name)}"
+        lines.append(f"# TYPE {metric} histogram")
+        for bound, count in hist["buckets"].items():
+            lines.append(f"{metric}_bucket{_labels(job=job, le=bound)} {count}")
+        lines.append(f"{metric}_bucket{_labels(job=job, le='+Inf')} {hist['count']}")
+        lines.append(f"{metric}_sum{_labels(job=job)} {hist['sum']:.6f}")
+        lines.append(f"{metric}_count{_labels(job=job)} {hist['count']}")
+
+    for name, value in sorted(snapshot["gauges"].items()):
+        metric = f"etl_{_metric_name(name)}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric}{_labels(job=job)} {value}")
+
+    lines.append("# TYPE etl_last_run_duration_seconds gauge")
+    lines.append(f"etl_last_run_duration_seconds{_labels(job=job)} {snapshot['duration_seconds']:.6f}")
+    lines.append("# TYPE etl_last_run_timestamp_seconds gauge")
+    lines.append(f"etl_last_run_timestamp_seconds{_labels(job=job)} {int(time.time())}")
+    return "\n".join(lines) + "\n"
+
+
+def export_run(job: str, metrics_dir: Optional[str] = None, history: bool = True) -> Dict[str, str]:
+    # сохраняет метрики прогона: <job>_<время>.json и etl_<job>.prom (перезаписывается атомарно)
+    # history=False - только etl_<job>.prom (долгоживущий процесс обновляет его после каждого цикла)
+    # возвращает пути к записанным файлам
+    metrics_dir = metrics_dir or METRICS_DIR
+    os.makedirs(metrics_dir, exist_ok=True)
+    snapshot = METRICS.snapshot()
+    snapshot["job"] = job
+    paths = {}
+
+    if history:
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        json_path = os.path.join(metrics_dir, f"{job}_{stamp}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=2)
+        paths["json"] = json_path
+
+    prom_path = os.path.join(metrics_dir, f"etl_{job}.prom")
+    tmp_path = prom_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(to_prometheus(snapshot, job))
+    os.replace(tmp_path, prom_path)
+    paths["prometheus"] = prom_path
+    return paths
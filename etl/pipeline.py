@@ -0,0 +1,178 @@
+# pipeline.py
+
+import argparse
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence
+
+import extract
+from extract import run_extract, get_stale_sources, close_sessions, RAW_SOURCES, STREAM_MODE
+from transform import transform, transform_batches, BATCH_SIZE
+from load import load, close_pool
+from export import export_batches, EXPORT_FORMAT
+from ledger import RunLedger, HistoryDelta, find_resumable, prune, LEDGER_ENABLED
+from records import SalesRow
+from state import open_sales_store
+from simulation import get_simulator
+from snapshots import archive_raw, etl_time_now, ARCHIVE_ENABLED
+from metrics import span, start_memory_probe, stop_memory_probe, export_run
+
+# КОНСТАНТЫ
+
+# сохранять ли сырые ответы в data/raw_*.json как побочный вывод (ETL_SAVE_RAW=0 отключает)
+SAVE_RAW = os.getenv("ETL_SAVE_RAW", "1") != "0"
+
+
+# ФУНКЦИИ
+
+def _extract() -> Optional[Dict[str, Any]]:
+    # сырые данные всех источников в памяти, с etl_time и stale; None если нет каталога товаров
+    with span("pipeline.extract"):
+        raw, latencies = run_extract(sources=RAW_SOURCES)
+    # источники, отданные из последних удачных данных: их факты помечаются is_stale
+    stale = get_stale_sources()
+    for name, seconds in latencies.items():
+        state = "ошибка" if raw[name] is None else f"устарело на {stale[name]:.0f} с" if name in stale else "ок"
+        print(f"[pipeline] {name}: {seconds:.3f} с, {state}")
+
+    if raw.get("products") is None:
+        print("[pipeline] каталог товаров не получен, выходим.")
+        return None
+
+    # один etl_time на весь прогон: им помечаются и записи, и снимки в архиве
+    raw["etl_time"] = etl_time_now()
+    if ARCHIVE_ENABLED:
+        # в архив - только свежие данные, устаревшие уже лежат там под своим etl_time
+        with span("pipeline.archive"):
+            archive_raw({name: data for name, data in raw.items() if name not in stale}, raw["etl_time"])
+    raw["stale"] = stale
+    return raw
+
+
+def _transform(raw: Dict[str, Any], stream: bool, batch_size: int,
+               store=None, simulator=None) -> Iterable[Sequence[SalesRow]]:
+    # пачки записей прогона; в потоковом режиме - генератор, записи считаются по мере чтения
+    if stream:
+        # каталог - список в памяти или путь к файлу (ETL_STREAM=1)
+        return transform_batches(batch_size, raw, store, simulator)
+    with span("pipeline.transform"):
+        records = transform(raw, store, simulator)
+    return [records] if records else []
+
+
+def _ledger_batches(ledger: RunLedger, raw: Dict[str, Any], stream: bool,
+                    batch_size: int) -> Iterator[Sequence[SalesRow]]:
+    # пачки transform идут в load прямо из памяти (в потоковом режиме - по мере чтения каталога),
+    # по пути сохраняясь в журнал; история продаж копится в памяти и пишется в хранилище
+    # после последней пачки, то есть до фиксации загрузки - как этап history
+    # продажи считаются с зерном из журнала: продолжение в другом процессе даёт те же записи
+    delta = HistoryDelta(open_sales_store())
+    try:
+        yield from ledger.save_transform(
+            _transform(raw, stream, batch_size, delta, ledger.simulator()), delta)
+    finally:
+        delta.store.close()
+    print(f"[pipeline] записей: {ledger.record['stages']['transform']['rows']}, "
+          f"изменений истории продаж: {len(delta.delta)}")
+    ledger.apply_history()
+
+
+def _run_with_ledger(ledger: Optional[RunLedger], mode: Optional[str], stream: bool,
+                     batch_size: int) -> bool:
+    # прогон по этапам журнала (ledger.py): каждый этап сохраняет результат до перехода к следующему,
+    # поэтому после сбоя прогон продолжается с первого незавершённого этапа
+    # ledger - продолжаемый прогон или None для нового
+    if ledger is None:
+        raw = _extract()
+        if raw is None:
+            return False
+        ledger = RunLedger.create(raw["etl_time"])
+        ledger.save_extract(raw, seed=get_simulator().seed)
+    else:
+        print(f"[pipeline] продолжаем прогон {ledger.run_id} ({ledger.etl_time}) "
+              f"с этапа {ledger.next_stage()}")
+        raw = ledger.load_extract()
+
+    # пачки читаются из журнала, только если transform уже завершён (продолжение прогона);
+    # если загрузка упадёт раньше, чем пройдёт все пачки, transform при продолжении посчитается заново
+    # с той же историей продаж: в хранилище она пишется только после последней пачки
+    staged: Iterator[Sequence[SalesRow]]
+    if ledger.is_done("transform"):
+        if not ledger.is_done("history"):
+            ledger.apply_history()
+        staged = ledger.iter_batches()
+    else:
+        staged = _ledger_batches(ledger, raw, stream, batch_size)
+
+    batches: Iterable[Sequence[SalesRow]] = staged
+    if EXPORT_FORMAT != "none":
+        batches = export_batches(batches, raw["etl_time"])
+    with span("pipeline.load"):
+        try:
+            ok = load(mode=mode, batches=batches, raw=raw)
+        except Exception as e:
+            ledger.fail("load", str(e))
+            raise
+        finally:
+            # load мог выйти, не дочитав пачки: закрываем генератор вместе с хранилищем истории
+            staged.close()
+    if not ok:
+        ledger.fail("load", "загрузка не зафиксирована")
+        print(f"[pipeline] загрузка не удалась, продолжить: python pipeline.py --resume {ledger.run_id}")
+        return False
+    ledger.complete("load")
+    prune()
+    return True
+
+
+def run_pipeline(mode: Optional[str] = None, stream: Optional[bool] = None,
+                 batch_size: int = BATCH_SIZE, save_raw: Optional[bool] = None,
+                 resume: Optional[str] = None) -> bool:
+    # extract -> transform -> load в одном процессе
+    # сырые данные идут из extract прямо в transform, записи - прямо в load,
+    # поэтому каждый источник разбирается один раз и история продаж обновляется один раз
+    # с журналом (LEDGER_ENABLED) результаты этапов сохраняются, и упавший прогон можно продолжить
+    # mode: режим загрузки (см. load.LOAD_MODE); stream: пачками (см. STREAM_MODE)
+    # save_raw: писать ли data/raw_*.json, по умолчанию SAVE_RAW
+    # resume: продолжить прогон из журнала - его run_id или "last" (последний незавершённый)
+    # возвращает True если загрузка зафиксирована
+    stream = STREAM_MODE if stream is None else stream
+    extract.SAVE_RAW = SAVE_RAW if save_raw is None else save_raw
+
+    if resume is not None:
+        ledger = find_resumable(resume)
+        return ledger is not None and _run_with_ledger(ledger, mode, stream, batch_size)
+    if LEDGER_ENABLED:
+        return _run_with_ledger(None, mode, stream, batch_size)
+
+    raw = _extract()
+    if raw is None:
+        return False
+    batches = _transform(raw, stream, batch_size)
+    if EXPORT_FORMAT != "none":
+        # выгрузка для аналитиков пишется из тех же пачек, что уходят в load
+        batches = export_batches(batches, raw["etl_time"])
+
+    with span("pipeline.load"):
+        return load(mode=mode, batches=batches, raw=raw)
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extract -> transform -> load одним процессом")
+    parser.add_argument("--mode", default=None, help="режим загрузки: row, bulk или parallel")
+    parser.add_argument("--resume", nargs="?", const="last", metavar="RUN_ID",
+                        help="продолжить упавший прогон из журнала (по умолчанию последний)")
+    args = parser.parse_args()
+
+    start_memory_probe()
+    started = time.perf_counter()
+    try:
+        run_pipeline(mode=args.mode, resume=args.resume)
+    finally:
+        close_sessions()
+        close_pool()
+        stop_memory_probe()
+        export_run("pipeline")
+    print(f"[pipeline] общее время: {time.perf_counter() - started:.3f} с")
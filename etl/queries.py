@@ -0,0 +1,311 @@
+# queries.py
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Any, Dict, Hashable, Iterable, List, NamedTuple, Optional, Tuple
+
+import psycopg2
+
+# КОНСТАНТЫ
+
+# сколько секунд результат запроса живёт в кэше (ETL_QUERY_CACHE_TTL), 0 - не кэшировать
+QUERY_CACHE_TTL = float(os.getenv("ETL_QUERY_CACHE_TTL", "300"))
+# сколько результатов держать в кэше, лишние вытесняются по lru (ETL_QUERY_CACHE_MAX)
+QUERY_CACHE_MAX = int(os.getenv("ETL_QUERY_CACHE_MAX", "256"))
+# слушать ли уведомления загрузок из других процессов (ETL_QUERY_LISTEN=0 отключает,
+# тогда кэш сбрасывают только загрузки этого процесса и ttl)
+QUERY_LISTEN = os.getenv("ETL_QUERY_LISTEN", "1") != "0"
+
+# канал NOTIFY: load() шлёт в него группы фактов в своей транзакции, уведомление доходит при commit
+NOTIFY_CHANNEL = "etl_loaded"
+
+
+class NamedQuery(NamedTuple):
+    # sql с именованными параметрами %(имя)s, значения параметров по умолчанию
+    # и группы фактов (load.FACT_GROUPS), после загрузки которых результат устаревает
+    sql: str
+    params: Dict[str, Any]
+    facts: Tuple[str, ...]
+
+
+# типовые вопросы дашбордов к звезде (Script.sql и миграции schema.py)
+QUERIES: Dict[str, NamedQuery] = {
+    # последняя цена каждого товара (или одного product_id)
+    "latest_price": NamedQuery("""
+        SELECT DISTINCT ON (f.product_id)
+               f.product_id, p.title, f.price_usd, f.price_rub, t.etl_time, f.is_stale
+        FROM fact_sales f
+        JOIN dim_time t ON t.time_id = f.time_id
+        JOIN dim_product p ON p.product_id = f.product_id
+        WHERE %(product_id)s IS NULL OR f.product_id = %(product_id)s
+        ORDER BY f.product_id, t.etl_time DESC;
+    """, {"product_id": None}, ("sales",)),
+    # последняя цена каждого товара в валюте currency_code: по курсам цб того же прогона,
+    # (рублей за доллар) / (рублей за единицу валюты); RUB - по курсу доллара
+    "latest_price_in": NamedQuery("""
+        SELECT DISTINCT ON (f.product_id)
+               f.product_id, p.title, %(currency_code)s AS currency_code,
+               ROUND((f.price_usd * usd.rate_cbr / COALESCE(cur.rate_cbr, 1.0))::numeric, 2)::float AS price,
+               t.etl_time, f.is_stale OR usd.is_stale AS is_stale
+        FROM fact_sales f
+        JOIN dim_time t ON t.time_id = f.time_id
+        JOIN dim_product p ON p.product_id = f.product_id
+        JOIN fact_currency usd ON usd.time_id = f.time_id AND usd.etl_date = f.etl_date
+                              AND usd.currency_code = 'USD'
+        LEFT JOIN fact_currency cur ON cur.time_id = f.time_id AND cur.etl_date = f.etl_date
+                                   AND cur.currency_code = %(currency_code)s
+        WHERE (cur.rate_cbr IS NOT NULL OR %(currency_code)s = 'RUB')
+          AND (%(product_id)s IS NULL OR f.product_id = %(product_id)s)
+        ORDER BY f.product_id, t.etl_time DESC;
+    """, {"currency_code": "EUR", "product_id": None}, ("sales", "currency")),
+    # текущий курс валюты цб (рублей за единицу)
+    "currency_rate": NamedQuery("""
+        SELECT f.currency_code, f.rate_cbr, t.etl_time, f.is_stale
+        FROM fact_currency f
+        JOIN dim_time t ON t.time_id = f.time_id
+        WHERE f.currency_code = %(currency_code)s
+        ORDER BY t.etl_time DESC
+        LIMIT 1;
+    """, {"currency_code": "USD"}, ("currency",)),
+    # последняя цена монеты
+    "crypto_price": NamedQuery("""
+        SELECT f.asset_id, a.symbol, f.price_usd, f.change_pct_24h, t.etl_time, f.is_stale
+        FROM fact_crypto_price f
+        JOIN dim_time t ON t.time_id = f.time_id
+        JOIN dim_crypto_asset a ON a.asset_id = f.asset_id
+        WHERE f.asset_id = %(asset_id)s
+        ORDER BY t.etl_time DESC
+        LIMIT 1;
+    """, {"asset_id": "bitcoin"}, ("crypto",)),
+    # последняя температура по точкам погоды
+    "latest_weather": NamedQuery("""
+        SELECT DISTINCT ON (f.location_id) l.location_name, f.temperature, t.etl_time, f.is_stale
+        FROM fact_weather f
+        JOIN dim_time t ON t.time_id = f.time_id
+        JOIN dim_location l ON l.location_id = f.location_id
+        ORDER BY f.location_id, t.etl_time DESC;
+    """, {}, ("weather",)),
+    # продажи по категориям за день (по умолчанию последний загруженный), из роллапа
+    "sales_by_category": NamedQuery("""
+        SELECT r.date, c.category_name, r.fact_count, r.sales_sum, r.revenue_usd_sum
+        FROM rollup_sales_category_day r
+        JOIN dim_category c ON c.category_id = r.category_id
+        WHERE r.date = COALESCE(%(date)s::date, (SELECT MAX(date) FROM rollup_sales_category_day))
+        ORDER BY r.sales_sum DESC;
+    """, {"date": None}, ("sales",)),
+}
+
+
+# КЭШ РЕЗУЛЬТАТОВ
+
+class QueryCache:
+    # результаты именованных запросов: ключ (имя, параметры) -> строки
+    # запись живёт ttl секунд, при переполнении вытесняется давно не использованная (lru)
+    # потокобезопасно: читают дашборды, сбрасывает load() из своего потока
+
+    def __init__(self, ttl: float = QUERY_CACHE_TTL, maxsize: int = QUERY_CACHE_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # растёт при каждом сбросе: результат, запрошенный до сброса, в кэш уже не кладётся
+        self.generation = 0
+        self._lock = threading.Lock()
+        # ключ -> (момент истечения, группы фактов, строки)
+        self._data: "OrderedDict[Hashable, Tuple[float, Tuple[str, ...], Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        # строки по ключу или None (нет, истекли), считает попадания и промахи
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, facts: Tuple[str, ...], rows: Any, generation: int) -> None:
+        # generation - значение self.generation до запроса в базу
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, facts, rows)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, facts: Optional[Iterable[str]] = None) -> int:
+        # выкидывает результаты, зависящие от групп фактов facts (None - все), возвращает их число
+        with self._lock:
+            if facts is None:
+                dropped = list(self._data)
+            else:
+                facts = set(facts)
+                dropped = [key for key, (_, deps, _) in self._data.items() if facts.intersection(deps)]
+            for key in dropped:
+                del self._data[key]
+            self.generation += 1
+            self.invalidations += len(dropped)
+            return len(dropped)
+
+    def clear(self) -> None:
+        self.invalidate()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations}
+
+
+QUERY_CACHE = QueryCache()
+
+# соединение, которое слушает NOTIFY_CHANNEL; False - слушать не удалось, больше не пробуем
+_listener: Any = None
+_listener_lock = threading.Lock()
+
+
+# СБРОС КЭША ПО ЗАГРУЗКАМ
+
+def notify_loaded(conn, time_id: int, facts: Iterable[str]) -> None:
+    # вызывается load() до commit: уведомление уйдёт слушателям только если транзакция зафиксируется
+    payload = json.dumps({"time_id": time_id, "facts": sorted(facts)})
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_notify(%s, %s);", (NOTIFY_CHANNEL, payload))
+
+
+def invalidate(facts: Optional[Iterable[str]] = None) -> int:
+    # сбрасывает в кэше результаты по группам фактов facts (None - все)
+    return QUERY_CACHE.invalidate(facts)
+
+
+def _open_listener() -> Any:
+    # отдельное соединение вне пула в autocommit: LISTEN действует, пока оно открыто
+    from load import DB_PARAMS
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {NOTIFY_CHANNEL};")
+        return conn
+    except psycopg2.Error as e:
+        print(f"[queries] не удалось подписаться на {NOTIFY_CHANNEL} ({e}), кэш живёт только ttl")
+        return False
+
+
+def _drain_notifications() -> None:
+    # забирает пришедшие уведомления загрузок и сбрасывает по ним кэш
+    # poll() только читает то, что уже лежит в сокете, запрос в базу не делается
+    global _listener
+    if not QUERY_LISTEN:
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = _open_listener()
+            # пока подписки не было, загрузки могли пройти незамеченными
+            QUERY_CACHE.clear()
+        if _listener is False:
+            return
+        try:
+            _listener.poll()
+        except psycopg2.Error as e:
+            # подписка потеряна: что пропущено, неизвестно - сбрасываем всё и переподключимся
+            print(f"[queries] подписка на {NOTIFY_CHANNEL} оборвалась: {e}")
+            _listener.close()
+            _listener = None
+            QUERY_CACHE.clear()
+            return
+        while _listener.notifies:
+            note = _listener.notifies.pop(0)
+            try:
+                facts = json.loads(note.payload)["facts"]
+            except (ValueError, KeyError, TypeError):
+                facts = None
+            QUERY_CACHE.invalidate(facts)
+
+
+def close_listener() -> None:
+    global _listener
+    with _listener_lock:
+        if _listener:
+            _listener.close()
+        _listener = None
+
+
+# ЗАПРОСЫ
+
+def _bind(name: str, params: Dict[str, Any]) -> Tuple[NamedQuery, Dict[str, Any]]:
+    # запрос по имени и его параметры с подставленными значениями по умолчанию
+    query = QUERIES.get(name)
+    if query is None:
+        raise ValueError(f"неизвестный запрос: {name} (есть: {', '.join(sorted(QUERIES))})")
+    unknown = set(params) - set(query.params)
+    if unknown:
+        raise ValueError(f"у запроса {name} нет параметров: {', '.join(sorted(unknown))}")
+    return query, dict(query.params, **params)
+
+
+def run_query(conn, name: str, **params: Any) -> List[Tuple[Any, ...]]:
+    # выполняет именованный запрос в соединении conn мимо кэша
+    # строки - namedtuple с именами колонок
+    query, bound = _bind(name, params)
+    with conn.cursor() as cur:
+        cur.execute(query.sql, bound)
+        row_type = namedtuple(f"{name}_row", [col.name for col in cur.description])
+        return [row_type._make(row) for row in cur.fetchall()]
+
+
+def query(name: str, **params: Any) -> List[Tuple[Any, ...]]:
+    # именованный запрос через кэш: между загрузками повторный вызов не ходит в базу
+    # возвращает копию списка строк (сами строки неизменяемые), кэш вызывающий не испортит
+    query_def, bound = _bind(name, params)
+    _drain_notifications()
+    key = (name, tuple(sorted(bound.items())))
+    generation = QUERY_CACHE.generation
+    rows = QUERY_CACHE.get(key)
+    if rows is None:
+        from load import get_pool
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            rows = run_query(conn, name, **params)
+            conn.rollback()
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+        QUERY_CACHE.put(key, query_def.facts, rows, generation)
+    return list(rows)
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    # python queries.py имя [параметр=значение ...]; без имени - список запросов
+    if len(sys.argv) < 2:
+        for name, q in QUERIES.items():
+            print(f"{name}: параметры {q.params or '-'}, зависит от {', '.join(q.facts)}")
+        sys.exit(0)
+    from load import close_pool
+
+    args = dict(arg.split("=", 1) for arg in sys.argv[2:])
+    try:
+        for attempt in ("из базы", "из кэша"):
+            started = time.perf_counter()
+            rows = query(sys.argv[1], **args)
+            print(f"[queries] {sys.argv[1]} {attempt}: строк {len(rows)}, "
+                  f"{(time.perf_counter() - started) * 1000:.2f} мс")
+        for row in rows[:20]:
+            print(row._asdict())
+    finally:
+        close_listener()
+        close_pool()
@@ -0,0 +1,84 @@
+# records.py
+
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+
+# КОНТЕКСТ ПРОГОНА
+
+class RunContext(NamedTuple):
+    # значения, общие для всех товаров прогона: считаются один раз в transform
+    # и передаются в load вместе с пачками, а не копируются в каждую запись
+    etl_time: str
+    cbr_rate: Optional[float]
+    temp_snapshot: Optional[float]
+    btc_price_usd: Optional[float]
+    btc_change_24h: Optional[float]
+    # множители пересчёта цены из долларов в валюты transform.TARGET_CURRENCIES: ((код, множитель), ...)
+    fx: Tuple[Tuple[str, float], ...] = ()
+
+    @classmethod
+    def build(cls, etl_time: str, cbr_rate: Optional[float], temp_snapshot: Optional[float],
+              crypto: Dict[str, Any], fx: Tuple[Tuple[str, float], ...] = ()) -> "RunContext":
+        # crypto - котировка основной монеты из ответа coingecko (может быть пустой)
+        return cls(etl_time, cbr_rate, temp_snapshot,
+                   crypto.get("current_price") if crypto else None,
+                   crypto.get("price_change_percentage_24h") if crypto else None, fx)
+
+
+# ЗАПИСИ ТОВАРОВ
+
+class SalesRow(NamedTuple):
+    # запись одного товара: только то, что у товаров разное
+    # порядок полей совпадает с колонками staging-таблицы load.STAGE_SALES_COLUMNS
+    product_id: Any
+    title: Optional[str]
+    image: Optional[str]
+    category: Optional[str]
+    sales: Optional[int]
+    price_usd: Optional[float]
+    price_rub: Optional[float]
+
+
+class SalesBatch(Sequence):
+    # пачка записей transform: контекст прогона и записи товаров (SalesRow)
+    # колоночный вариант с тем же интерфейсом - columnar.ColumnarRecords
+    __slots__ = ("context", "rows")
+
+    def __init__(self, context: RunContext, rows: Iterable[SalesRow] = ()):
+        self.context = context
+        self.rows: List[SalesRow] = list(rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __iter__(self) -> Iterator[SalesRow]:
+        return iter(self.rows)
+
+
+# СЛОВАРИ ЗАПИСЕЙ
+
+def as_dict(row: SalesRow, context: RunContext) -> Dict[str, Any]:
+    # запись товара в прежнем виде: словарь из 12 ключей вместе с полями прогона
+    return {
+        "product_id":      row.product_id,
+        "title":           row.title,
+        "image":           row.image,
+        "category":        row.category,
+        "sales":           row.sales,
+        "price_usd":       row.price_usd,
+        "price_rub":       row.price_rub,
+        "cbr_usd_rub":     context.cbr_rate,
+        "temp_snapshot":   context.temp_snapshot,
+        "btc_price_usd":   context.btc_price_usd,
+        "btc_change_24h":  context.btc_change_24h,
+        "etl_time":        context.etl_time
+    }
+
+
+def as_dicts(batch: Sequence[SalesRow], context: Optional[RunContext] = None) -> List[Dict[str, Any]]:
+    # пачка (SalesBatch или ColumnarRecords) списком словарей, для просмотра и отладки
+    context = context if context is not None else batch.context
+    return [as_dict(row, context) for row in batch]
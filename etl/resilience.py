@@ -0,0 +1,145 @@
+# resilience.py
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from snapshots import read_snapshot, write_snapshot, dumps_json
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
+
+# КОНСТАНТЫ
+
+# состояние предохранителей и последних удачных данных источников, переживает перезапуск процесса
+SOURCE_HEALTH = os.path.join(DATA_DIR, "source_health.json")
+# куда складываются последние удачные данные источников
+LAST_GOOD_DIR = os.getenv("ETL_LAST_GOOD_DIR", os.path.join(DATA_DIR, "last_good"))
+
+# после стольких неудач подряд предохранитель источника размыкается (ETL_BREAKER_FAILURES)
+BREAKER_FAILURES = int(os.getenv("ETL_BREAKER_FAILURES", "3"))
+# сколько секунд разомкнутый источник не опрашивается, потом пробуем один раз (ETL_BREAKER_COOLDOWN)
+BREAKER_COOLDOWN = float(os.getenv("ETL_BREAKER_COOLDOWN", "300"))
+# данные старше стольких секунд не подставляются вместо свежих (ETL_LAST_GOOD_MAX_AGE)
+LAST_GOOD_MAX_AGE = float(os.getenv("ETL_LAST_GOOD_MAX_AGE", str(24 * 3600)))
+
+_health: Optional[Dict[str, Dict[str, Any]]] = None
+_health_lock = threading.Lock()
+# последние удачные данные в памяти: долгоживущему процессу (daemon.py) не нужно читать их с диска
+_last_good_values: Dict[str, Any] = {}
+
+
+# СОСТОЯНИЕ
+
+def _load_health() -> Dict[str, Dict[str, Any]]:
+    # читает source_health.json один раз за процесс (вызывать под _health_lock)
+    global _health
+    if _health is None:
+        try:
+            with open(SOURCE_HEALTH, "r", encoding="utf-8") as f:
+                _health = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            _health = {}
+        _health.setdefault("breakers", {})
+        _health.setdefault("last_good", {})
+    return _health
+
+
+def _write_health(health: Dict[str, Dict[str, Any]]) -> None:
+    # сохраняет source_health.json через временный файл (вызывать под _health_lock)
+    tmp_path = SOURCE_HEALTH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(health, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, SOURCE_HEALTH)
+
+
+# ПРЕДОХРАНИТЕЛЬ
+
+def breaker_allows(name: str) -> bool:
+    # можно ли сейчас обращаться к источнику name
+    # разомкнутый предохранитель пропускает один пробный запрос, когда истекла пауза
+    with _health_lock:
+        entry = _load_health()["breakers"].get(name, {})
+    open_until = entry.get("open_until")
+    return open_until is None or time.time() >= open_until
+
+
+def breaker_record(name: str, ok: bool) -> None:
+    # учитывает результат обращения к источнику name
+    # неудачный пробный запрос сразу размыкает предохранитель снова: счётчик неудач не сбрасывался
+    with _health_lock:
+        health = _load_health()
+        entry = health["breakers"].setdefault(name, {"failures": 0, "open_until": None})
+        if ok:
+            if entry["failures"] == 0 and entry["open_until"] is None:
+                return
+            entry["failures"] = 0
+            entry["open_until"] = None
+        else:
+            entry["failures"] += 1
+            if entry["failures"] >= BREAKER_FAILURES:
+                entry["open_until"] = time.time() + BREAKER_COOLDOWN
+                print(f"[breaker] {name}: неудач подряд {entry['failures']}, "
+                      f"не опрашиваем {BREAKER_COOLDOWN:g} с")
+        _write_health(health)
+
+
+# ПОСЛЕДНИЕ УДАЧНЫЕ ДАННЫЕ
+
+def _last_good_path(key: str) -> str:
+    return os.path.join(LAST_GOOD_DIR, re.sub(r"[^a-zA-Z0-9_]", "_", key) + ".json.gz")
+
+
+def remember_good(key: str, data: Any) -> None:
+    # запоминает удачный сырой ответ источника key (extract.source_key): в памяти и на диске
+    # файл переписывается только если данные изменились, время получения - всегда
+    # строка - это путь к файлу (потоковый каталог), копию не делаем: файл и так актуален
+    entry: Dict[str, Any] = {"fetched_at": time.time()}
+    if isinstance(data, str):
+        entry["path"] = data
+    else:
+        entry["path"] = _last_good_path(key)
+        entry["sha256"] = hashlib.sha256(dumps_json(data)).hexdigest()
+    with _health_lock:
+        health = _load_health()
+        previous = health["last_good"].get(key, {})
+        if "sha256" in entry and (entry["sha256"] != previous.get("sha256")
+                                  or not os.path.exists(entry["path"])):
+            os.makedirs(LAST_GOOD_DIR, exist_ok=True)
+            write_snapshot(entry["path"], data)
+        _last_good_values[key] = data
+        health["last_good"][key] = entry
+        _write_health(health)
+
+
+def last_good(key: str, max_age: Optional[float] = None) -> Optional[Tuple[Any, float]]:
+    # последний удачный результат key и его возраст в секундах
+    # None если его нет или он старше max_age (по умолчанию LAST_GOOD_MAX_AGE)
+    max_age = LAST_GOOD_MAX_AGE if max_age is None else max_age
+    with _health_lock:
+        entry = dict(_load_health()["last_good"].get(key, {}))
+        data = _last_good_values.get(key)
+    if not entry:
+        return None
+    age = time.time() - entry["fetched_at"]
+    if age > max_age:
+        return None
+    if data is None:
+        path = entry["path"]
+        if not os.path.exists(path):
+            return None
+        if "sha256" not in entry:
+            data = path
+        else:
+            try:
+                data = read_snapshot(path)
+            except (OSError, ValueError) as e:
+                print(f"[last_good] не удалось прочитать {path}: {e}")
+                return None
+    return data, age
@@ -0,0 +1,203 @@
+# rollups.py
+
+import threading
+from typing import Any, Dict, List, Optional
+
+from psycopg2.extras import execute_values
+
+from metrics import timed
+
+# КОНСТАНТЫ
+
+# агрегаты для дашбордов, таблицы создаются миграцией 5 в schema.py
+# загрузка дописывает в них прирост от вставленных ею фактов (apply_rollups),
+# а REBUILD_SQL пересчитывает роллап целиком по таблицам фактов
+# средние хранятся как сумма и число значений, *_avg - вычисляемая колонка
+ROLLUP_DDL = {
+    "rollup_sales_category_day": """
+        CREATE TABLE IF NOT EXISTS rollup_sales_category_day (
+            date DATE NOT NULL,
+            category_id INTEGER NOT NULL REFERENCES dim_category(category_id),
+            fact_count INTEGER NOT NULL,
+            sales_sum BIGINT NOT NULL,
+            revenue_usd_sum DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (date, category_id)
+        );
+    """,
+    "rollup_weather_location_hour": """
+        CREATE TABLE IF NOT EXISTS rollup_weather_location_hour (
+            date DATE NOT NULL,
+            hour INTEGER NOT NULL,
+            location_id INTEGER NOT NULL REFERENCES dim_location(location_id),
+            temperature_sum DOUBLE PRECISION NOT NULL,
+            temperature_count INTEGER NOT NULL,
+            temperature_avg DOUBLE PRECISION
+                GENERATED ALWAYS AS (temperature_sum / NULLIF(temperature_count, 0)) STORED,
+            PRIMARY KEY (date, hour, location_id)
+        );
+    """,
+    "rollup_crypto_asset_hour": """
+        CREATE TABLE IF NOT EXISTS rollup_crypto_asset_hour (
+            date DATE NOT NULL,
+            hour INTEGER NOT NULL,
+            asset_id TEXT NOT NULL REFERENCES dim_crypto_asset(asset_id),
+            price_usd_sum DOUBLE PRECISION NOT NULL,
+            price_count INTEGER NOT NULL,
+            price_usd_avg DOUBLE PRECISION
+                GENERATED ALWAYS AS (price_usd_sum / NULLIF(price_count, 0)) STORED,
+            PRIMARY KEY (date, hour, asset_id)
+        );
+    """,
+}
+
+REBUILD_SQL = {
+    "rollup_sales_category_day": """
+        INSERT INTO rollup_sales_category_day (date, category_id, fact_count, sales_sum, revenue_usd_sum)
+        SELECT f.etl_date, p.category_id, COUNT(*),
+               COALESCE(SUM(f.sales), 0), COALESCE(SUM(f.sales * f.price_usd), 0)
+        FROM fact_sales f
+        JOIN dim_product p ON p.product_id = f.product_id
+        GROUP BY f.etl_date, p.category_id;
+    """,
+    "rollup_weather_location_hour": """
+        INSERT INTO rollup_weather_location_hour (date, hour, location_id, temperature_sum, temperature_count)
+        SELECT t.date, t.hour, f.location_id, SUM(f.temperature), COUNT(*)
+        FROM fact_weather f
+        JOIN dim_time t ON t.time_id = f.time_id
+        WHERE f.temperature IS NOT NULL
+        GROUP BY t.date, t.hour, f.location_id;
+    """,
+    "rollup_crypto_asset_hour": """
+        INSERT INTO rollup_crypto_asset_hour (date, hour, asset_id, price_usd_sum, price_count)
+        SELECT t.date, t.hour, f.asset_id, SUM(f.price_usd), COUNT(*)
+        FROM fact_crypto_price f
+        JOIN dim_time t ON t.time_id = f.time_id
+        WHERE f.price_usd IS NOT NULL
+        GROUP BY t.date, t.hour, f.asset_id;
+    """,
+}
+
+
+class RollupDelta:
+    # прирост роллапов от фактов, вставленных одним прогоном (все они с одним time_id)
+    # потокобезопасно: партиции режима parallel дописывают сюда из своих потоков
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # category_id -> [fact_count, sales_sum, revenue_usd_sum]
+        self.sales: Dict[int, List[float]] = {}
+        # location_id -> [temperature_sum, temperature_count]
+        self.weather: Dict[int, List[float]] = {}
+        # asset_id -> [price_usd_sum, price_count]
+        self.crypto: Dict[str, List[float]] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.sales or self.weather or self.crypto)
+
+    @staticmethod
+    def _add(target: Dict[Any, List[float]], key: Any, values: List[float]) -> None:
+        entry = target.setdefault(key, [0] * len(values))
+        for i, value in enumerate(values):
+            entry[i] += value
+
+    def add_sales(self, category_id: int, fact_count: int, sales_sum: float, revenue_usd_sum: float) -> None:
+        with self._lock:
+            self._add(self.sales, category_id, [fact_count, sales_sum, revenue_usd_sum])
+
+    def add_weather(self, location_id: int, temperature: Optional[float]) -> None:
+        if temperature is None:
+            return
+        with self._lock:
+            self._add(self.weather, location_id, [temperature, 1])
+
+    def add_crypto(self, asset_id: str, price_usd: Optional[float]) -> None:
+        if price_usd is None:
+            return
+        with self._lock:
+            self._add(self.crypto, asset_id, [price_usd, 1])
+
+    def merge(self, other: "RollupDelta") -> None:
+        with self._lock:
+            for target, source in ((self.sales, other.sales), (self.weather, other.weather),
+                                   (self.crypto, other.crypto)):
+                for key, values in source.items():
+                    self._add(target, key, values)
+
+
+# ФУНКЦИИ
+
+@timed("load.apply_rollups")
+def apply_rollups(conn, time_id: int, delta: RollupDelta) -> None:
+    # дописывает прирост в роллапы в транзакции conn (до её commit, вместе с фактами)
+    # строки обновляются в порядке ключа, чтобы параллельные загрузки не ловили взаимных блокировок
+    with conn.cursor() as cur:
+        if delta.sales:
+            execute_values(cur, """
+                INSERT INTO rollup_sales_category_day AS r
+                    (date, category_id, fact_count, sales_sum, revenue_usd_sum)
+                SELECT t.date, v.category_id, v.fact_count, v.sales_sum, v.revenue_usd_sum
+                FROM (VALUES %s) AS v(time_id, category_id, fact_count, sales_sum, revenue_usd_sum)
+                JOIN dim_time t ON t.time_id = v.time_id
+                ORDER BY v.category_id
+                ON CONFLICT (date, category_id) DO UPDATE SET
+                    fact_count = r.fact_count + EXCLUDED.fact_count,
+                    sales_sum = r.sales_sum + EXCLUDED.sales_sum,
+                    revenue_usd_sum = r.revenue_usd_sum + EXCLUDED.revenue_usd_sum;
+            """, [(time_id, key, *values) for key, values in delta.sales.items()],
+                template="(%s::integer, %s::integer, %s::integer, %s::bigint, %s::double precision)")
+        if delta.weather:
+            execute_values(cur, """
+                INSERT INTO rollup_weather_location_hour AS r
+                    (date, hour, location_id, temperature_sum, temperature_count)
+                SELECT t.date, t.hour, v.location_id, v.temperature_sum, v.temperature_count
+                FROM (VALUES %s) AS v(time_id, location_id, temperature_sum, temperature_count)
+                JOIN dim_time t ON t.time_id = v.time_id
+                ORDER BY v.location_id
+                ON CONFLICT (date, hour, location_id) DO UPDATE SET
+                    temperature_sum = r.temperature_sum + EXCLUDED.temperature_sum,
+                    temperature_count = r.temperature_count + EXCLUDED.temperature_count;
+            """, [(time_id, key, *values) for key, values in delta.weather.items()],
+                template="(%s::integer, %s::integer, %s::double precision, %s::integer)")
+        if delta.crypto:
+            execute_values(cur, """
+                INSERT INTO rollup_crypto_asset_hour AS r
+                    (date, hour, asset_id, price_usd_sum, price_count)
+                SELECT t.date, t.hour, v.asset_id, v.price_usd_sum, v.price_count
+                FROM (VALUES %s) AS v(time_id, asset_id, price_usd_sum, price_count)
+                JOIN dim_time t ON t.time_id = v.time_id
+                ORDER BY v.asset_id
+                ON CONFLICT (date, hour, asset_id) DO UPDATE SET
+                    price_usd_sum = r.price_usd_sum + EXCLUDED.price_usd_sum,
+                    price_count = r.price_count + EXCLUDED.price_count;
+            """, [(time_id, key, *values) for key, values in delta.crypto.items()],
+                template="(%s::integer, %s::text, %s::double precision, %s::integer)")
+
+
+def rebuild_rollup(conn, name: str) -> int:
+    # пересчитывает роллап name с нуля по таблицам фактов, возвращает число строк
+    # на время пересчёта роллап заблокирован от приростов параллельных загрузок
+    if name not in REBUILD_SQL:
+        raise ValueError(f"неизвестный роллап: {name}")
+    with conn.cursor() as cur:
+        cur.execute(f"LOCK TABLE {name} IN EXCLUSIVE MODE;")
+        cur.execute(f"DELETE FROM {name};")
+        cur.execute(REBUILD_SQL[name])
+        rows = cur.rowcount
+    conn.commit()
+    return rows
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    import sys
+    import psycopg2
+    from load import DB_PARAMS
+    from schema import ensure_schema
+
+    # python rollups.py [имя роллапа ...] - без аргументов пересчитываются все
+    names = sys.argv[1:] or list(REBUILD_SQL)
+    with psycopg2.connect(**DB_PARAMS) as conn:
+        ensure_schema(conn)
+        for name in names:
+            print(f"[rollups] {name}: пересчитано строк: {rebuild_rollup(conn, name)}")
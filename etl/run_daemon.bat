@@ -0,0 +1,6 @@
+@echo off
+
+cd /d "C:\Users\Huawei\OneDrive\Desktop\kursovaya\ETL_pipline\etl"
+
+rem долгоживущий процесс: каждый источник по своему интервалу (ETL_INTERVALS), остановка - Ctrl+C
+python daemon.py
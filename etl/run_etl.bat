@@ -2,6 +2,5 @@
 
 cd /d "C:\Users\Huawei\OneDrive\Desktop\kursovaya\ETL_pipline\etl"
 
-python extract.py
-python transform.py
-python load.py
+rem extract -> transform -> load в одном процессе, данные передаются в памяти
+python pipeline.py
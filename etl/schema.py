@@ -0,0 +1,260 @@
+# schema.py
+
+import os
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+
+# КОНСТАНТЫ
+
+# базовая схема (версия 1), её же можно накатить вручную через psql
+SCHEMA_SQL = os.path.join(PROJECT_DIR, "Script.sql")
+
+# накатывать ли недостающие миграции в начале load() (ETL_AUTO_MIGRATE=0 отключает)
+AUTO_MIGRATE = os.getenv("ETL_AUTO_MIGRATE", "1") != "0"
+
+# ключ pg_advisory_xact_lock, чтобы две загрузки не мигрировали базу одновременно
+MIGRATION_LOCK_ID = 7_310_015
+
+# таблицы фактов: natural key факта и колонки (кроме fact_id и etl_date)
+# таблицы секционируются по etl_date (дата прогона из dim_time) помесячно
+FACT_TABLES: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    "fact_sales": (("product_id", "time_id"), """
+        product_id INTEGER NOT NULL REFERENCES dim_product(product_id),
+        time_id INTEGER NOT NULL REFERENCES dim_time(time_id),
+        sales INTEGER,
+        price_usd DOUBLE PRECISION,
+        price_rub DOUBLE PRECISION"""),
+    "fact_weather": (("time_id", "location_id"), """
+        time_id INTEGER NOT NULL REFERENCES dim_time(time_id),
+        location_id INTEGER NOT NULL REFERENCES dim_location(location_id),
+        temperature DOUBLE PRECISION"""),
+    "fact_currency": (("time_id", "currency_code"), """
+        time_id INTEGER NOT NULL REFERENCES dim_time(time_id),
+        currency_code TEXT NOT NULL REFERENCES dim_currency(currency_code),
+        rate_cbr DOUBLE PRECISION"""),
+    "fact_crypto_price": (("time_id", "asset_id"), """
+        time_id INTEGER NOT NULL REFERENCES dim_time(time_id),
+        asset_id TEXT NOT NULL REFERENCES dim_crypto_asset(asset_id),
+        price_usd DOUBLE PRECISION,
+        change_pct_24h DOUBLE PRECISION"""),
+}
+
+
+# СЕКЦИИ
+
+def _month_bounds(day: date) -> Tuple[date, date]:
+    start = day.replace(day=1)
+    end = date(start.year + 1, 1, 1) if start.month == 12 else date(start.year, start.month + 1, 1)
+    return start, end
+
+
+def partition_name(table: str, day: date) -> str:
+    return f"{table}_p{day:%Y%m}"
+
+
+def ensure_partitions(conn, day: date, tables: Optional[List[str]] = None) -> None:
+    # создаёт месячные секции фактов для даты day, если их ещё нет
+    # вызывается до вставки фактов: строки вне секций попали бы в секцию default
+    # наличие секций проверяется в базе каждый раз (один запрос к каталогу): запоминать их в процессе
+    # нельзя - create table откатится вместе с транзакцией загрузки, а память процесса нет
+    start, end = _month_bounds(day)
+    tables = tables or FACT_TABLES
+    names = {partition_name(table, start): table for table in tables}
+    with conn.cursor() as cur:
+        cur.execute("SELECT name FROM unnest(%s::text[]) AS name WHERE to_regclass(name) IS NULL;",
+                    (list(names),))
+        for (name,) in cur.fetchall():
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {name} PARTITION OF {names[name]}
+                FOR VALUES FROM (%s) TO (%s);
+            """, (start, end))
+
+
+# МИГРАЦИИ
+
+def _baseline(cur) -> None:
+    # версия 1: таблицы из Script.sql (для уже созданных баз ничего не меняет)
+    with open(SCHEMA_SQL, "r", encoding="utf-8") as f:
+        sql = f.read()
+    sql = sql.replace("CREATE TABLE dim_", "CREATE TABLE IF NOT EXISTS dim_")
+    sql = sql.replace("CREATE TABLE fact_", "CREATE TABLE IF NOT EXISTS fact_")
+    cur.execute(sql)
+
+
+def _unique_dimensions(cur) -> None:
+    # версия 2: уникальные имена категорий и точек погоды
+    # дубликаты, которые могли появиться без ограничения, сводятся к меньшему id
+    cur.execute("""
+        UPDATE dim_product p SET category_id = k.keep_id
+        FROM (
+            SELECT category_id, MIN(category_id) OVER (PARTITION BY category_name) AS keep_id
+            FROM dim_category
+        ) k
+        WHERE p.category_id = k.category_id AND k.category_id <> k.keep_id;
+    """)
+    cur.execute("""
+        DELETE FROM dim_category c USING dim_category k
+        WHERE c.category_name = k.category_name AND c.category_id > k.category_id;
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_category_name_uniq ON dim_category (category_name);")
+
+    cur.execute("""
+        UPDATE fact_weather f SET location_id = k.keep_id
+        FROM (
+            SELECT location_id, MIN(location_id) OVER (PARTITION BY location_name) AS keep_id
+            FROM dim_location
+        ) k
+        WHERE f.location_id = k.location_id AND k.location_id <> k.keep_id;
+    """)
+    cur.execute("""
+        DELETE FROM dim_location l USING dim_location k
+        WHERE l.location_name = k.location_name AND l.location_id > k.location_id;
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_location_name_uniq ON dim_location (location_name);")
+
+
+def _partition_facts(cur) -> None:
+    # версия 3: таблицы фактов секционируются по etl_date, natural key факта уникален
+    # старые строки переносятся (повторы по natural key отбрасываются, остаётся первая),
+    # последовательность fact_id переходит к новой таблице
+    cur.execute("SELECT DISTINCT date_trunc('month', date)::date FROM dim_time;")
+    months = [row[0] for row in cur.fetchall()]
+
+    for table, (key, columns) in FACT_TABLES.items():
+        legacy = f"{table}_legacy"
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'fact_id');", (table,))
+        sequence = cur.fetchone()[0]
+        cur.execute(f"ALTER TABLE {table} RENAME TO {legacy};")
+        cur.execute(f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey;")
+
+        key_cols = ", ".join(key)
+        cur.execute(f"""
+            CREATE TABLE {table} (
+                fact_id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+                {columns.strip()},
+                etl_date DATE NOT NULL,
+                CONSTRAINT {table}_pkey PRIMARY KEY (fact_id, etl_date),
+                CONSTRAINT {table}_natural_key UNIQUE ({key_cols}, etl_date)
+            ) PARTITION BY RANGE (etl_date);
+        """)
+        cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;")
+        for month in months:
+            start, end = _month_bounds(month)
+            cur.execute(f"""
+                CREATE TABLE {partition_name(table, start)} PARTITION OF {table}
+                FOR VALUES FROM (%s) TO (%s);
+            """, (start, end))
+
+        value_cols = [c.strip().split()[0] for c in columns.strip().split(",\n")]
+        cols = ", ".join(value_cols)
+        legacy_cols = ", ".join(f"l.{c}" for c in value_cols)
+        key_order = ", ".join(f"l.{c}" for c in key)
+        cur.execute(f"""
+            INSERT INTO {table} (fact_id, {cols}, etl_date)
+            SELECT DISTINCT ON ({key_order}) l.fact_id, {legacy_cols}, t.date
+            FROM {legacy} l
+            JOIN dim_time t ON t.time_id = l.time_id
+            ORDER BY {key_order}, l.fact_id;
+        """)
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.fact_id;")
+        cur.execute(f"DROP TABLE {legacy};")
+
+
+def _time_range_indexes(cur) -> None:
+    # версия 4: индексы для выборок по диапазону времени
+    # brin по etl_date компактен, а строки фактов и так пишутся в порядке времени
+    for table in FACT_TABLES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_etl_date_brin ON {table} USING BRIN (etl_date);")
+    cur.execute("CREATE INDEX IF NOT EXISTS dim_time_date_idx ON dim_time (date);")
+
+
+def _rollup_tables(cur) -> None:
+    # версия 5: роллапы для дашбордов (rollups.py), заполняются по уже загруженным фактам
+    from rollups import ROLLUP_DDL, REBUILD_SQL
+    for name, ddl in ROLLUP_DDL.items():
+        cur.execute(ddl)
+        cur.execute(REBUILD_SQL[name])
+
+
+def _stale_flags(cur) -> None:
+    # версия 6: признак факта, посчитанного по последним удачным данным источника, а не по свежим
+    # (источник не уложился в бюджет времени прогона или его предохранитель разомкнут, см. resilience.py)
+    for table in FACT_TABLES:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS is_stale BOOLEAN NOT NULL DEFAULT false;")
+
+
+# (версия, описание, функция) по возрастанию версии; новые миграции - только в конец
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "базовая схема Script.sql", _baseline),
+    (2, "уникальные имена категорий и точек погоды", _unique_dimensions),
+    (3, "секционирование фактов по etl_date и уникальный natural key", _partition_facts),
+    (4, "brin-индексы по etl_date и индекс dim_time.date", _time_range_indexes),
+    (5, "роллапы продаж по категориям и дням, погоды и крипто по часам", _rollup_tables),
+    (6, "признак устаревших данных источника у фактов", _stale_flags),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    # версия схемы базы (0 - миграции ещё не накатывались)
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+        return cur.fetchone()[0]
+
+
+def migrate(conn, target: Optional[int] = None) -> List[int]:
+    # накатывает недостающие миграции до target (по умолчанию до последней) одной транзакцией
+    # возвращает номера применённых миграций
+    target = LATEST_VERSION if target is None else target
+    applied: List[int] = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            );
+        """)
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+        version = cur.fetchone()[0]
+        for number, description, apply in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            apply(cur)
+            cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                        (number, description))
+            applied.append(number)
+            print(f"[migrate] применена миграция {number}: {description}")
+    conn.commit()
+    return applied
+
+
+def ensure_schema(conn) -> None:
+    # догоняет схему до последней версии, если это разрешено AUTO_MIGRATE
+    # без миграций загрузка не сможет опереться на уникальные ключи, поэтому останавливаемся
+    if current_version(conn) >= LATEST_VERSION:
+        conn.rollback()
+        return
+    if not AUTO_MIGRATE:
+        raise RuntimeError(f"схема базы устарела, запустите python schema.py "
+                           f"(нужна версия {LATEST_VERSION})")
+    migrate(conn)
+
+
+if __name__ == "__main__":
+    import psycopg2
+    from load import DB_PARAMS
+
+    with psycopg2.connect(**DB_PARAMS) as conn:
+        before = current_version(conn)
+        applied = migrate(conn)
+        print(f"версия схемы: {before} -> {current_version(conn)}"
+              + ("" if applied else " (изменений нет)"))
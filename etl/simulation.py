@@ -0,0 +1,337 @@
+# simulation.py
+
+import argparse
+import bisect
+import hashlib
+import math
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+# numpy ускоряет генерацию, но не обязателен: без него приросты считаются по одному товару
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from snapshots import ETL_TIME_FORMAT
+
+# КОНСТАНТЫ
+
+# зерно генератора продаж (ETL_SALES_SEED): при одном зерне и одних входных данных
+# (каталог, etl_time, история) продажи получаются одни и те же
+# без зерна оно выбирается случайно один раз на процесс и печатается, чтобы прогон можно было повторить
+SALES_SEED = os.getenv("ETL_SALES_SEED")
+# распределение прироста продаж за прогон: "имя:параметр:параметр" (ETL_SALES_DISTRIBUTION)
+# по умолчанию равномерное 1..10, как было у random.randint(1, 10)
+SALES_DISTRIBUTION = os.getenv("ETL_SALES_DISTRIBUTION", "uniform:1:10")
+
+# сколько периодов многопериодной симуляции считается одной матрицей (память: периоды x товары)
+PERIOD_CHUNK = int(os.getenv("ETL_SIMULATION_CHUNK", "64"))
+
+# хвост распределения меньше этой вероятности отбрасывается, таблица не длиннее MAX_TABLE
+TAIL_EPSILON = 1e-12
+MAX_TABLE = 100_000
+
+MASK64 = (1 << 64) - 1
+# шаг и константы перемешивания splitmix64
+GOLDEN64 = 0x9E3779B97F4A7C15
+MIX1 = 0xBF58476D1CE4E5B9
+MIX2 = 0x94D049BB133111EB
+
+_simulator: Optional["SalesSimulator"] = None
+
+
+# РАСПРЕДЕЛЕНИЯ
+
+class Distribution(NamedTuple):
+    # дискретное распределение прироста: значения offset, offset+1, ... с накопленными вероятностями cdf
+    # прирост получается обратной функцией распределения от равномерного u из [0, 1),
+    # поэтому одно и то же u даёт один и тот же прирост и в python, и в numpy
+    name: str
+    offset: int
+    cdf: Tuple[float, ...]
+
+    def sample(self, u: float) -> int:
+        return self.offset + min(bisect.bisect_right(self.cdf, u), len(self.cdf) - 1)
+
+    def sample_array(self, u: "np.ndarray") -> "np.ndarray":
+        idx = np.searchsorted(np.asarray(self.cdf), u, side="right")
+        return self.offset + np.minimum(idx, len(self.cdf) - 1).astype(np.int64)
+
+
+def discrete(name: str, offset: int, pmf: Iterable[float]) -> Distribution:
+    # распределение по вероятностям значений offset, offset+1, ...
+    # вероятности нормируются, хвост после TAIL_EPSILON отбрасывается
+    cdf: List[float] = []
+    total = 0.0
+    for p in pmf:
+        total += p
+        cdf.append(total)
+        if total >= 1.0 - TAIL_EPSILON or len(cdf) >= MAX_TABLE:
+            break
+    if not cdf or total <= 0:
+        raise ValueError(f"распределение {name}: пустая таблица вероятностей")
+    cdf = [c / total for c in cdf]
+    cdf[-1] = 1.0
+    return Distribution(name, offset, tuple(cdf))
+
+
+def uniform(low: float = 1, high: float = 10) -> Distribution:
+    # равномерный прирост от low до high включительно
+    low, high = int(low), int(high)
+    if high < low:
+        raise ValueError(f"uniform: high ({high}) меньше low ({low})")
+    n = high - low + 1
+    return discrete(f"uniform:{low}:{high}", low, [1.0 / n] * n)
+
+
+def _poisson_pmf(lam: float) -> Iterator[float]:
+    p = math.exp(-lam)
+    k = 0
+    while True:
+        yield p
+        k += 1
+        p *= lam / k
+
+
+def poisson(lam: float = 5.0) -> Distribution:
+    # прирост по пуассону со средним lam (бывают и прогоны без продаж)
+    if lam <= 0 or lam > 500:
+        raise ValueError(f"poisson: среднее должно быть в (0, 500], получено {lam}")
+    return discrete(f"poisson:{lam:g}", 0, _poisson_pmf(lam))
+
+
+def _negbinom_pmf(mean: float, dispersion: float) -> Iterator[float]:
+    # p(k) = C(k + r - 1, k) * q^r * (1 - q)^k, q = r / (r + mean)
+    r = dispersion
+    q = r / (r + mean)
+    k = 0
+    while True:
+        yield math.exp(math.lgamma(k + r) - math.lgamma(r) - math.lgamma(k + 1)
+                       + r * math.log(q) + k * math.log1p(-q))
+        k += 1
+
+
+def negbinom(mean: float = 5.0, dispersion: float = 1.0) -> Distribution:
+    # отрицательное биномиальное: среднее mean, разброс больше пуассоновского,
+    # чем меньше dispersion, тем чаще редкие всплески продаж (похоже на реальные продажи)
+    if mean <= 0 or dispersion <= 0:
+        raise ValueError("negbinom: среднее и dispersion должны быть положительными")
+    return discrete(f"negbinom:{mean:g}:{dispersion:g}", 0, _negbinom_pmf(mean, dispersion))
+
+
+# имя -> функция, которая по числовым параметрам строит Distribution
+DISTRIBUTIONS: Dict[str, Callable[..., Distribution]] = {
+    "uniform":  uniform,
+    "poisson":  poisson,
+    "negbinom": negbinom,
+}
+
+
+def register_distribution(name: str, factory: Callable[..., Distribution]) -> None:
+    # добавляет распределение, доступное через ETL_SALES_DISTRIBUTION="name:параметры"
+    # factory принимает параметры числами и возвращает Distribution (удобно через discrete())
+    DISTRIBUTIONS[name] = factory
+
+
+def parse_distribution(spec: str) -> Distribution:
+    # "poisson:4.5" -> Distribution
+    name, *args = spec.strip().split(":")
+    factory = DISTRIBUTIONS.get(name)
+    if factory is None:
+        raise ValueError(f"неизвестное распределение продаж: {name} "
+                         f"(есть: {', '.join(sorted(DISTRIBUTIONS))})")
+    try:
+        params = [float(a) for a in args]
+    except ValueError:
+        raise ValueError(f"параметры распределения должны быть числами: {spec}") from None
+    return factory(*params)
+
+
+# СЛУЧАЙНЫЕ ЧИСЛА
+
+def _mix64(x: int) -> int:
+    # перемешивание splitmix64 для одного числа
+    x = ((x ^ (x >> 30)) * MIX1) & MASK64
+    x = ((x ^ (x >> 27)) * MIX2) & MASK64
+    return x ^ (x >> 31)
+
+
+def _mix64_array(x: "np.ndarray") -> "np.ndarray":
+    # то же для массива uint64 (переполнение при умножении - как & MASK64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(MIX1)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(MIX2)
+    return x ^ (x >> np.uint64(31))
+
+
+def run_key(seed: Any, etl_time: str) -> int:
+    # 64-битный ключ прогона: зерно + etl_time, у каждого прогона свой поток чисел
+    digest = hashlib.blake2b(f"{seed}|{etl_time}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def product_key(prod_id: Any) -> int:
+    # 64-битный ключ товара: целый id как есть, остальные - по хешу строки
+    if isinstance(prod_id, int) and not isinstance(prod_id, bool):
+        return prod_id & MASK64
+    digest = hashlib.blake2b(str(prod_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _product_key_array(ids: Any) -> "np.ndarray":
+    if isinstance(ids, np.ndarray) and ids.dtype.kind in "iu":
+        return ids.astype(np.uint64)
+    return np.fromiter((product_key(i) for i in ids), dtype=np.uint64, count=len(ids))
+
+
+def uniforms(keys: "np.ndarray", run_keys: "np.ndarray") -> "np.ndarray":
+    # равномерные u из [0, 1) для товаров keys (n,) и прогонов run_keys (p, 1) -> матрица (p, n)
+    # u зависит только от ключей товара и прогона, а не от порядка товаров и размера пачки:
+    # это позиция keys в потоке splitmix64, начатом с run_key
+    x = _mix64_array(run_keys + keys * np.uint64(GOLDEN64))
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+# СИМУЛЯТОР ПРОДАЖ
+
+class SalesSimulator:
+    # прирост продаж товаров за прогон: детерминирован по (зерно, etl_time, id товара),
+    # считается сразу для всей пачки и сразу для многих прогонов (simulate)
+
+    def __init__(self, seed: Any = None, distribution: Any = None):
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(63)
+        spec = distribution or SALES_DISTRIBUTION
+        self.distribution = parse_distribution(spec) if isinstance(spec, str) else spec
+
+    def increments(self, ids: Sequence[Any], etl_time: str) -> List[int]:
+        # приросты товаров ids за прогон etl_time списком python-чисел (для build_row)
+        if np is not None:
+            return self.increment_array(ids, etl_time).tolist()
+        rk = run_key(self.seed, etl_time)
+        sample = self.distribution.sample
+        return [sample((_mix64((rk + product_key(i) * GOLDEN64) & MASK64) >> 11) * 2.0 ** -53)
+                for i in ids]
+
+    def increment_array(self, ids: Any, etl_time: str) -> "np.ndarray":
+        # то же массивом int64 (для columnar.build_columns)
+        return self.simulate_increments(ids, [etl_time])[0]
+
+    def simulate_increments(self, ids: Any, etl_times: Sequence[str]) -> "np.ndarray":
+        # приросты за несколько прогонов сразу: матрица (прогоны, товары)
+        # строка i совпадает с тем, что дал бы одиночный прогон etl_times[i]
+        if np is None:
+            raise RuntimeError("для пакетной симуляции продаж нужен пакет numpy")
+        keys = _product_key_array(ids)
+        run_keys = np.array([run_key(self.seed, t) for t in etl_times], dtype=np.uint64)[:, None]
+        return self.distribution.sample_array(uniforms(keys[None, :], run_keys))
+
+    def simulate(self, ids: Any, prev_sales: Any, etl_times: Sequence[str]) -> "np.ndarray":
+        # продажи после каждого из прогонов etl_times: prev_sales + накопленные приросты,
+        # матрица (прогоны, товары); повторы id внутри каталога здесь не накапливаются
+        increments = self.simulate_increments(ids, etl_times)
+        return np.asarray(prev_sales, dtype=np.int64)[None, :] + np.cumsum(increments, axis=0)
+
+
+def get_simulator() -> SalesSimulator:
+    # симулятор процесса по ETL_SALES_SEED и ETL_SALES_DISTRIBUTION, создаётся один раз
+    global _simulator
+    if _simulator is None:
+        _simulator = SalesSimulator(SALES_SEED)
+        if SALES_SEED is None:
+            print(f"[simulation] ETL_SALES_SEED не задан, зерно продаж: {_simulator.seed}")
+    return _simulator
+
+
+# ИСТОРИЯ ДЛЯ НАГРУЗОЧНЫХ ТЕСТОВ
+
+def run_times(start: str, periods: int, step: int) -> List[str]:
+    # etl_time прогонов: start, start + step секунд, ...
+    first = datetime.strptime(start, ETL_TIME_FORMAT)
+    return [(first + timedelta(seconds=step * i)).strftime(ETL_TIME_FORMAT) for i in range(periods)]
+
+
+def simulate_runs(products: Sequence[Dict[str, Any]], etl_times: Sequence[str],
+                  cbr_rate: Optional[float], sales_history: Optional[Dict[str, int]] = None,
+                  simulator: Optional[SalesSimulator] = None,
+                  chunk: int = PERIOD_CHUNK, fx: Tuple[Tuple[str, float], ...] = ()) -> Iterator[Any]:
+    # пачки записей (columnar.ColumnarRecords) для прогонов etl_times по одному каталогу:
+    # продажи считаются матрицей по chunk прогонов сразу, колонки товаров собираются один раз
+    # продажи те же, что дали бы прогоны transform с тем же зерном (при каталоге без повторов id)
+    # sales_history: продажи до первого прогона, в конце в нём остаются продажи после последнего
+    # fx: множители пересчёта цен в валюты, как RunContext.fx
+    from columnar import product_columns, rub_prices, SalesHistoryArray, ColumnarRecords
+    from records import RunContext
+
+    simulator = simulator or get_simulator()
+    history = sales_history if sales_history is not None else {}
+    ids, base_sales, prices, titles, images, categories = product_columns(products)
+    prev = SalesHistoryArray.from_dict(history).lookup(ids, base_sales)
+    price_rub = rub_prices(prices, cbr_rate) if cbr_rate else None
+    for start in range(0, len(etl_times), chunk):
+        times = etl_times[start:start + chunk]
+        sales = simulator.simulate(ids, prev, times)
+        for etl_time, row in zip(times, sales):
+            context = RunContext(etl_time, cbr_rate, None, None, None, fx)
+            yield ColumnarRecords(context, ids, titles, images, categories, row, prices, price_rub)
+        prev = sales[-1]
+    history.update(zip(map(str, ids.tolist()), prev.tolist()))
+
+
+# ГЛАВНЫЙ БЛОК
+
+if __name__ == "__main__":
+    from transform import load_json, parse_cbr_rates, fx_factors, RAW_PRODUCTS, RAW_CBR
+
+    parser = argparse.ArgumentParser(description="история продаж за много прогонов для нагрузочных тестов")
+    parser.add_argument("--periods", type=int, default=24 * 30, help="число прогонов")
+    parser.add_argument("--step", type=int, default=3600, help="секунд между прогонами")
+    parser.add_argument("--start", help="etl_time первого прогона 'YYYY-MM-DD HH:MM:SS', "
+                                        "по умолчанию так, чтобы последний был сейчас")
+    parser.add_argument("--seed", default=SALES_SEED, help="зерно, по умолчанию ETL_SALES_SEED")
+    parser.add_argument("--distribution", default=None, help="например poisson:5 или negbinom:5:0.8")
+    parser.add_argument("--products", default=RAW_PRODUCTS, help="каталог товаров (json)")
+    parser.add_argument("--load", dest="mode", help="грузить в хранилище режимом row, bulk или parallel "
+                                                    "(только факты продаж; лучше в отдельную базу)")
+    parser.add_argument("--export", action="store_true", help="выгружать прогоны в parquet/arrow (export.py)")
+    args = parser.parse_args()
+
+    products = load_json(args.products)
+    raw_cbr = load_json(RAW_CBR)
+    if not products:
+        raise SystemExit("[simulation] нет каталога товаров")
+    start = args.start or (datetime.now() - timedelta(seconds=args.step * (args.periods - 1))
+                           ).strftime(ETL_TIME_FORMAT)
+    simulator = SalesSimulator(args.seed, args.distribution)
+    print(f"[simulation] товаров: {len(products)}, прогонов: {args.periods}, "
+          f"зерно: {simulator.seed}, распределение: {simulator.distribution.name}")
+
+    if args.mode:
+        from load import load, close_pool
+    if args.export:
+        from export import export_records, EXPORT_FORMAT
+        fmt = EXPORT_FORMAT if EXPORT_FORMAT != "none" else "parquet"
+
+    started = time.perf_counter()
+    generated = 0.0
+    rows = 0
+    rates = parse_cbr_rates(raw_cbr)
+    runs = simulate_runs(products, run_times(start, args.periods, args.step),
+                         rates.get("USD"), simulator=simulator, fx=fx_factors(rates))
+    try:
+        for i in range(args.periods):
+            t0 = time.perf_counter()
+            batch = next(runs)
+            generated += time.perf_counter() - t0
+            rows += len(batch)
+            if args.export:
+                export_records(batch, batch.context.etl_time, fmt)
+            if args.mode:
+                load(mode=args.mode, batches=[batch], facts=["sales"])
+    finally:
+        if args.mode:
+            close_pool()
+    print(f"[simulation] записей: {rows}, генерация: {generated:.3f} с, "
+          f"всего: {time.perf_counter() - started:.3f} с")
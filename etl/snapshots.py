@@ -0,0 +1,277 @@
+# snapshots.py
+
+import gzip
+import io
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, IO, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+# необязательные ускорители: без них работаем на стандартном json и gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
+
+# КОНСТАНТЫ
+
+# архив сырых снимков: data/snapshots/date=YYYY-MM-DD/hour=HH/<источник>_<время>.<формат>
+SNAPSHOT_DIR = os.getenv("ETL_SNAPSHOT_DIR", os.path.join(DATA_DIR, "snapshots"))
+# складывать ли каждый прогон в архив (ETL_SNAPSHOT_ARCHIVE=0 отключает)
+ARCHIVE_ENABLED = os.getenv("ETL_SNAPSHOT_ARCHIVE", "1") != "0"
+# кодирование снимка: "json" (компактный, через orjson если установлен) или "msgpack"
+SNAPSHOT_FORMAT = os.getenv("ETL_SNAPSHOT_FORMAT", "json")
+# сжатие снимка: "gzip", "zstd" или "none"
+SNAPSHOT_COMPRESSION = os.getenv("ETL_SNAPSHOT_COMPRESSION", "gzip")
+
+# формат etl_time во всех модулях и часовой пояс, в котором он считается
+ETL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+ETL_TIMEZONE = "Asia/Vladivostok"
+
+FORMAT_EXT = {"json": ".json", "msgpack": ".msgpack"}
+COMPRESSION_EXT = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+# ВРЕМЯ
+
+def etl_time_now() -> str:
+    # текущее время во Владивостоке в формате etl_time
+    try:
+        now_vl = datetime.now(ZoneInfo(ETL_TIMEZONE))
+    except Exception:
+        from datetime import timezone, timedelta
+        now_utc = datetime.now(timezone.utc)
+        now_vl = now_utc + timedelta(hours=10)
+    return now_vl.strftime(ETL_TIME_FORMAT)
+
+
+# КОДИРОВАНИЕ
+
+def dumps_json(data: Any) -> bytes:
+    # компактный json без отступов; orjson быстрее, но не умеет, например, числа больше 64 бит
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            pass
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(raw: bytes) -> Any:
+    # ошибки разбора в обоих случаях - json.JSONDecodeError
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _encode(data: Any, fmt: str) -> bytes:
+    if fmt == "json":
+        return dumps_json(data)
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("для формата msgpack нужен пакет msgpack")
+        return msgpack.packb(data, use_bin_type=True)
+    raise ValueError(f"неизвестный формат снимка: {fmt}")
+
+
+def _decode(raw: bytes, fmt: str) -> Any:
+    if fmt == "json":
+        return loads_json(raw)
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("для чтения msgpack-снимка нужен пакет msgpack")
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    raise ValueError(f"неизвестный формат снимка: {fmt}")
+
+
+def _split_ext(path: str) -> Tuple[str, str]:
+    # (формат, сжатие) по расширению файла: raw.json, x.json.gz, x.msgpack.zst ...
+    name = os.path.basename(path)
+    compression = "none"
+    for comp, ext in COMPRESSION_EXT.items():
+        if ext and name.endswith(ext):
+            compression = comp
+            name = name[:-len(ext)]
+            break
+    fmt = next((f for f, ext in FORMAT_EXT.items() if name.endswith(ext)), "json")
+    return fmt, compression
+
+
+def _open_binary(path: str, mode: str, compression: str) -> BinaryIO:
+    # файл с прозрачным сжатием/распаковкой
+    if compression == "gzip":
+        return gzip.open(path, mode + "b", compresslevel=6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("для сжатия zstd нужен пакет zstandard")
+        raw = open(path, mode + "b")
+        if mode == "r":
+            return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=True)
+    if compression == "none":
+        return open(path, mode + "b")
+    raise ValueError(f"неизвестное сжатие снимка: {compression}")
+
+
+# ЧТЕНИЕ И ЗАПИСЬ ФАЙЛОВ
+
+def read_snapshot(path: str) -> Any:
+    # читает снимок любого поддерживаемого вида, формат определяется по расширению
+    fmt, compression = _split_ext(path)
+    with _open_binary(path, "r", compression) as f:
+        return _decode(f.read(), fmt)
+
+
+def open_text(path: str) -> IO[str]:
+    # текстовый поток json-снимка (в том числе сжатого) для потокового разбора
+    fmt, compression = _split_ext(path)
+    if fmt != "json":
+        raise ValueError(f"{path}: потоково читается только json")
+    return io.TextIOWrapper(_open_binary(path, "r", compression), encoding="utf-8")
+
+
+def write_snapshot(path: str, data: Any, fmt: Optional[str] = None,
+                   compression: Optional[str] = None) -> str:
+    # пишет data в path через временный файл; формат и сжатие - из аргументов или по расширению
+    ext_fmt, ext_compression = _split_ext(path)
+    return write_encoded(path, _encode(data, fmt or ext_fmt), compression or ext_compression)
+
+
+def write_encoded(path: str, body: bytes, compression: Optional[str] = None) -> str:
+    # то же для уже закодированных данных (например, dumps_json): сжатие - из аргумента или по расширению
+    compression = compression or _split_ext(path)[1]
+    tmp_path = path + ".tmp"
+    with _open_binary(tmp_path, "w", compression) as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    return path
+
+
+# АРХИВ
+
+def _partition_dir(etl_time: str, root: str) -> str:
+    dt = datetime.strptime(etl_time, ETL_TIME_FORMAT)
+    return os.path.join(root, f"date={dt:%Y-%m-%d}", f"hour={dt:%H}")
+
+
+def snapshot_path(source: str, etl_time: str, fmt: Optional[str] = None,
+                  compression: Optional[str] = None, root: Optional[str] = None) -> str:
+    # путь снимка источника source за прогон etl_time в архиве
+    fmt = fmt or SNAPSHOT_FORMAT
+    compression = compression or SNAPSHOT_COMPRESSION
+    dt = datetime.strptime(etl_time, ETL_TIME_FORMAT)
+    name = f"{source}_{dt:%Y%m%dT%H%M%S}{FORMAT_EXT[fmt]}{COMPRESSION_EXT[compression]}"
+    return os.path.join(_partition_dir(etl_time, root or SNAPSHOT_DIR), name)
+
+
+def archive_snapshot(source: str, data: Any, etl_time: str, fmt: Optional[str] = None,
+                     compression: Optional[str] = None, root: Optional[str] = None) -> str:
+    # кладёт сырые данные источника в архив под etl_time, возвращает путь
+    # если data - путь к json-файлу (потоковый каталог), файл копируется без разбора
+    if isinstance(data, str):
+        return archive_file(source, data, etl_time, compression, root)
+    path = snapshot_path(source, etl_time, fmt, compression, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return write_snapshot(path, data, fmt or SNAPSHOT_FORMAT, compression or SNAPSHOT_COMPRESSION)
+
+
+def archive_file(source: str, src_path: str, etl_time: str,
+                 compression: Optional[str] = None, root: Optional[str] = None) -> str:
+    # копирует json-файл в архив кусками (со сжатием), память не зависит от размера файла
+    compression = compression or SNAPSHOT_COMPRESSION
+    path = snapshot_path(source, etl_time, "json", compression, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(src_path, "rb") as src, _open_binary(tmp_path, "w", compression) as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    os.replace(tmp_path, path)
+    return path
+
+
+def archive_raw(raw: Dict[str, Any], etl_time: str, root: Optional[str] = None) -> Dict[str, str]:
+    # архивирует все источники прогона (None - источник не загрузился, пропускаем)
+    # etl_time и stale (см. pipeline.py) - сведения о прогоне, а не источники
+    # возвращает пути по имени источника
+    paths = {}
+    for source, data in raw.items():
+        if data is None or source in ("etl_time", "stale"):
+            continue
+        try:
+            paths[source] = archive_snapshot(source, data, etl_time, root=root)
+        except (OSError, RuntimeError, ValueError, TypeError) as e:
+            print(f"[archive_raw] не удалось сохранить снимок {source}: {e}")
+    return paths
+
+
+def _parse_name(name: str) -> Optional[Tuple[str, str]]:
+    # "<источник>_<YYYYMMDDTHHMMSS>.<ext>" -> (источник, etl_time)
+    base = name.split(".", 1)[0]
+    source, _, stamp = base.rpartition("_")
+    try:
+        dt = datetime.strptime(stamp, "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None
+    return source, dt.strftime(ETL_TIME_FORMAT)
+
+
+def list_snapshots(source: Optional[str] = None, start: Optional[str] = None,
+                   end: Optional[str] = None, root: Optional[str] = None) -> List[Tuple[str, str, str]]:
+    # снимки архива как (etl_time, источник, путь), по возрастанию etl_time
+    # start/end - границы etl_time включительно; партиции вне диапазона не обходятся
+    # end в виде даты (YYYY-MM-DD) включает весь день
+    root = root or SNAPSHOT_DIR
+    if end and len(end) == 10:
+        end += " 23:59:59"
+    if not os.path.isdir(root):
+        return []
+    start_date = start[:10] if start else None
+    end_date = end[:10] if end else None
+    found = []
+    for date_dir in sorted(os.listdir(root)):
+        day = date_dir.partition("=")[2]
+        if (start_date and day < start_date) or (end_date and day > end_date):
+            continue
+        for dirpath, _, files in os.walk(os.path.join(root, date_dir)):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                parsed = _parse_name(name)
+                if parsed is None:
+                    continue
+                src, etl_time = parsed
+                if source and src != source:
+                    continue
+                if (start and etl_time < start) or (end and etl_time > end):
+                    continue
+                found.append((etl_time, src, os.path.join(dirpath, name)))
+    found.sort()
+    return found
+
+
+def load_run(etl_time: str, root: Optional[str] = None) -> Dict[str, Any]:
+    # все снимки одного прогона в виде raw для transform(raw=...)
+    # каталог товаров не разбирается, отдаётся путь к снимку (transform_batches читает его потоково)
+    raw: Dict[str, Any] = {"etl_time": etl_time}
+    for _, source, path in list_snapshots(start=etl_time, end=etl_time, root=root):
+        if source == "products" and _split_ext(path)[0] == "json":
+            raw[source] = path
+        else:
+            raw[source] = read_snapshot(path)
+    return raw
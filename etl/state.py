@@ -0,0 +1,220 @@
+# state.py
+
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Optional
+
+# вычисляем пути к файлам относительно корня проекта
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+DATA_DIR = os.path.join(PROJECT_DIR, "data")
+
+# КОНСТАНТЫ
+
+# старый формат: весь словарь продаж в одном json-файле
+SALES_HISTORY = os.path.join(DATA_DIR, "sales_history.json")
+# отпечатки атрибутов товаров для json-хранилища
+PRODUCT_FINGERPRINTS = os.path.join(DATA_DIR, "product_fingerprints.json")
+# новый формат: sqlite в режиме wal, одна строка на товар
+SALES_STATE_DB = os.path.join(DATA_DIR, "sales_state.sqlite3")
+
+# хранилище состояния продаж: "sqlite" (по умолчанию) или "json" (старый файл целиком)
+STATE_BACKEND = os.getenv("ETL_STATE_BACKEND", "sqlite")
+
+# сколько ключей отправляем в одном select ... in (...)
+SQLITE_BATCH = 500
+
+
+# ХРАНИЛИЩА
+
+def _read_json_dict(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        print(f"[JsonSalesStore] ошибка: не удалось декодировать {path} как json")
+        return {}
+    if not isinstance(data, dict):
+        print(f"[JsonSalesStore] {os.path.basename(path)} не dict, используем пустой словарь")
+        return {}
+    return data
+
+
+def _write_json_dict(path: str, data: Dict[str, Any]) -> None:
+    # сохраняем через временный файл, чтобы не оставить полузаписанный файл
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+class JsonSalesStore:
+    # старое поведение: словарь целиком в памяти, файл целиком перезаписывается при commit
+
+    def __init__(self, path: Optional[str] = None, fingerprints_path: Optional[str] = None):
+        # пути по умолчанию читаются при создании, чтобы их можно было переопределить в модуле
+        self.path = path or SALES_HISTORY
+        self.fingerprints_path = fingerprints_path or PRODUCT_FINGERPRINTS
+        self._data = _read_json_dict(self.path)
+        self._fingerprints: Optional[Dict[str, str]] = None
+        self._dirty = False
+        self._fingerprints_dirty = False
+
+    def all(self) -> Dict[str, int]:
+        return dict(self._data)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, int]:
+        return {k: self._data[k] for k in keys if k in self._data}
+
+    def put_many(self, values: Dict[str, int]) -> None:
+        self._data.update(values)
+        self._dirty = True
+
+    def get_fingerprints(self, keys: Iterable[str]) -> Dict[str, str]:
+        # отпечатки читаются лениво: transform они не нужны
+        if self._fingerprints is None:
+            self._fingerprints = _read_json_dict(self.fingerprints_path)
+        return {k: self._fingerprints[k] for k in keys if k in self._fingerprints}
+
+    def put_fingerprints(self, values: Dict[str, str]) -> None:
+        if self._fingerprints is None:
+            self._fingerprints = _read_json_dict(self.fingerprints_path)
+        self._fingerprints.update(values)
+        self._fingerprints_dirty = True
+
+    def commit(self) -> None:
+        try:
+            if self._dirty:
+                _write_json_dict(self.path, self._data)
+                self._dirty = False
+            if self._fingerprints_dirty:
+                _write_json_dict(self.fingerprints_path, self._fingerprints)
+                self._fingerprints_dirty = False
+        except IOError as e:
+            print(f"[JsonSalesStore] ошибка записи истории продаж: {e}")
+
+    def rollback(self) -> None:
+        self._data = _read_json_dict(self.path)
+        self._fingerprints = None
+        self._dirty = False
+        self._fingerprints_dirty = False
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteSalesStore:
+    # история продаж в sqlite: чтение и запись только тех товаров, что есть в текущей пачке
+    # изменения видны на диске только после commit (одна транзакция на прогон)
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or SALES_STATE_DB
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sales_state (
+                product_id TEXT PRIMARY KEY,
+                sales INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS product_fingerprint (
+                product_id TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS state_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.conn.commit()
+
+    def _select_many(self, table: str, column: str, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(dict.fromkeys(keys))
+        result: Dict[str, Any] = {}
+        for i in range(0, len(keys), SQLITE_BATCH):
+            chunk = keys[i:i + SQLITE_BATCH]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT product_id, {column} FROM {table} WHERE product_id IN ({placeholders});",
+                chunk)
+            result.update(rows)
+        return result
+
+    def _upsert_many(self, table: str, column: str, values: Dict[str, Any]) -> None:
+        self.conn.executemany(f"""
+            INSERT INTO {table} (product_id, {column}) VALUES (?, ?)
+            ON CONFLICT (product_id) DO UPDATE SET {column} = excluded.{column};
+        """, values.items())
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, int]:
+        return self._select_many("sales_state", "sales", keys)
+
+    def put_many(self, values: Dict[str, int]) -> None:
+        self._upsert_many("sales_state", "sales", values)
+
+    def get_fingerprints(self, keys: Iterable[str]) -> Dict[str, str]:
+        # отпечатки атрибутов товаров, записанные в dim_product прошлыми загрузками
+        return self._select_many("product_fingerprint", "fingerprint", keys)
+
+    def put_fingerprints(self, values: Dict[str, str]) -> None:
+        self._upsert_many("product_fingerprint", "fingerprint", values)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM state_meta WHERE key = ?;", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self.conn.execute("""
+            INSERT INTO state_meta (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+        """, (key, value))
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def rollback(self) -> None:
+        self.conn.rollback()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# МИГРАЦИЯ
+
+def migrate_json_history(store: SqliteSalesStore, json_path: Optional[str] = None) -> int:
+    # разовый перенос sales_history.json в sqlite
+    # повторный вызов ничего не делает (отметка в state_meta)
+    # возвращает число перенесённых товаров
+    json_path = json_path or SALES_HISTORY
+    if store.get_meta("migrated_from_json") is not None:
+        return 0
+    moved = 0
+    if os.path.exists(json_path):
+        data: Dict[str, Any] = JsonSalesStore(json_path).all()
+        store.put_many({str(k): int(v) for k, v in data.items()})
+        moved = len(data)
+    store.set_meta("migrated_from_json", json_path)
+    store.commit()
+    if moved:
+        print(f"[migrate_json_history] перенесено товаров из {json_path}: {moved}")
+    return moved
+
+
+def open_sales_store(backend: Optional[str] = None):
+    # открывает хранилище состояния продаж выбранного типа
+    # при первом открытии sqlite переносит в него старый sales_history.json
+    backend = (backend or STATE_BACKEND).lower()
+    if backend == "json":
+        return JsonSalesStore()
+    if backend == "sqlite":
+        store = SqliteSalesStore()
+        migrate_json_history(store)
+        return store
+    raise ValueError(f"неизвестное хранилище состояния: {backend}")
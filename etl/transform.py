@@ -1,9 +1,11 @@
 import json
 import os
-import random
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from typing import Optional, List, Dict, Any
+from state import open_sales_store
+from records import RunContext, SalesRow, SalesBatch, as_dicts
+from simulation import SalesSimulator, get_simulator
+from snapshots import read_snapshot, open_text, etl_time_now
+from metrics import timed, span, inc, start_memory_probe, stop_memory_probe, export_run
+from typing import Optional, List, Dict, Any, Iterator, Sequence, Tuple
 
 # вычисляем пути к файлам относительно корня проекта
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -16,53 +18,131 @@ RAW_PRODUCTS = os.path.join(DATA_DIR, "raw_products.json")
 RAW_CBR = os.path.join(DATA_DIR, "raw_cbr.json")
 RAW_WEATHER = os.path.join(DATA_DIR, "raw_weather.json")
 RAW_CRYPTO = os.path.join(DATA_DIR, "raw_crypto.json")
-SALES_HISTORY = os.path.join(DATA_DIR, "sales_history.json")
+
+# потоковый режим: товары читаются из файла по одному и отдаются пачками (ETL_STREAM=1)
+STREAM_MODE = os.getenv("ETL_STREAM", "0") == "1"
+# сколько записей в одной пачке в потоковом режиме
+BATCH_SIZE = int(os.getenv("ETL_BATCH_SIZE", "1000"))
+# сколько символов читаем из файла за раз при потоковом разборе
+READ_CHUNK_SIZE = 64 * 1024
+
+# валюты, в которые пересчитываются цены товаров (коды цб через запятую, ETL_TARGET_CURRENCIES)
+# цена в рублях считается всегда (price_rub), эти - в выгрузке export.py колонками price_<код>
+TARGET_CURRENCIES = tuple(code.strip().upper()
+                          for code in os.getenv("ETL_TARGET_CURRENCIES", "EUR,CNY").split(",") if code.strip())
+
+# движок трансформации: "python" - build_row по одному товару,
+# "columnar" - колоночный расчёт на numpy (ETL_ENGINE=columnar)
+ENGINE = os.getenv("ETL_ENGINE", "python")
+
+# прогон (etl_time), о валютах без курса в котором уже предупредили (fx_factors)
+_fx_warned_run: Optional[str] = None
 
 
 # ФУНКЦИИ
 
+@timed("transform.load_json")
 def load_json(path: str) -> Any:
     # загружает json из файла path, или возвращает none и предупреждение если не удалось
+    # понимает и снимки из архива (snapshots.py): .json.gz, .json.zst, .msgpack...
     if not os.path.exists(path):
         print(f"[load_json] файл {path} не найден")
         return None
+    inc("json_bytes_read", os.path.getsize(path))
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
+        return read_snapshot(path)
+    except ValueError:
         print(f"[load_json] ошибка: не удалось декодировать {path} как json")
         return None
 
 
-def build_record(
+def iter_json_array(path: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[Any]:
+    # разбирает json-массив верхнего уровня из файла по одному элементу
+    # в памяти держится только текущий кусок файла и текущий элемент
+    decoder = json.JSONDecoder()
+    with open_text(path) as f:
+        buf = ""
+        pos = 0
+        eof = False
+        started = False
+        expect_item = True
+
+        while True:
+            # пропускаем пробелы, при необходимости дочитываем файл
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                chunk = f.read(chunk_size)
+                buf, pos = buf[pos:] + chunk, 0
+                eof = not chunk
+
+            if pos >= len(buf):
+                raise ValueError(f"{path}: неожиданный конец файла")
+
+            ch = buf[pos]
+            if not started:
+                if ch != "[":
+                    raise ValueError(f"{path}: ожидался json-массив")
+                started = True
+                pos += 1
+                continue
+            if ch == "]":
+                return
+            if not expect_item:
+                if ch != ",":
+                    raise ValueError(f"{path}: ожидалась запятая между элементами")
+                expect_item = True
+                pos += 1
+                continue
+
+            # разбираем очередной элемент; если он обрезан концом куска - дочитываем
+            # элемент принимаем только если за ним видно , ] или пробел,
+            # иначе обрезанное число "12" из "12.5" примется за целое
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                if end >= len(buf) or buf[end] not in ",] \t\r\n":
+                    raise ValueError(f"{path}: неожиданный символ после элемента")
+            except ValueError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                buf, pos = buf[pos:] + chunk, 0
+                eof = not chunk
+                continue
+
+            yield item
+            expect_item = False
+            pos = end
+            # отрезаем уже разобранную часть буфера
+            if pos > chunk_size:
+                buf, pos = buf[pos:], 0
+
+
+def build_row(
     p: Dict[str, Any],
     cbr_rate: Optional[float],
-    temp_snapshot: Optional[float],
-    crypto: Dict[str, Any],
-    etl_time: str,
-    sales_history: Dict[str, int]
-) -> Dict[str, Any]:
-    # собирает один словарь для товара p
+    sales_history: Dict[str, int],
+    increment: int
+) -> SalesRow:
+    # собирает запись для товара p (общие поля прогона - в RunContext, не здесь)
+    # increment - прирост продаж товара за прогон (SalesSimulator.increments)
     # обновляет sales_history в памяти (не сохраняет в файл)
-    # возвращает готовый к загрузке словарь
+    # возвращает готовую к загрузке запись
     prod_id = p.get("id")
-    title = p.get("title")
-    image = p.get("image")
-    category = p.get("category")
     try:
         base_price_usd = float(p.get("price", 0))
     except (ValueError, TypeError):
         base_price_usd = 0.0
         print(
-            f"[build_record] неверная цена у товара id={prod_id}, установлено 0.0")
+            f"[build_row] неверная цена у товара id={prod_id}, установлено 0.0")
 
     base_sales = p.get("rating", {}).get("count", 0)
 
     # получаем предыдущее значение продаж
     prev_sales = sales_history.get(str(prod_id), base_sales)
 
-    # генерируем случайное увеличение
-    increment = random.randint(1, 10)
     new_sales = prev_sales + increment
 
     # сохраняем в историю
@@ -71,91 +151,254 @@ def build_record(
     # пересчитываем цену в рубли если курс есть
     price_rub = round(base_price_usd * cbr_rate, 2) if cbr_rate else None
 
-    # собираем итоговый record
-    record = {
-        "product_id":      prod_id,
-        "title":           title,
-        "image":           image,
-        "category":        category,
-        "sales":           new_sales,
-        "price_usd":       base_price_usd,
-        "price_rub":       price_rub,
-        "cbr_usd_rub":     cbr_rate,
-        "temp_snapshot":   temp_snapshot,
-        "btc_price_usd":   crypto.get("current_price") if crypto else None,
-        "btc_change_24h":  crypto.get("price_change_percentage_24h") if crypto else None,
-        "etl_time":        etl_time
-    }
-    return record
-
-
-def transform() -> List[Dict[str, Any]]:
-    # читает сырые данные и обновляет историю продаж в sales_history
-    # возвращает список записей готовых для загрузки
-    products = load_json(RAW_PRODUCTS)
-    raw_cbr = load_json(RAW_CBR)
-    raw_weather = load_json(RAW_WEATHER)
-    raw_crypto_list = load_json(RAW_CRYPTO)
+    return SalesRow(prod_id, p.get("title"), p.get("image"), p.get("category"),
+                    new_sales, base_price_usd, price_rub)
 
-    # если хоть один из необходимых файлов не загрузился - завершаем трансформацию
-    if products is None or raw_cbr is None or raw_weather is None or raw_crypto_list is None:
-        print("[transform] недостаточно данных для трансформации, выходим.")
+
+def build_records(
+    products: Sequence[Dict[str, Any]],
+    context: RunContext,
+    sales_history: Dict[str, int],
+    engine: Optional[str] = None,
+    simulator: Optional[SalesSimulator] = None
+) -> Sequence[SalesRow]:
+    # собирает пачку записей для всех товаров выбранным движком
+    # приросты продаж даёт simulator (по умолчанию - по ETL_SALES_SEED, см. simulation.py):
+    # при одном зерне оба движка дают одинаковые продажи, независимо от размера пачек
+    # python возвращает SalesBatch, columnar - записи поверх массивов (см. columnar.ColumnarRecords),
+    # у обоих есть context - общие поля прогона
+    engine = (engine or ENGINE).lower()
+    simulator = simulator or get_simulator()
+    inc("records_built", len(products))
+    if engine == "columnar":
+        # numpy нужен только для этого движка, поэтому импортируем здесь
+        from columnar import build_columns
+        try:
+            with span("transform.build_columns"):
+                return build_columns(products, context, sales_history, simulator)
+        except (TypeError, ValueError, OverflowError) as e:
+            # колоночный движок требует целые id и продажи; история ещё не тронута
+            print(f"[build_records] колоночный движок не подошёл ({e}), считаем построчно")
+
+    with span("transform.build_row_loop"):
+        increments = simulator.increments([p.get("id") for p in products], context.etl_time)
+        return SalesBatch(context, [build_row(p, context.cbr_rate, sales_history, increment)
+                                    for p, increment in zip(products, increments)])
+
+
+def parse_weather_snapshots(raw_weather: Any) -> List[Dict[str, Any]]:
+    # раскладывает raw_weather.json на точки: location_name, координаты из ответа open-meteo
+    # и температура за последний час
+    # файл может быть объектом (одна точка, старый формат без location_name) или списком
+    items = raw_weather if isinstance(raw_weather, list) else [raw_weather]
+    snapshots = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        temps = item.get("hourly", {}).get("temperature_2m", [])
+        snapshots.append({
+            "location_name": item.get("location_name"),
+            "latitude":      item.get("latitude"),
+            "longitude":     item.get("longitude"),
+            "temperature":   temps[-1] if temps else None,
+        })
+    return snapshots
+
+
+def parse_crypto_quotes(raw_crypto: Any) -> List[Dict[str, Any]]:
+    # раскладывает raw_crypto.json (ответ coins/markets) на котировки по монетам
+    if not isinstance(raw_crypto, list):
+        return []
+    return [{
+        "asset_id":       coin.get("id"),
+        "symbol":         coin.get("symbol"),
+        "name":           coin.get("name"),
+        "price_usd":      coin.get("current_price"),
+        "change_pct_24h": coin.get("price_change_percentage_24h"),
+    } for coin in raw_crypto if isinstance(coin, dict) and coin.get("id")]
+
+
+def parse_cbr_currencies(raw_cbr: Any) -> List[Dict[str, Any]]:
+    # раскладывает ответ цб (raw_cbr.json) на курсы всех валют за один проход по Valute
+    # rate - рублей за одну единицу валюты: Value в ответе дан за Nominal единиц (100 иен, 10 юаней...)
+    if not isinstance(raw_cbr, dict):
         return []
+    currencies = []
+    for code, item in (raw_cbr.get("Valute") or {}).items():
+        try:
+            rate = float(item["Value"]) / float(item.get("Nominal") or 1)
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            print(f"[parse_cbr_currencies] неверный курс у валюты {code}, пропускаем")
+            continue
+        currencies.append({
+            "currency_code": item.get("CharCode") or code,
+            "description":   item.get("Name"),
+            "rate":          rate,
+        })
+    return currencies
+
+
+def parse_cbr_rates(raw_cbr: Any) -> Dict[str, float]:
+    # таблица курсов: код валюты -> рублей за единицу, рубль - 1.0
+    rates = {c["currency_code"]: c["rate"] for c in parse_cbr_currencies(raw_cbr)}
+    if rates:
+        rates["RUB"] = 1.0
+    return rates
+
+
+def parse_cbr_rate(raw_cbr: Any) -> Optional[float]:
+    # курс доллара из ответа цб (raw_cbr.json) или None
+    return parse_cbr_rates(raw_cbr).get("USD")
+
+
+def fx_factors(rates: Dict[str, float],
+               currencies: Sequence[str] = TARGET_CURRENCIES,
+               etl_time: Optional[str] = None) -> Tuple[Tuple[str, float], ...]:
+    # множители для пересчёта цены в долларах в валюты currencies: цена * множитель
+    # валюты, которых нет в ответе цб (или нет курса доллара), пропускаются
+    # о них предупреждаем один раз на прогон etl_time: контекст собирается при каждом transform
+    global _fx_warned_run
+    usd = rates.get("USD")
+    if not usd:
+        return ()
+    missing = [code for code in currencies if code not in rates]
+    if missing and (etl_time is None or etl_time != _fx_warned_run):
+        print(f"[transform] нет курса цб для валют: {', '.join(missing)}")
+        _fx_warned_run = etl_time
+    return tuple((code, usd / rates[code]) for code in currencies if code in rates)
+
+
+def _load_raw(raw: Optional[Dict[str, Any]], key: str, path: str) -> Any:
+    # сырые данные источника key: из raw (передача в памяти, pipeline.py) или из файла path
+    if raw is not None and key in raw:
+        return raw[key]
+    return load_json(path)
+
+
+def _load_run_context(raw: Optional[Dict[str, Any]] = None) -> Optional[RunContext]:
+    # берёт небольшие сырые данные (курс, погода, крипто) из raw или из файлов и определяет etl_time
+    # возвращает контекст прогона или None если данных не хватает
+    raw_cbr = _load_raw(raw, "cbr", RAW_CBR)
+    raw_weather = _load_raw(raw, "weather", RAW_WEATHER)
+    raw_crypto_list = _load_raw(raw, "crypto", RAW_CRYPTO)
+
+    # если хоть один из необходимых файлов не загрузился - завершаем трансформацию
+    if raw_cbr is None or raw_weather is None or raw_crypto_list is None:
+        return None
 
     # распаковываем нужные значения
-    cbr_rate = raw_cbr.get("Valute", {}).get("USD", {}).get("Value")
+    rates = parse_cbr_rates(raw_cbr)
+    cbr_rate = rates.get("USD")
     if cbr_rate is None:
         print("[transform] не удалось найти курс USD в cbr-данных")
 
-    hourly = raw_weather.get("hourly", {})
-    temps = hourly.get("temperature_2m", [])
-    temp_snapshot = temps[-1] if temps else None
+    # в записи идёт температура основной (первой) точки
+    snapshots = parse_weather_snapshots(raw_weather)
+    temp_snapshot = snapshots[0]["temperature"] if snapshots else None
     if temp_snapshot is None:
         print("[transform] нет данных о температуре за последний час")
 
+    # в записи идёт биткоин, если его нет - первая монета
     if isinstance(raw_crypto_list, list) and raw_crypto_list:
-        crypto = raw_crypto_list[0]
+        crypto = next((c for c in raw_crypto_list if c.get("id") == "bitcoin"),
+                      raw_crypto_list[0])
     else:
         crypto = {}
         print("[transform] raw_crypto.json не содержит элементов")
 
-    # получаем текущее время в зоне Владивостока
-    try:
-        now_vl = datetime.now(ZoneInfo("Asia/Vladivostok"))
-    except Exception:
-        from datetime import timezone, timedelta
-        now_utc = datetime.now(timezone.utc)
-        now_vl = now_utc + timedelta(hours=10)
-    etl_time = now_vl.strftime("%Y-%m-%d %H:%M:%S")
-
-    # загружаем историю продаж
-    if os.path.exists(SALES_HISTORY):
-        history_data = load_json(SALES_HISTORY)
-        sales_history = history_data if isinstance(history_data, dict) else {}
-        if not isinstance(history_data, dict):
-            print("[transform] sales_history.json не dict, используем пустой словарь")
-    else:
-        sales_history = {}
+    # время прогона: заданное в raw (pipeline, перепрогон снимка) или текущее во Владивостоке
+    etl_time = (raw or {}).get("etl_time") or etl_time_now()
 
-    # формируем новые записи
-    records = []
-    for p in products:
-        rec = build_record(p, cbr_rate, temp_snapshot,
-                           crypto, etl_time, sales_history)
-        records.append(rec)
+    return RunContext.build(etl_time, cbr_rate, temp_snapshot, crypto,
+                            fx_factors(rates, etl_time=etl_time))
 
-    # сохраняем обновлённый sales_history
-    temp_path = SALES_HISTORY + ".tmp"
-    try:
-        with open(temp_path, "w", encoding="utf-8") as hist_f:
-            json.dump(sales_history, hist_f, ensure_ascii=False, indent=2)
-        os.replace(temp_path, SALES_HISTORY)
-    except IOError as e:
-        print(f"[transform] ошибка записи истории продаж: {e}")
 
+def _product_keys(products: Sequence[Dict[str, Any]]) -> List[str]:
+    # ключи товаров в хранилище продаж, как в sales_history.json
+    return [str(p.get("id")) for p in products]
+
+
+def _build_with_store(store, products: Sequence[Dict[str, Any]], context: RunContext,
+                      simulator: Optional[SalesSimulator] = None) -> Sequence[SalesRow]:
+    # читает из хранилища продажи только товаров из products, считает записи
+    # и пишет обратно только изменённые ключи
+    with span("transform.state_read"):
+        sales_history = store.get_many(_product_keys(products))
+    records = build_records(products, context, sales_history, simulator=simulator)
+    with span("transform.state_write"):
+        store.put_many(sales_history)
     return records
 
 
+def transform(raw: Optional[Dict[str, Any]] = None, store=None,
+              simulator: Optional[SalesSimulator] = None) -> Sequence[SalesRow]:
+    # читает сырые данные и обновляет историю продаж в хранилище состояния (state.py)
+    # raw - уже загруженные данные по источникам (products, cbr, weather, crypto),
+    # как их отдаёт extract.run_extract(sources=RAW_SOURCES); чего нет в raw - читается из data/
+    # store - хранилище истории продаж вместо open_sales_store() (ledger.HistoryDelta копит изменения
+    # в памяти, не трогая настоящее); simulator - генератор продаж вместо get_simulator()
+    # (продолжение прогона из журнала считает с зерном первой попытки)
+    # возвращает пачку записей готовых для загрузки (с контекстом прогона в .context)
+    # или пустой список
+    products = _load_raw(raw, "products", RAW_PRODUCTS)
+    if isinstance(products, str):
+        # потоковый extract отдаёт путь к файлу каталога
+        products = load_json(products)
+    context = _load_run_context(raw)
+
+    # если хоть один из необходимых файлов не загрузился - завершаем трансформацию
+    if products is None or context is None:
+        print("[transform] недостаточно данных для трансформации, выходим.")
+        return []
+
+    # формируем новые записи и фиксируем историю продаж одной транзакцией
+    store = store if store is not None else open_sales_store()
+    try:
+        records = _build_with_store(store, products, context, simulator)
+        store.commit()
+    finally:
+        store.close()
+    return records
+
+
+def transform_batches(batch_size: int = BATCH_SIZE, raw: Optional[Dict[str, Any]] = None,
+                      store=None, simulator: Optional[SalesSimulator] = None) -> Iterator[Sequence[SalesRow]]:
+    # потоковая версия transform(): товары разбираются из файла по одному,
+    # записи отдаются пачками по batch_size, весь каталог в памяти не держится
+    # raw - как в transform(); raw["products"] может быть списком товаров или путём к файлу
+    # история продаж фиксируется после того как отдана последняя пачка; store и simulator - как в transform()
+    if batch_size < 1:
+        raise ValueError("batch_size должен быть положительным")
+    products = raw["products"] if raw is not None and "products" in raw else RAW_PRODUCTS
+    if isinstance(products, str) and not os.path.exists(products):
+        print(f"[load_json] файл {products} не найден")
+        products = None
+    if products is None:
+        print("[transform] недостаточно данных для трансформации, выходим.")
+        return
+    context = _load_run_context(raw)
+    if context is None:
+        print("[transform] недостаточно данных для трансформации, выходим.")
+        return
+
+    store = store if store is not None else open_sales_store()
+    try:
+        batch: List[Dict[str, Any]] = []
+        for p in (iter_json_array(products) if isinstance(products, str) else products):
+            batch.append(p)
+            if len(batch) >= batch_size:
+                yield _build_with_store(store, batch, context, simulator)
+                batch = []
+        if batch:
+            yield _build_with_store(store, batch, context, simulator)
+        store.commit()
+    finally:
+        store.close()
+
+
 if __name__ == "__main__":
+    start_memory_probe()
     example = transform()
-    print("примеры первых трёх записей:", example[:3])
+    print("примеры первых трёх записей:", as_dicts(example[:3], example.context) if example else [])
+    stop_memory_probe()
+    export_run("transform")
@@ -1,16 +1,23 @@
-from etl.transform import transform
-import pandas as pd
+import os
+import sys
 
-# получаем данные
-records = transform()
+# модули etl импортируют друг друга напрямую, поэтому кладём папку etl в путь поиска
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "etl"))
 
-# превращаем в DataFrame
-df = pd.DataFrame(records)
+from export import list_exports, read_export  # noqa: E402
 
-# смотрим первые строки и типы колонок
-print(df.head(10))  # первые 10 записей
-print("\nТипы колонок:\n", df.dtypes)
+# смотрим последнюю выгрузку записей (etl/export.py), transform здесь не вызывается,
+# поэтому просмотр не сдвигает историю продаж
+# выгрузку пишет pipeline.py при ETL_EXPORT_FORMAT=parquet (или arrow)
+exports = list_exports()
+if not exports:
+    print("Выгрузок нет: запустите pipeline.py с ETL_EXPORT_FORMAT=parquet")
+    sys.exit(1)
+etl_time, path = exports[-1]
+table = read_export(path)
 
-# сохраняем в CSV
-df.to_csv("data/transformed.csv", index=False, encoding="utf-8")
-print("\nСохранено в data/transformed.csv")
+# смотрим первые строки и типы колонок
+print(f"Прогон {etl_time}: {table.num_rows} записей, {path}")
+for row in table.slice(0, 10).to_pylist():  # первые 10 записей
+    print(row)
+print("\nТипы колонок:\n", table.schema)